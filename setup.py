@@ -24,6 +24,7 @@ setuptools.setup(
             "tmv-camera=tmv.camera:camera_console",
             "tmv-video-compile=tmv.video:video_compile_console",
             "tmv-video-join=tmv.video:video_join_console",
+            "tmv-video-bench=tmv.video:video_bench_console",
             "tmv-video-info=tmv.videotools:video_info_console",
             "tmv-videod=tmv.videod:videod_console",
             "tmv-video-decompile=tmv.videotools:video_decompile_console",
@@ -46,7 +47,7 @@ setuptools.setup(
     # flask?
     
     install_requires=['astral', 'toml', 'python-dateutil', 'pytimeparse',
-                      'Pillow', 'watchdog',  'freezegun', 'flask',
+                      'Pillow', 'numpy', 'watchdog',  'freezegun', 'flask',
                      # 'flask-socketio',# 'python-socketio',
                       'ascii_graph',
                       #'gpiozero', 'RPi.GPIO',
@@ -0,0 +1,10 @@
+# pylint: disable=import-error
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path_factory, monkeypatch):
+    """ Keep caches that default to ~/.cache (validation.default_cache_path, predict.default_history_path) out of the user's """
+    path = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(path))
+    return path
@@ -0,0 +1,69 @@
+# pylint: disable=line-too-long, import-error
+import threading
+from pathlib import Path
+
+import pytest
+
+import tmv.admission
+from tmv.admission import Admission, downscale, load_per_cpu, memory_available
+
+
+def test_downscale():
+    cl, changes = downscale(["ffmpeg", "-i", "in", "-vcodec", "libx264", "-preset", "veryfast", "out.mp4"], threads=2)
+    assert cl == ["ffmpeg", "-i", "in", "-vcodec", "libx264", "-threads", "2", "-preset", "ultrafast", "out.mp4"]
+    assert changes == "-preset ultrafast, -threads 2"
+    cl, _ = downscale(["ffmpeg", "-vcodec", "libsvtav1", "-preset", "12", "-threads", "8", "out.mp4"])
+    assert cl == ["ffmpeg", "-vcodec", "libsvtav1", "-preset", "13", "-threads", "1", "out.mp4"]
+    cl, _ = downscale(["ffmpeg", "-vcodec", "libvpx-vp9", "-deadline", "good", "-cpu-used", "5", "out.webm"], faster=1)
+    assert cl[cl.index("-cpu-used") + 1] == "6"
+    # not an encode
+    assert downscale(["ffmpeg", "-i", "in", "-c", "copy", "out.mp4"]) == (["ffmpeg", "-i", "in", "-c", "copy", "out.mp4"], "unchanged")
+
+
+def test_host():
+    if not Path("/proc/meminfo").exists():
+        pytest.skip("no /proc")
+    assert load_per_cpu() >= 0
+    assert memory_available() > 0
+
+
+def test_admit(tmp_path, monkeypatch, caplog):
+    caplog.set_level("INFO")
+    admission = Admission()
+    cl = ["ffmpeg", "-vcodec", "libx264", "-preset", "fast", "out.mp4"]
+    assert admission.admit(cl, tmp_path) == (cl, False)
+    loads = iter([4, 4, 0.5])
+    monkeypatch.setattr(tmv.admission, "load_per_cpu", lambda: next(loads, 4))
+    admission.max_load = 1
+    admission.poll = 0.01
+    # recovers while deferred
+    assert admission.admit(cl, tmp_path) == (cl, False)
+    assert "Deferring ffmpeg: load 4.00/cpu > 1" in caplog.text
+    assert "Admitting ffmpeg after waiting" in caplog.text
+    # doesn't
+    admission.max_wait = 0.05
+    assert admission.admit(cl, tmp_path) == (downscale(cl)[0], True)
+    admission.max_load = None
+    admission.min_disk = 2 ** 40
+    with pytest.raises(OSError):
+        admission.admit(cl, tmp_path / "not-yet")
+
+
+def test_cancel(tmp_path):
+    admission = Admission()
+    admission.min_disk = 2 ** 40
+    admission.poll = 60
+    raised = []
+
+    def admit():
+        try:
+            admission.admit(["ffmpeg", "out.mp4"], tmp_path)
+        except InterruptedError as exc:
+            raised.append(exc)
+
+    t = threading.Thread(target=admit)
+    t.start()
+    while not raised and t.is_alive():
+        admission.cancel()
+        t.join(0.1)
+    assert raised
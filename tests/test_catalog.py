@@ -0,0 +1,99 @@
+# pylint: disable=line-too-long, import-error, redefined-outer-name
+import os
+from datetime import datetime as dt, time, date
+from pathlib import Path
+import shutil
+import pytest
+
+from tmv.catalog import Catalog
+from tmv.video import VideoMakerConcat
+from tmv.videod import TaskRunner
+
+
+def touch_images(root: Path, location: str, day: str, hours):
+    d = root / location / "daily-photos" / day
+    d.mkdir(parents=True, exist_ok=True)
+    for h in hours:
+        (d / f"{day}T{h:02d}-00-00.jpg").write_bytes(b"\xff\xd8\xff fake \xff\xd9")
+
+
+@pytest.fixture()
+def tmv_root(tmp_path):
+    touch_images(tmp_path, "cam1", "2000-01-01", range(0, 24))
+    touch_images(tmp_path, "cam1", "2000-01-02", range(0, 24))
+    touch_images(tmp_path, "cam2", "2000-01-01", range(12, 14))
+    (tmp_path / "cam1" / "daily-photos" / "2000-01-01" / "not-dated.jpg").touch()
+    (tmp_path / "cam1" / "daily-photos" / "2000-01-01" / "notes.txt").touch()
+    return tmp_path
+
+
+def test_refresh_and_query(tmv_root):
+    c = Catalog(tmv_root)
+    assert c.refresh("cam1") == (48, 0)
+    assert c.refresh("cam2") == (2, 0)
+    assert c.count("cam1") == 48
+    assert c.count("cam2") == 2
+    assert c.days("cam1") == [date(2000, 1, 1), date(2000, 1, 2)]
+    frames = c.frames("cam1", start=dt(2000, 1, 1, 12), end=dt(2000, 1, 2, 12), start_time=time(11), end_time=time(13))
+    assert [f.taken for f in frames] == [dt(2000, 1, 1, 12), dt(2000, 1, 1, 13), dt(2000, 1, 2, 11), dt(2000, 1, 2, 12)]
+    assert Path(frames[0].filename).is_file()
+    assert c.count("cam1", subdir="daily-photos/2000-01-02") == 24
+    assert c.latest("cam1") == tmv_root / "cam1/daily-photos/2000-01-02/2000-01-02T23-00-00.jpg"
+
+
+def test_incremental_refresh(tmv_root):
+    c = Catalog(tmv_root)
+    c.refresh("cam1")
+    # nothing changed: nothing rescanned
+    assert c.refresh("cam1") == (0, 0)
+    touch_images(tmv_root, "cam1", "2000-01-03", [1, 2])
+    (tmv_root / "cam1/daily-photos/2000-01-02/2000-01-02T00-00-00.jpg").unlink()
+    assert c.refresh("cam1") == (2, 1)
+    shutil.rmtree(tmv_root / "cam1/daily-photos/2000-01-01")
+    assert c.refresh("cam1") == (0, 24)
+    assert c.count("cam1") == 25
+    # persistent
+    c.close()
+    assert Catalog(tmv_root).count("cam1") == 25
+
+
+def test_nested_locations(tmv_root):
+    c = Catalog(tmv_root)
+    assert c.refresh(".") == (50, 0)
+    assert c.refresh("cam1") == (48, 0)
+    # each has its own rows: refreshing one doesn't undo the other
+    assert c.refresh(".") == (0, 0)
+    assert c.refresh("cam1") == (0, 0)
+    assert c.count(".") == 50
+    assert c.count("cam1") == 48
+    path = tmv_root / "cam1/daily-photos/2000-01-01/2000-01-01T00-00-00.jpg"
+    c.set_pixel_average([(path, 0.5)])
+    assert c.pixel_averages([path]) == [0.5]
+    path.unlink()
+    assert c.refresh("cam1") == (0, 1)
+    assert c.count(".") == 50
+    assert c.refresh(".") == (0, 1)
+    assert c.count(".") == 49
+
+
+def test_video_maker_from_catalog(tmv_root):
+    c = Catalog(tmv_root)
+    c.refresh("cam1")
+    mm = VideoMakerConcat()
+    mm.validate_images = False
+    mm.start_time = time(6)
+    mm.end_time = time(7)
+    mm.files_from_catalog(c, "cam1", subdir="daily-photos")
+    mm.load_videos()
+    assert [tlf.taken.hour for tlf in mm.videos[0].images] == [6, 7, 6, 7]
+
+
+def test_most_recent_from_catalog(tmv_root):
+    os.chdir(tmv_root / "cam1")
+    vd = TaskRunner()
+    vd.raise_task_exceptions = True
+    vd.configs("[most-recent]")
+    vd.catalog = Catalog(tmv_root)
+    vd.location = "cam1"
+    vd.run_tasks()
+    assert Path("most-recent-2000-01-02T23-00-00.jpg").resolve() == (tmv_root / "cam1/daily-photos/2000-01-02/2000-01-02T23-00-00.jpg").resolve()
@@ -0,0 +1,51 @@
+# pylint: disable=line-too-long, import-error, redefined-outer-name
+from datetime import datetime as dt, timedelta
+import numpy as np
+import pytest
+from PIL import Image
+
+import tmv.deflicker
+from tmv.deflicker import Deflicker, frame_lumas, gains, smooth
+from tmv.framefeed import FrameFeed
+from tmv.catalog import Catalog
+
+
+@pytest.fixture()
+def flickering(tmp_path):
+    """ 30 grey frames a minute apart, alternating brighter and darker """
+    filenames = []
+    for i in range(30):
+        level = 100 + (20 if i % 2 else -20)
+        fn = tmp_path / "daily-photos" / f"2000-01-01T00-{i:02d}-00.jpg"
+        fn.parent.mkdir(exist_ok=True)
+        Image.new("RGB", (64, 48), (level, level, level)).save(fn)
+        filenames.append(fn)
+    taken = [dt(2000, 1, 1, 0, i) for i in range(30)]
+    return filenames, taken
+
+
+def test_smooth():
+    taken = np.array([dt(2000, 1, 1, 0, m) for m in (0, 1, 2, 3, 10)], dtype="datetime64[us]")
+    values = np.array([1, 3, 5, np.nan, 9])
+    s = smooth(taken, values, timedelta(minutes=2))
+    assert s.tolist() == pytest.approx([2, 3, 4, 5, 9])
+    assert gains([0.5, 0, np.nan, 0.1], [1, 1, 1, 1]).tolist() == [2, 1, 1, 2]
+
+
+def test_deflicker(flickering):
+    filenames, taken = flickering
+    lumas = frame_lumas(filenames)
+    assert lumas.std() > 0.05
+    deflicker = Deflicker.from_frames(filenames, taken, window=timedelta(minutes=20))
+    frames = [np.frombuffer(b, dtype="uint8") for b in FrameFeed(filenames, frame_filters=[deflicker])]
+    means = np.array([f.mean() for f in frames])
+    assert means.std() < 2
+
+
+def test_lumas_cached(flickering, tmp_path, monkeypatch):
+    filenames, _ = flickering
+    catalog = Catalog(tmp_path)
+    catalog.refresh()
+    lumas = frame_lumas(filenames, catalog=catalog)
+    monkeypatch.setattr(tmv.deflicker, "frame_luma", None)
+    assert frame_lumas(filenames, catalog=catalog).tolist() == pytest.approx(lumas.tolist())
@@ -0,0 +1,74 @@
+# pylint: disable=line-too-long, import-error
+import os
+
+from tmv.dirindex import DirIndex
+
+
+def settle(*paths):
+    """ Set mtimes in the past, as the index doesn't keep listings of just-changed dirs """
+    for p in paths:
+        os.utime(p, (0, 0))
+
+
+def test_listing(tmp_path):
+    day = tmp_path / "2000-01-01"
+    day.mkdir()
+    (tmp_path / ".segments").mkdir()
+    for name in ("a.jpg", "b.JPG", "c.jpeg", "d.txt"):
+        (day / name).write_bytes(b"12")
+    settle(day, tmp_path)
+    index = DirIndex()
+    assert index.dirs(tmp_path) == [day]
+    assert index.dirs(tmp_path, hidden=True) == [tmp_path / ".segments", day]
+    assert index.files(day, (".jpg", ".jpeg")) == [day / "a.jpg", day / "b.JPG", day / "c.jpeg"]
+    assert index.walk_files(tmp_path, (".txt",)) == [day / "d.txt"]
+    assert index.stat(day / "a.jpg")[0] == 2
+    assert index.stat(day / "missing.jpg") is None
+    assert index.files(tmp_path / "missing") == []
+    counts = index.take_counts()
+    assert counts['scandir'] == 2 and counts['cached'] > 0
+    assert index.take_counts() == {}
+
+
+def test_cached(tmp_path):
+    (tmp_path / "a.jpg").write_bytes(b"1")
+    settle(tmp_path / "a.jpg", tmp_path)
+    index = DirIndex()
+    assert index.files(tmp_path) == [tmp_path / "a.jpg"]
+    # settled when listed, so a change in place is unseen until the dir changes
+    (tmp_path / "a.jpg").write_bytes(b"12")
+    assert index.stat(tmp_path / "a.jpg")[0] == 1
+    (tmp_path / "b.jpg").write_bytes(b"1")
+    assert index.files(tmp_path) == [tmp_path / "a.jpg", tmp_path / "b.jpg"]
+    assert index.stat(tmp_path / "a.jpg")[0] == 2
+    # just changed, so listed every time
+    index.take_counts()
+    index.files(tmp_path)
+    index.files(tmp_path)
+    assert index.take_counts()['scandir'] == 2
+    settle(tmp_path)
+    (tmp_path / "a.jpg").write_bytes(b"123")
+    index.files(tmp_path)
+    assert index.stat(tmp_path / "a.jpg")[0] == 3
+    (tmp_path / "a.jpg").write_bytes(b"1234")
+    index.invalidate(tmp_path)
+    assert index.stat(tmp_path / "a.jpg")[0] == 4
+
+
+def test_unsettled(tmp_path):
+    # being uploaded as it's listed
+    image = tmp_path / "a.jpg"
+    image.write_bytes(b"1")
+    settle(tmp_path)
+    index = DirIndex()
+    assert index.stat(image)[0] == 1
+    with open(image, "ab") as f:
+        f.write(b"23")
+    # the dir's unchanged, but the file is stat'd again
+    assert index.stat(image)[0] == 3
+    settle(image)
+    assert index.stat(image) == (3, 0)
+    # until it's settled
+    index.take_counts()
+    assert index.stat(image) == (3, 0)
+    assert index.take_counts() == {'stat': 1, 'cached': 1}
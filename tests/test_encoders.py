@@ -0,0 +1,26 @@
+# pylint: disable=line-too-long, import-error
+import pytest
+
+import tmv.encoders
+from tmv.encoders import EncoderProfile, configure_encoders, encoder_profile
+from tmv.exceptions import ConfigError
+
+
+def test_output_parameters():
+    assert encoder_profile().output_parameters() == ["-vcodec", "libx264", "-preset", "veryfast"]
+    assert encoder_profile("x265").output_parameters() == ["-vcodec", "libx265", "-preset", "fast", "-crf", "28", "-tag:v", "hvc1"]
+    assert encoder_profile("vp9").output_parameters() == ["-vcodec", "libvpx-vp9", "-deadline", "good", "-cpu-used", "5", "-crf", "33", "-b:v", "0", "-row-mt", "1"]
+    assert EncoderProfile("t", "libsvtav1", 10, threads=2).output_parameters() == ["-vcodec", "libsvtav1", "-preset", "10", "-threads", "2"]
+
+
+def test_configure_encoders(monkeypatch):
+    monkeypatch.setattr(tmv.encoders, "PROFILES", dict(tmv.encoders.PROFILES))
+    x264 = encoder_profile("x264")
+    configure_encoders({'x264': {'crf': 20}, 'small': {'codec': "libx265", 'preset': "slow"}})
+    assert encoder_profile("x264").as_dict() == {'codec': "libx264", 'preset': "veryfast", 'crf': 20, 'threads': None}
+    assert x264.crf is None  # replaced, not changed
+    assert encoder_profile("small").output_parameters()[:4] == ["-vcodec", "libx265", "-preset", "slow"]
+    with pytest.raises(ConfigError):
+        encoder_profile("nope")
+    with pytest.raises(ConfigError):
+        configure_encoders({'bad': {'codec': "mpeg2video"}})
@@ -0,0 +1,140 @@
+# pylint: disable=line-too-long, import-error, redefined-outer-name
+import sys
+import time
+import threading
+from subprocess import CalledProcessError, TimeoutExpired
+import pytest
+
+from tmv.ffrunner import JobRunner
+from tmv.metrics import Meter, metering
+
+# a stand-in for ffmpeg: reports progress to the -progress pipe, writes its output and some stderr
+FAKE_FFMPEG = """#!{python}
+import os, sys, time
+args = sys.argv[1:]
+fd = int(args[args.index("-progress") + 1].split(":")[1])
+with os.fdopen(fd, "w") as progress:
+    for frame in range(1, 4):
+        progress.write(f"frame={{frame}}\\nspeed=1x\\nprogress={{'end' if frame == 3 else 'continue'}}\\n")
+        progress.flush()
+for i in range(1000):
+    print(f"line {{i}}", file=sys.stderr)
+open(args[-1], "w").write("partial")
+time.sleep(float(os.environ.get("FAKE_SLEEP", "0")))
+sys.exit(int(os.environ.get("FAKE_EXIT", "0")))
+"""
+
+
+@pytest.fixture()
+def ffmpeg(tmp_path):
+    path = tmp_path / "bin" / "ffmpeg"
+    path.parent.mkdir()
+    path.write_text(FAKE_FFMPEG.format(python=sys.executable))
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_progress(ffmpeg, tmp_path):
+    runner = JobRunner()
+    runner.stderr_lines = 10
+    updates = []
+    _, err = runner.run([ffmpeg, "-i", "in", tmp_path / "out.mp4"], on_progress=updates.append)
+    assert [u['frame'] for u in updates] == ["1", "2", "3"]
+    assert updates[-1]['progress'] == "end"
+    assert err.splitlines() == [f"line {i}" for i in range(990, 1000)]
+
+
+def test_failure_and_timeout(ffmpeg, tmp_path, monkeypatch):
+    runner = JobRunner()
+    out = tmp_path / "out.mp4"
+    monkeypatch.setenv("FAKE_EXIT", "3")
+    with pytest.raises(CalledProcessError):
+        runner.run([ffmpeg, out], log_filename=tmp_path / "fail.log", outputs=[out])
+    assert "line 999" in (tmp_path / "fail.log").read_text()
+    monkeypatch.setenv("FAKE_EXIT", "0")
+    monkeypatch.setenv("FAKE_SLEEP", "10")
+    start = time.monotonic()
+    with pytest.raises(TimeoutExpired):
+        runner.run([ffmpeg, out], outputs=[out], timeout=1)
+    assert time.monotonic() - start < 5
+    assert not out.exists()
+
+
+def test_limits(tmp_path):
+    runner = JobRunner()
+    runner.configd({'max_jobs': 2, 'max_host_jobs': 1, 'lock_dir': str(tmp_path / "slots"), 'nice': 5})
+    sleep = [sys.executable, "-c", "import time; time.sleep(0.5)"]
+    threads = [threading.Thread(target=runner.run, args=(sleep,)) for _ in range(3)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # one at a time
+    assert time.monotonic() - start >= 1.5
+    out, _ = runner.run([sys.executable, "-c", "import os; print(os.nice(0))"])
+    assert int(out) >= 5
+
+
+def test_atomic(ffmpeg, tmp_path, monkeypatch):
+    runner = JobRunner()
+    out = tmp_path / "out.mp4"
+    out.write_text("done")
+    monkeypatch.setenv("FAKE_EXIT", "3")
+    with pytest.raises(CalledProcessError):
+        runner.run([ffmpeg, out], outputs=[out], atomic=True)
+    # the previous output is untouched, and the partial one removed
+    assert out.read_text() == "done"
+    assert list(tmp_path.glob(".partial-*")) == []
+    monkeypatch.setenv("FAKE_EXIT", "0")
+    runner.run([ffmpeg, out], outputs=[out], atomic=True)
+    assert out.read_text() == "partial"
+    assert list(tmp_path.glob(".partial-*")) == []
+
+
+def test_metrics(ffmpeg, tmp_path):
+    runner = JobRunner()
+    out = tmp_path / "out.mp4"
+    with metering(Meter()) as meter:
+        runner.run([ffmpeg, "-i", "in", out], outputs=[out])
+        runner.run([ffmpeg, "-i", "in", out], outputs=[out], timeout=10)
+    assert meter.counts['frames'] == 6
+    assert meter.counts['bytes_written'] == 2 * len("partial")
+    # the fake ffmpeg's python startup, at least
+    assert meter.counts['cpu_seconds'] > 0
+
+
+def test_cancel(tmp_path):
+    runner = JobRunner()
+    out = tmp_path / "out.mp4"
+    spin = [sys.executable, "-c", "import sys, time\nopen(sys.argv[1], 'w').write('partial')\nwhile True: pass", out]
+    raised = []
+
+    def run():
+        with metering(Meter()) as meter:
+            try:
+                runner.run(spin, outputs=[out])
+            except CalledProcessError:
+                raised.append(meter)
+
+    t = threading.Thread(target=run)
+    t.start()
+    time.sleep(1)
+    runner.cancel_all()
+    t.join()
+    assert not out.exists()
+    # the killed job is reaped by the thread running it, so its cpu time is metered
+    assert raised and raised[0].counts['cpu_seconds'] > 0.3
+
+
+def test_deferred_encode_holds_no_slot(tmp_path):
+    runner = JobRunner()
+    runner.configd({'max_jobs': 1, 'admission': {'min_disk': 2 ** 40, 'poll': 0.05, 'max_wait': 60}})
+    deferred = threading.Thread(target=lambda: pytest.raises(InterruptedError, runner.run, ["ffmpeg", tmp_path / "out.mp4"], outputs=[tmp_path / "out.mp4"]))
+    deferred.start()
+    time.sleep(0.2)
+    # not an encode, so runs while the other waits for disk space
+    out, _ = runner.run([sys.executable, "-c", "print('ran')"], timeout=5)
+    assert out.strip() == "ran"
+    runner.cancel_all()
+    deferred.join()
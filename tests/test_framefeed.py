@@ -0,0 +1,74 @@
+# pylint: disable=line-too-long, import-error, redefined-outer-name
+import sys
+from subprocess import CalledProcessError
+import numpy as np
+import pytest
+from PIL import Image
+
+from tmv.framefeed import FrameBlend, FrameFeed
+from tmv.ffrunner import JobRunner
+
+
+@pytest.fixture()
+def images(tmp_path):
+    """ 50 jpegs of increasing brightness """
+    for i in range(50):
+        Image.new("RGB", (65, 48), (i * 5, i * 5, i * 5)).save(tmp_path / f"2000-01-01T00-{i:02d}-00.jpg")
+    return sorted(tmp_path.glob("*.jpg"))
+
+
+def test_pass_through(images):
+    feed = FrameFeed(images, read_ahead=4)
+    assert not feed.decode
+    assert list(feed) == [f.read_bytes() for f in images]
+    assert feed.input_parameters(25)[:2] == ["-f", "image2pipe"]
+
+
+def test_decode_and_filter(images, tmp_path):
+    (tmp_path / "2000-01-01T00-99-00.jpg").write_text("not an image")
+    seen = []
+
+    def invert(frame, i):
+        seen.append(i)
+        return 255 - frame
+
+    feed = FrameFeed(images + [tmp_path / "2000-01-01T00-99-00.jpg"], frame_filters=[invert], read_ahead=4)
+    assert feed.input_parameters(25)[:6] == ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "64x48"]
+    frames = [np.frombuffer(b, dtype="uint8").reshape(48, 64, 3) for b in feed]
+    assert len(frames) == 50
+    assert seen == list(range(50))
+    assert feed.n_skipped == 1
+    assert frames[0].mean() == pytest.approx(255, abs=2)
+    assert frames[-1].mean() == pytest.approx(255 - 49 * 5, abs=2)
+
+
+def test_resize(images):
+    feed = FrameFeed(images[:3], size=(32, 24))
+    assert [len(b) for b in feed] == [32 * 24 * 3] * 3
+
+
+def test_read_ahead_bounded(images):
+    # 64x48 RGB frames are 9216 bytes
+    feed = FrameFeed(images, decode=True, read_ahead=32, read_ahead_mb=0.05)
+    assert feed.frames_ahead() == 5
+    assert FrameFeed(images, decode=True, read_ahead_mb=0.001).frames_ahead() == 2
+    assert FrameFeed(images, decode=True, read_ahead_mb=None).frames_ahead() == 32
+    assert len(list(feed)) == 50
+
+
+def test_run_with_feed(images, tmp_path):
+    runner = JobRunner()
+    count_stdin = [sys.executable, "-c", "import sys; print(len(sys.stdin.buffer.read()))"]
+    out, _ = runner.run(count_stdin, feed=FrameFeed(images))
+    assert int(out) == sum(f.stat().st_size for f in images)
+
+    fail = [sys.executable, "-c", "import sys; sys.exit(3)"]
+    with pytest.raises(CalledProcessError):
+        runner.run(fail, feed=FrameFeed(images), log_filename=tmp_path / "fail.log")
+    assert (tmp_path / "fail.log").is_file()
+
+
+def test_frame_blend():
+    blend = FrameBlend(3)
+    frames = [np.full((2, 2, 3), v, dtype="uint8") for v in (0, 30, 60, 90)]
+    assert [blend(f, i)[0, 0, 0] for i, f in enumerate(frames)] == [0, 15, 30, 60]
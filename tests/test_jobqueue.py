@@ -0,0 +1,114 @@
+# pylint: disable=line-too-long, import-error
+import os
+from multiprocessing import Process
+from time import sleep
+
+from tmv.jobqueue import JobQueue, digest
+
+
+def test_claim(tmp_path):
+    q = JobQueue(tmp_path)
+    day = q.enqueue("cam1", "daily 2000-01-01", 10)
+    recap = q.enqueue("cam1", "recap", 20, [day])
+    other = q.enqueue("cam2", "other", 5)
+    assert q.enqueue("cam1", "daily 2000-01-01", 10) == day
+    assert q.claim("w1").id == other
+    job = q.claim("w1")
+    assert job.id == day
+    # recap is after day
+    assert q.claim("w2") is None
+    assert q.done(job, "w1", "signature")
+    assert q.claim("w2").id == recap
+    assert q.latest("cam1")["daily 2000-01-01"].signature == "signature"
+    assert q.counts() == {'pending': 0, 'running': 2, 'done': 1, 'failed': 0}
+
+
+def test_retry(tmp_path):
+    q = JobQueue(tmp_path)
+    q.retry_delay = 0
+    q.max_attempts = 2
+    day = q.enqueue("cam1", "daily", 10)
+    recap = q.enqueue("cam1", "recap", 20, [day])
+    job = q.claim("w1")
+    assert q.fail(job, "w1", "ffmpeg failed")
+    job = q.claim("w1")
+    assert job.id == day and job.attempts == 2
+    q.fail(job, "w1", "ffmpeg failed")
+    # failed for good, and so is recap
+    assert q.claim("w1") is None
+    assert q.latest("cam1")["recap"].state == "failed"
+    assert q.latest("cam1")["recap"].id == recap
+    # released jobs aren't counted as attempts
+    q.enqueue("cam1", "daily", 10)
+    job = q.claim("w1")
+    assert q.release(job, "w1")
+    assert q.claim("w1").attempts == 1
+
+
+def test_lease(tmp_path):
+    q = JobQueue(tmp_path)
+    q.lease = 0.2
+    q.enqueue("cam1", "daily", 10)
+    job = q.claim("w1")
+    assert q.heartbeat(job, "w1")
+    sleep(0.3)
+    # w1 has died, or is stuck
+    assert q.claim("w2").id == job.id
+    assert not q.heartbeat(job, "w1")
+    assert not q.done(job, "w1")
+
+
+def test_purge(tmp_path):
+    q = JobQueue(tmp_path)
+    for _ in range(3):
+        q.enqueue("cam1", "daily", 10)
+        job = q.claim("w1")
+        q.done(job, "w1")
+    assert q.purge(before=float("inf")) == 2
+    assert q.latest("cam1")["daily"].id == job.id
+
+
+def test_digest(tmp_path):
+    assert digest(((str(tmp_path / "a"), 1, 2), ("b", 3)), tmp_path) == digest((("/elsewhere/a", 1, 2), ("b", 3)), "/elsewhere")
+
+
+def work(path, log, die=False):
+    q = JobQueue(path=path)
+    q.lease = 0.5
+    while True:
+        job = q.claim(str(os.getpid()))
+        if job is None:
+            return
+        if die:
+            os._exit(1)  # pylint: disable=protected-access
+        sleep(0.05)
+        with open(log, "a") as f:
+            f.write(f"{job.node} {os.getpid()}\n")
+        q.done(job, str(os.getpid()))
+        sleep(0.01)  # let others claim
+
+
+def test_workers(tmp_path):
+    q = JobQueue(tmp_path)
+    for i in range(20):
+        q.enqueue("cam1", f"job{i}", 10)
+    log = tmp_path / "log"
+    dead = Process(target=work, args=(q.path, log, True))
+    dead.start()
+    dead.join()
+    workers = [Process(target=work, args=(q.path, log)) for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    for _ in range(20):
+        # the dead worker's job, once its lease expires
+        work(q.path, log)
+        if q.counts()['done'] == 20:
+            break
+        sleep(0.1)
+    lines = log.read_text().splitlines()
+    # each job run once, by several workers
+    assert sorted(line.split()[0] for line in lines) == sorted(f"job{i}" for i in range(20))
+    assert len({line.split()[1] for line in lines}) > 1
+    assert q.counts()['done'] == 20
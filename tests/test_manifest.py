@@ -0,0 +1,53 @@
+# pylint: disable=line-too-long, import-error
+import os
+
+from tmv.manifest import Manifest, by_day, manifest_path
+
+
+def test_manifest(tmp_path):
+    day = tmp_path / "daily-photos" / "2000-01-01"
+    day.mkdir(parents=True)
+    images = [day / f"2000-01-01T0{h}-00-00.jpg" for h in range(3)]
+    for i in images:
+        i.write_bytes(b"jpg")
+    out = tmp_path / "daily-videos" / "2000-01-01.mp4"
+    out.parent.mkdir()
+    assert not Manifest(out, images, {'fps': 25}).fresh()
+    # a failed encode's partial output isn't fresh
+    out.write_bytes(b"")
+    assert not Manifest(out, images, {'fps': 25}).fresh()
+    out.write_bytes(b"mp4")
+    Manifest(out, images, {'fps': 25}).write()
+    assert manifest_path(out) == tmp_path / "daily-videos" / ".2000-01-01.mp4.manifest.json"
+    assert Manifest(out, reversed(images), {'fps': 25}).fresh()
+    assert not Manifest(out, images, {'fps': 30}).fresh()
+    # a late upload, with an old mtime
+    late = day / "2000-01-01T03-00-00.jpg"
+    late.write_bytes(b"jpg")
+    os.utime(late, (0, 0))
+    assert not Manifest(out, images + [late], {'fps': 25}).fresh()
+    # replaced
+    images[0].write_bytes(b"jpeg")
+    assert not Manifest(out, images, {'fps': 25}).fresh()
+
+
+def test_adopt(tmp_path):
+    image = tmp_path / "2000-01-01T00-00-00.jpg"
+    image.write_bytes(b"jpg")
+    os.utime(image, (1000, 1000))
+    out = tmp_path / "2000-01-01.mp4"
+    out.write_bytes(b"mp4")
+    # made before manifests, and newer than its inputs
+    assert Manifest(out, [image]).fresh()
+    assert manifest_path(out).is_file()
+    # then its manifest counts, not mtimes
+    assert not Manifest(out, [image], {'fps': 30}).fresh()
+    manifest_path(out).unlink()
+    assert not Manifest(out, [image]).fresh(adopt=False)
+
+
+def test_by_day(tmp_path):
+    paths = [tmp_path / "2000-01-02" / "a.jpg", tmp_path / "2000-01-01" / "b.jpg", tmp_path / "other" / "c.jpg"]
+    days = by_day(paths, lambda p: p.parent.name)
+    assert sorted(str(d) for d in days) == ["2000-01-01", "2000-01-02", "None"]
+    assert days[None] == [tmp_path / "other" / "c.jpg"]
@@ -0,0 +1,36 @@
+# pylint: disable=line-too-long, import-error
+import json
+import threading
+
+from tmv.metrics import Meter, Metrics, metering, record
+
+
+def test_metering():
+    meter = Meter()
+    record(frames=1)  # not metering: ignored
+    with metering(meter):
+        record(frames=10, bytes_written=100)
+        other = threading.Thread(target=record, kwargs={'frames': 1000})
+        other.start()
+        other.join()
+    record(frames=1)
+    # only this thread's, while metering
+    assert meter.counts['frames'] == 10 and meter.counts['bytes_written'] == 100
+
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.configs(f"""
+        textfile_dir = "{tmp_path}"
+        history = 2
+        """)
+    meter = Meter()
+    meter.add(nodes=2, wall_seconds=1.23456, frames=100)
+    for _ in range(3):
+        metrics.write('cam "1"', tmp_path, {'DailyVideosTask': meter, 'RecapVideosTask': Meter()})
+    runs = json.loads((tmp_path / Metrics.FILENAME).read_text())
+    assert len(runs) == 2
+    assert runs[-1]['tasks']['DailyVideosTask']['wall_seconds'] == 1.235
+    text = (tmp_path / "tmv-videod-cam-1.prom").read_text()
+    assert 'tmv_videod_task_frames{location="cam \\"1\\"",task="DailyVideosTask"} 100\n' in text
+    assert "# TYPE tmv_videod_task_wall_seconds gauge" in text
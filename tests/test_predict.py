@@ -0,0 +1,51 @@
+# pylint: disable=line-too-long, import-error
+import sys
+import pytest
+
+from tmv.ffrunner import JobRunner
+from tmv.predict import EncodeHistory, default_history_path
+
+
+def job(frames, codec="libx264", preset="veryfast", filters=None):
+    return {'frames': frames, 'width': 100, 'height': 100, 'codec': codec, 'preset': preset, 'filters': filters}
+
+
+def test_predict(tmp_path):
+    history = EncodeHistory(tmp_path / "history.sqlite", host="h")
+    assert history.predict(job(100)).based_on == 0  # a guess
+    history.record(job(100), 10, 1000)
+    history.record(job(100, filters="tmix"), 40, 1000)
+    history.record(job(100, codec="libx265"), 90, 500)
+
+    e = history.predict(job(200))
+    assert (e.seconds, e.bytes, e.based_on) == (pytest.approx(20), 2000, 1)
+    assert history.predict(job(100, filters="tmix")).seconds == pytest.approx(40)
+    # no encodes with these filters: fall back to codec and preset
+    assert history.predict(job(100, filters="deflicker")).based_on == 2
+    assert history.predict(job(100, codec="libx265", preset="slow")).seconds == pytest.approx(90)
+    # other hosts' encodes are ignored
+    assert EncodeHistory(tmp_path / "history.sqlite", host="other").predict(job(100)).based_on == 0
+    history.close()
+
+
+def test_runner_records(tmp_path):
+    runner = JobRunner()
+    runner.configd({'history': str(tmp_path / "history.sqlite")})
+    out = tmp_path / "out.mp4"
+    runner.run([sys.executable, "-c", f"open({str(out)!r}, 'wb').write(bytes(1234))"], outputs=[out], job=job(10))
+    e = runner.predict(job(20))
+    assert (e.bytes, e.based_on) == (2468, 1)
+
+    runner.configd({'history': False})
+    assert runner.predict(job(20)).based_on == 0
+
+
+def test_default_history(tmp_path, cache_home):
+    # tests keep it out of ~/.cache (see conftest.py)
+    assert default_history_path() == cache_home / "tmv" / "encode-history.sqlite"
+    runner = JobRunner()
+    out = tmp_path / "out.mp4"
+    runner.run([sys.executable, "-c", f"open({str(out)!r}, 'wb').write(bytes(10))"], outputs=[out], job=job(10))
+    history = EncodeHistory()
+    assert history.path == default_history_path() and history.predict(job(10)).based_on == 1
+    history.close()
@@ -0,0 +1,63 @@
+# pylint: disable=line-too-long, import-error
+from time import monotonic
+
+import pytest
+from PIL import Image
+
+from tmv.exceptions import ConfigError
+from tmv.retention import RateLimiter, archive_day, check_tiers, downscale_image, due, restore, thinned
+
+
+def test_tiers():
+    tiers = [{'days': 30, 'action': "downscale", 'width': 640}, {'days': 90, 'action': "thin", 'every': 3}]
+    check_tiers(tiers)
+    assert due(tiers, 10, {}) == []
+    assert due(tiers, 30, {}) == tiers[:1]
+    assert due(tiers, 100, {'downscale': 640}) == tiers[1:]
+    assert due(tiers, 100, {'downscale': 640, 'every': 3}) == []
+    with pytest.raises(ConfigError):
+        check_tiers([{'days': 0, 'action': "thin", 'every': 3}])
+    with pytest.raises(ConfigError):
+        check_tiers([{'days': 10, 'action': "downscale"}])
+    with pytest.raises(ConfigError):
+        check_tiers([{'days': 10, 'action': "thin", 'every': 2}, {'days': 20, 'action': "thin", 'every': 3}])
+    check_tiers([{'days': 10, 'action': "thin", 'every': 2}, {'days': 20, 'action': "thin", 'every': 6}])
+    assert thinned(["d", "a", "c", "b", "e"], 2) == ["b", "d"]
+
+
+def test_downscale(tmp_path):
+    image = tmp_path / "2000-01-01T00-00-00.jpg"
+    Image.new("RGB", (200, 100), "red").save(image)
+    mtime = image.stat().st_mtime_ns
+    assert downscale_image(image, 100)
+    with Image.open(image) as im:
+        assert im.size == (100, 50)
+    assert image.stat().st_mtime_ns == mtime
+    assert not downscale_image(image, 100)
+    (tmp_path / "broken.jpg").write_bytes(b"not a jpg")
+    assert not downscale_image(tmp_path / "broken.jpg", 100)
+
+
+@pytest.mark.parametrize("fmt", ["tar", "zip"])
+def test_archive(tmp_path, fmt):
+    day = tmp_path / "2000-01-01"
+    day.mkdir()
+    for i in range(3):
+        (day / f"2000-01-01T00-0{i}-00.jpg").write_bytes(b"jpg" * i)
+    (day / ".retention.json").write_text("{}")
+    bundle = archive_day(day, fmt)
+    assert bundle == tmp_path / f"2000-01-01.{fmt}" and not day.exists()
+    assert restore(bundle) == day
+    assert sorted(p.name for p in day.iterdir()) == [".retention.json", "2000-01-01T00-00-00.jpg", "2000-01-01T00-01-00.jpg", "2000-01-01T00-02-00.jpg"]
+    assert (day / "2000-01-01T00-02-00.jpg").read_bytes() == b"jpgjpg"
+    assert not bundle.exists()
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1000)
+    start = monotonic()
+    for _ in range(3):
+        limiter.consume(100)
+    # the first is free
+    assert monotonic() - start >= 0.2
+    RateLimiter().consume(10 ** 9)
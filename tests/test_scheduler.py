@@ -0,0 +1,98 @@
+# pylint: disable=line-too-long, import-error
+import os
+import threading
+from time import sleep
+
+from tmv.dirindex import DirIndex
+from tmv.scheduler import CpuBudget, Node, affected, dependencies, signature
+
+
+class Prioritised:
+    def __init__(self, priority, cpus=1):
+        self.priority = priority
+        self.cpus = cpus
+
+
+def test_dependencies(tmp_path):
+    daily = Node("daily", Prioritised(10), None, [tmp_path / "daily-photos"], [tmp_path / "daily-videos"])
+    day = Node("daily 2000-01-01", Prioritised(10), None, [tmp_path / "daily-photos" / "2000-01-01"], [tmp_path / "daily-videos" / "2000-01-01.mp4"])
+    recap = Node("recap", Prioritised(20), None, [tmp_path / "daily-videos"], [tmp_path / "recap-videos"])
+    preview = Node("preview", Prioritised(70), None, [tmp_path / "recap-videos"], [tmp_path / "recap-videos" / "previews"])
+    other = Node("other", Prioritised(5), None, [], [tmp_path / "other"])
+    depends = dependencies([daily, day, recap, preview, other])
+    assert depends[recap] == {daily, day}
+    assert depends[preview] == {recap}
+    # same priority: no edges, so no cycles
+    assert depends[daily] == set() and depends[day] == set()
+    assert depends[other] == set()
+
+
+def test_signature(tmp_path):
+    node = Node("n", Prioritised(10), None, [tmp_path], [tmp_path / "out.mp4"])
+    assert Node("n", Prioritised(10), None).signature() is None
+    before = node.signature()
+    assert node.signature() == before
+    (tmp_path / "image.jpg").write_bytes(b"1")
+    assert node.signature() != before
+    before = node.signature()
+    (tmp_path / ".videod.lock").write_bytes(b"")
+    assert node.signature() == before
+    assert signature([tmp_path / "missing"]) == ((str(tmp_path / "missing"), None),)
+    # a file added to a subdirectory changes its mtime, not its parent's
+    index = DirIndex()
+    (tmp_path / "2000-01-01").mkdir()
+    before = node.signature(index)
+    (tmp_path / "2000-01-01" / "image.jpg").write_bytes(b"1")
+    os.utime(tmp_path / "2000-01-01", (1, 1))
+    assert node.signature(index) != before
+
+
+def test_signature_of_upload(tmp_path):
+    # still being uploaded as its dir is listed
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"1")
+    os.utime(tmp_path, (1, 1))
+    node = Node("n", Prioritised(10), None, [tmp_path], [tmp_path / "out.mp4"])
+    index = DirIndex()
+    before = node.signature(index)
+    with open(image, "ab") as f:
+        f.write(b"23")
+    # the dir's unchanged, but the upload's seen to finish
+    assert node.signature(index) != before
+    os.utime(image, (1, 1))
+    before = node.signature(index)
+    assert node.signature(index) == before
+
+
+def test_cpu_budget():
+    budget = CpuBudget(2)
+    running = []
+    most = []
+
+    def hold(n):
+        with budget.hold(n) as held:
+            running.append(held.n)
+            most.append(sum(running))
+            sleep(0.1)
+            running.remove(held.n)
+
+    threads = [threading.Thread(target=hold, args=(n,)) for n in (1, 1, 1, 2, 3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 3 is capped to the whole budget
+    assert max(most) == 2
+    assert str(budget) == "CpuBudget: 0/2 used"
+
+
+def test_affected(tmp_path):
+    photos = tmp_path / "daily-photos"
+    day1 = Node("daily 2000-01-01", Prioritised(10), None, [photos / "2000-01-01"], [tmp_path / "daily-videos" / "2000-01-01.mp4"])
+    day2 = Node("daily 2000-01-02", Prioritised(10), None, [photos / "2000-01-02"], [tmp_path / "daily-videos" / "2000-01-02.mp4"])
+    recap = Node("recap", Prioritised(20), None, [tmp_path / "daily-videos"], [tmp_path / "recap-videos"])
+    preview = Node("preview", Prioritised(70), None, [tmp_path / "recap-videos"], [tmp_path / "recap-videos" / "previews"])
+    recent = Node("most-recent", Prioritised(80), None, [photos])
+    depends = dependencies([day1, day2, recap, preview, recent])
+    assert affected(depends, [photos / "2000-01-02"]) == {day2, recap, preview, recent}
+    assert affected(depends, [tmp_path / "other"]) == set()
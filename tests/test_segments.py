@@ -0,0 +1,93 @@
+# pylint: disable=line-too-long, import-error, redefined-outer-name
+from datetime import datetime as dt, timedelta
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tmv.exceptions import VideoMakerError
+from tmv.ffrunner import run_ffmpeg
+from tmv.deflicker import Deflicker
+from tmv.segments import SegmentManifest, deflicker_gains, segments_dir, write_video_incremental
+from tmv.video import TLFile, Video
+
+
+def names(n):
+    return [f"2000-01-01T00-{i:02d}-00.jpg" for i in range(n)]
+
+
+def add_segment(manifest, names_):
+    manifest.add(names_).write_bytes(b"segment")
+
+
+def test_plan(tmp_path):
+    params = {'fps': 25}
+    manifest = SegmentManifest(tmp_path)
+    assert manifest.plan(names(10), params) == 0
+    add_segment(manifest, names(10))
+    assert manifest.plan(names(20), params) == 10
+    add_segment(manifest, names(20)[10:])
+    manifest.save()
+
+    manifest = SegmentManifest.load(tmp_path)
+    assert manifest.n_frames == 20
+    # nothing new
+    assert manifest.plan(names(20), params) == 20
+    # a single new frame is encoded with the last segment
+    assert manifest.plan(names(21), params) == 10
+    assert len(manifest.segments) == 1 and not (tmp_path / "00001.mp4").exists()
+
+
+def test_plan_changes(tmp_path):
+    manifest = SegmentManifest(tmp_path)
+    manifest.plan(names(10), {'fps': 25})
+    add_segment(manifest, names(5))
+    add_segment(manifest, names(10)[5:])
+    # a late frame, before the end of the second segment
+    late = sorted(names(10) + ["2000-01-01T00-07-30.jpg"])
+    assert manifest.plan(late, {'fps': 25}) == 5
+    add_segment(manifest, late[5:])
+    # new parameters: re-encode all
+    assert manifest.plan(late, {'fps': 30}) == 0
+    assert not manifest.segments and not list(tmp_path.glob("*.mp4"))
+
+
+def test_segments_dir():
+    assert segments_dir("daily-videos/2000-01-01.mp4").as_posix() == "daily-videos/.segments/2000-01-01"
+
+
+def test_incremental_timing(tmp_path):
+    # an image a minute, then one every five: each segment alone would have its own frame rate
+    times = [dt(2000, 1, 1) + timedelta(minutes=i) for i in range(10)] + [dt(2000, 1, 1, 0, 10) + timedelta(minutes=5 * i) for i in range(5)]
+    files = []
+    for i, t in enumerate(times):
+        path = tmp_path / f"{t:%Y-%m-%dT%H-%M-%S}.jpg"
+        Image.new("RGB", (64, 48), (i * 15, 0, 0)).save(path)
+        files.append(TLFile(str(path), t))
+    video = Video(files)
+    filename = tmp_path / "2000-01-01.mp4"
+    with pytest.raises(VideoMakerError):
+        write_video_incremental(video[:10], str(filename), speedup=600)
+    write_video_incremental(video[:10], str(filename), speedup=600, deflicker="none")
+    write_video_incremental(video, str(filename), speedup=600, deflicker="none")
+    assert len(list(segments_dir(filename).glob("*.mp4"))) == 2
+    out, _ = run_ffmpeg(["ffprobe", "-v", "error", "-select_streams", "v", "-show_entries", "packet=pts_time", "-of", "csv=p=0", str(filename)])
+    pts = sorted(float(line) for line in out.split() if line.strip())
+    intervals = {round(b - a, 3) for a, b in zip(pts, pts[1:])}
+    assert len(intervals) == 1
+
+
+def test_incremental_deflicker(tmp_path):
+    files = []
+    for i in range(60):
+        t = dt(2000, 1, 1) + timedelta(minutes=i)
+        path = tmp_path / f"{t:%Y-%m-%dT%H-%M-%S}.jpg"
+        Image.new("RGB", (16, 16), (100 + 50 * (i % 2),) * 3).save(path)
+        files.append(TLFile(str(path), t))
+    video = Video(files)
+    # a segment's gains are as if measured over the whole video, so don't step at its start
+    whole = Deflicker.from_frames(video.images.filenames, video.images.taken, video.deflicker_window).gains
+    assert np.allclose(deflicker_gains(video, 40), whole[40:])
+    assert not np.allclose(Deflicker.from_frames(video[40:].images.filenames, video[40:].images.taken, video.deflicker_window).gains, whole[40:])
+    with pytest.raises(VideoMakerError):
+        write_video_incremental(video, str(tmp_path / "2000-01-01.mp4"), speedup=600, deflicker="numpy", motion_blur="tmix")
@@ -0,0 +1,36 @@
+# pylint: disable=line-too-long, import-error
+from datetime import datetime as dt, timedelta
+from time import perf_counter
+import numpy as np
+import pytest
+
+from tmv.util import str2dt, str2dt_array
+
+
+def test_str2dt():
+    assert str2dt("2000-01-31T23-59-59.jpg") == dt(2000, 1, 31, 23, 59, 59)
+    assert str2dt("/path/to/2000-01-31/2000-01-31T23-59-59.jpg") == dt(2000, 1, 31, 23, 59, 59)
+    assert str2dt("IMG_20190330_174048.JPG") == dt(2019, 3, 30, 17, 40, 48)
+    assert str2dt("2000-01-02") == dt(2000, 1, 2)
+    assert str2dt("2000-02-30T00-00-00.jpg", throw=False) is None
+    assert str2dt("no-date.jpg", throw=False) is None
+    with pytest.raises(ValueError):
+        str2dt("no-date.jpg")
+
+
+def test_str2dt_array():
+    names = ["2000-01-31T23-59-59.jpg", "/a/2000-02-29T12-00-00.jpg", "2000-02-30T00-00-00.jpg",
+             "IMG_20190330_174048.JPG", "2000-01-02", "no-date.jpg", "2000-13-01T00-00-00.jpg"]
+    parsed = str2dt_array(names)
+    assert parsed.dtype == np.dtype("datetime64[s]")
+    assert list(parsed.astype(object)) == [str2dt(n, throw=False) for n in names]
+    assert len(str2dt_array([])) == 0
+
+
+def test_str2dt_array_speed():
+    start = dt(2000, 1, 1)
+    names = [f"daily-photos/{start + timedelta(minutes=i):%Y-%m-%d/%Y-%m-%dT%H-%M-%S}.jpg" for i in range(1000000)]
+    s = perf_counter()
+    parsed = str2dt_array(names)
+    assert perf_counter() - s < 2  # generous for slow test hosts: typically ~0.5s
+    assert parsed[-1] == np.datetime64(start + timedelta(minutes=999999))
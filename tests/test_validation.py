@@ -0,0 +1,83 @@
+# pylint: disable=line-too-long, import-error, redefined-outer-name
+from pathlib import Path
+import pytest
+from PIL import Image
+
+import tmv.validation
+from tmv.validation import ValidationCache, default_cache_path, image_valid, validate_images
+from tmv.video import VideoMakerConcat
+
+
+@pytest.fixture()
+def images(tmp_path):
+    """ Three good jpegs, one truncated, one empty and one not-an-image """
+    for i in range(3):
+        Image.new("RGB", (64, 48), (i * 50, 0, 0)).save(tmp_path / f"2000-01-01T00-0{i}-00.jpg")
+    good = (tmp_path / "2000-01-01T00-00-00.jpg").read_bytes()
+    (tmp_path / "2000-01-01T00-03-00.jpg").write_bytes(good[:len(good) // 2])
+    (tmp_path / "2000-01-01T00-04-00.jpg").touch()
+    (tmp_path / "2000-01-01T00-05-00.jpg").write_text("not an image")
+    return sorted(tmp_path.glob("*.jpg"))
+
+
+def test_image_valid(images, tmp_path):
+    assert [image_valid(f) for f in images] == [True, True, True, False, False, False]
+    assert not image_valid(tmp_path / "missing.jpg")
+    Image.new("RGB", (8, 8)).save(tmp_path / "ok.png")
+    assert image_valid(tmp_path / "ok.png")
+    # other formats, by their header
+    for fmt in ("gif", "bmp", "tiff", "webp"):
+        Image.new("RGB", (8, 8)).save(tmp_path / f"ok.{fmt}")
+        assert image_valid(tmp_path / f"ok.{fmt}")
+
+
+def test_jpeg_trailing_data(tmp_path):
+    image = tmp_path / "2000-01-01T00-00-00.jpg"
+    exif = Image.Exif()
+    exif[0x010f] = "tmv"
+    Image.new("RGB", (64, 48), "red").save(image, exif=exif)
+    good = image.read_bytes()
+    # e.g. a motion photo's video, longer than the tail that's read first
+    image.write_bytes(good + bytes(range(256)) * 1000)
+    assert image_valid(image)
+    # truncated, so its only EOI would be in a thumbnail before the image data
+    thumbnail = b"\xff\xd8\xff\xd9"
+    app = b"\xff\xe1" + (2 + len(thumbnail)).to_bytes(2, "big") + thumbnail
+    truncated = good[:2] + app + good[2:len(good) // 2]
+    image.write_bytes(truncated)
+    assert not image_valid(image)
+    image.write_bytes(good[:2] + app + good[2:])
+    assert image_valid(image)
+
+
+def test_default_cache_path(cache_home):
+    # tests keep it out of ~/.cache (see conftest.py)
+    assert default_cache_path() == cache_home / "tmv" / "image-validity.sqlite"
+
+
+def test_validate_images_cached(images, tmp_path, monkeypatch):
+    cache = ValidationCache(tmp_path / "cache.sqlite")
+    assert validate_images(images, cache=cache) == [True, True, True, False, False, False]
+
+    checked = []
+
+    def counting_image_valid(f):
+        checked.append(f)
+        return image_valid(f)
+
+    monkeypatch.setattr(tmv.validation, "image_valid", counting_image_valid)
+    assert validate_images(images, cache=cache) == [True, True, True, False, False, False]
+    assert checked == []
+    # a changed file is re-checked
+    Path(images[0]).write_bytes(Path(images[1]).read_bytes()[:10])
+    assert validate_images(images, cache=cache)[0] is False
+    assert checked == [str(images[0])]
+    cache.close()
+
+
+def test_read_image_times_skips_invalid(images, tmp_path):
+    mm = VideoMakerConcat()
+    mm.validation_cache = tmp_path / "cache.sqlite"
+    mm.file_list = images
+    mm.load_videos()
+    assert [tlf.filename for tlf in mm.images] == [str(f) for f in images[:3]]
@@ -6,10 +6,14 @@ import shutil
 import logging
 from datetime import timedelta, date, time, datetime as dt
 from pathlib import Path
+from subprocess import CalledProcessError
 from tempfile import mkdtemp
 import pytest
+import numpy as np
+from PIL import Image
 
-from tmv.video import VideoMakerDay, VideoMakerConcat
+from tmv.video import VideoMakerDay, VideoMakerConcat, FrameSet, Video, TLFile, MOTION_BLURS, Rendition, motion_blur_benchmark, encoder_benchmark
+from tmv.video import hls_generation, output_format_parameters, output_path, replacing_hls_segments
 from tmv.video import video_compile_console
 from tmv.util import files_from_glob, LOG_FORMAT
 from tmv.videotools import VideoInfo, fps, frames
@@ -420,3 +424,125 @@ def no_test_console_autoname(setup_module, capsys):
     assert exc.value.code == 0
     assert frames(fn) == 896
     assert fps(fn) == 25
+
+
+def test_frameset():
+    filenames = [f"d/2000-01-0{d}T{h:02d}-00-00.jpg" for d in (1, 2) for h in range(24)]
+    taken = [dt(2000, 1, d, h) for d in (1, 2) for h in range(24)]
+    frames = FrameSet(filenames, taken)
+    assert len(frames) == 48
+    assert frames.filenames == filenames
+    assert frames[-1].filename == filenames[-1]
+    assert frames[3].taken == dt(2000, 1, 1, 3)
+    assert len(frames[frames.taken >= np.datetime64(dt(2000, 1, 2))]) == 24
+    assert [len(f) for f in VideoMakerDay.group_by_day(frames).values()] == [24, 24]
+    # same as from a list of TLFiles
+    v = Video(frames)
+    v_tlfs = Video([TLFile(fn, t) for fn, t in zip(filenames, taken)])
+    assert v.duration_real() == v_tlfs.duration_real() == timedelta(hours=48)
+    assert v.fps_real_max() == v_tlfs.fps_real_max() == pytest.approx(1 / 3600)
+    assert v.images[-1].is_last
+    assert v[:24].duration_real() == timedelta(hours=24)
+    # close a gap
+    v = Video(frames[np.r_[0:10, 30:40]])
+    v.disjoint_threshold = timedelta(hours=2)
+    v.calc_gaps()
+    assert v.duration_real() == timedelta(hours=19, seconds=1)
+
+
+def test_frameset_sample():
+    # two days of 08:00-17:59, a minute apart
+    taken = [dt(2000, 1, d, h, m) for d in (1, 2) for h in range(8, 18) for m in range(60)]
+    frames = FrameSet([f"{i}.jpg" for i in range(len(taken))], taken)
+    assert len(frames.sample(2000)) == len(frames)
+    # the night takes no time: half from each day
+    sampled = frames.sample(100, disjoint_threshold=timedelta(hours=1))
+    assert len(sampled) == 100
+    assert sampled.taken[0] == frames.taken[0] and sampled.taken[-1] == frames.taken[-1]
+    assert sum(sampled.taken < np.datetime64(dt(2000, 1, 2))) == 50
+    # the night takes real time: frames either side of it are nearest to those times
+    assert len(frames.sample(100)) < 100
+
+
+def test_video_stats():
+    filenames = [f"2000-01-01T{h:02d}-00-00.jpg" for h in range(10)]
+    v = Video(FrameSet(filenames, [dt(2000, 1, 1, h) for h in range(10)]))
+    assert v.duration_real() == timedelta(hours=10)
+    assert v.fps_video_avg(3600) == pytest.approx(1)
+    assert v.spf_real_avg() == pytest.approx(3600)
+    # computed once, and reset when the frames change
+    assert v.stats is v.stats
+    v.images = v.images[:5]
+    assert v.duration_real() == timedelta(hours=5)
+    assert v.n_frames == 5
+
+
+def moving_square(dest_dir, n=12):
+    """ n tiny images of a square moving jerkily: alternately still and jumping """
+    for i in range(n):
+        im = Image.new("RGB", (64, 48))
+        x = 8 * ((i + 1) // 2)
+        im.paste((255, 255, 255), (x, 16, x + 8, 32))
+        im.save(Path(dest_dir) / f"2000-01-01T00-{i:02d}-00.jpg")
+    return sorted(str(p) for p in Path(dest_dir).glob("*.jpg"))
+
+
+def test_motion_blur_benchmark(tmp_path):
+    images = moving_square(tmp_path)
+    results = {r['mode']: r for r in motion_blur_benchmark(images, tmp_path, fps=25)}
+    assert set(results) == set(MOTION_BLURS)
+    # blending is smoother than nothing
+    assert results['tmix']['jerkiness'] < results['none']['jerkiness']
+    assert results['blend']['jerkiness'] < results['none']['jerkiness']
+
+
+def test_encoder_benchmark(tmp_path):
+    images = moving_square(tmp_path)
+    results = encoder_benchmark(images, tmp_path, ["x264"], fps=25)
+    assert [r['encoder'] for r in results] == ["x264"]
+    assert results[0]['fps'] > 0 and results[0]['bytes'] > 0
+    assert frames(str(tmp_path / "encoder-x264.mp4")) == len(images)
+
+
+def test_rendition():
+    preview = Rendition("preview")
+    assert preview.path("daily-videos/2000-01-01.mp4") == Path("daily-videos/previews/2000-01-01.mp4")
+    assert preview.filter_chain(100) == "scale=128:-1,fps=fps=5,setpts=0.25*PTS"
+    assert Rendition("poster").path("a/b.mp4") == Path("a/previews/b.jpg")
+    assert Rendition("sprite", tiles=(2, 5)).filter_chain(100).endswith("tile=2x5")
+    with pytest.raises(VideoMakerError):
+        Rendition("gif")
+
+
+def test_output_formats():
+    assert output_path("a/b.mp4") == "a/b.mp4"
+    assert output_path("a/b.mp4", "fmp4") == "a/b.mp4"
+    assert output_path("a/b.mp4", "hls") == "a/b.m3u8"
+    assert output_format_parameters("a/b.mp4") == []
+    assert "+frag_keyframe+empty_moov+default_base_moof" in output_format_parameters("a/b.mp4", "fmp4")
+    hls = output_format_parameters("a/b.mp4", "hls")
+    assert hls[hls.index("-hls_segment_filename") + 1] == str(Path("a/b-%05d.m4s"))
+    assert "-force_key_frames" in hls and "append_list" not in hls
+    hls = output_format_parameters("a/b.mp4", "hls", append=True, copy=True)
+    assert "-force_key_frames" not in hls and "append_list" in hls
+    hls = output_format_parameters("a/b.mp4", "hls", generation="0a1b")
+    assert hls[hls.index("-hls_segment_filename") + 1] == str(Path("a/b-0a1b-%05d.m4s"))
+    with pytest.raises(VideoMakerError):
+        output_format_parameters("a/b.mp4", "gif")
+
+
+def test_replacing_hls_segments(tmp_path):
+    old = [tmp_path / "b-init.m4s", tmp_path / "b-00000.m4s"]
+    for p in old:
+        p.write_bytes(b"old")
+    generation = hls_generation()
+    new = tmp_path / f"b-{generation}-00000.m4s"
+    with pytest.raises(CalledProcessError):
+        with replacing_hls_segments(tmp_path / "b.mp4", generation):
+            new.write_bytes(b"new")
+            raise CalledProcessError(1, "ffmpeg")
+    # the old playlist's are kept
+    assert all(p.exists() for p in old) and not new.exists()
+    with replacing_hls_segments(tmp_path / "b.mp4", generation):
+        new.write_bytes(b"new")
+    assert new.exists() and not any(p.exists() for p in old)
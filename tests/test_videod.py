@@ -1,6 +1,9 @@
 # pytest tricks stuff pylint
 # pylint: disable=import-error, protected-access, unused-argument, redefined-outer-name. unused-argument, global-statement
+import json
 import shutil
+import threading
+import fcntl
 from distutils.dir_util import copy_tree  # instead of sh(it)utils
 import os
 from tempfile import mkdtemp
@@ -12,9 +15,13 @@ from time import sleep
 from dateutil.parser import parse
 from freezegun import freeze_time
 import pytest
+from PIL import Image
 
+import tmv.metrics
+import tmv.videod
 from tmv.videotools import VideoInfo, frames, fps
 from tmv.videod import LOGGER, TaskRunner, videod_console, TaskRunnerManager
+from tmv.exceptions import ConfigError
 from tmv.util import LOG_FORMAT_DETAILED, LOG_FORMAT, file_by_day
 from tmv.images import cal_cross_images
 
@@ -112,6 +119,33 @@ def test_daily(setup_test):
     assert d1.stat().st_mtime > d1_mtime
 
 
+def test_incremental(setup_test):
+    vd = TaskRunner()
+    c = """
+    [daily-videos]
+    incremental = true
+    """
+    vd.configs(c)
+    vd.raise_task_exceptions = True
+    vd.tasks = {k: t for k, t in vd.tasks.items() if k == 'DailyVideosTask'}
+    vd.run_tasks()
+    d3 = Path("daily-videos/2000-01-03.mp4")
+    frames_1 = frames(d3)
+    # only the last day is kept in segments
+    assert not Path("daily-videos/.segments/2000-01-01").exists()
+    assert len(list(Path("daily-videos/.segments/2000-01-03").glob("*.mp4"))) == 1
+    # add two frames: encoded into a second segment and copied into the day's video
+    im = sorted(Path("daily-photos/2000-01-03").glob("*.jpg"))[-1]
+    shutil.copy(str(im), "daily-photos/2000-01-03/2000-01-03T23-58-00.jpg")
+    shutil.copy(str(im), "daily-photos/2000-01-03/2000-01-03T23-59-00.jpg")
+    vd.run_tasks()
+    assert len(list(Path("daily-videos/.segments/2000-01-03").glob("*.mp4"))) == 2
+    assert frames(d3) == frames_1 + 2
+    # blending would restart at each segment
+    with pytest.raises(ConfigError):
+        TaskRunner().configs("[daily-videos]\nincremental = true\nmotion_blur = \"tmix\"")
+
+
 def test_recap_videos(setup_test):
     # daily-videos are : 2019-10-22, 23, 24
     with freeze_time(parse("2019-10-24 23:00:00")):
@@ -143,9 +177,15 @@ def test_recap_videos(setup_test):
         # shouldn't overwrite...
         assert v1.stat().st_mtime == v1_mtime
         Path("daily-videos/dummy").touch()
-        # ... unless daily-videos folder mtime is updated
+        # ... even if other files are added to daily-videos...
+        vd.run_tasks()
+        assert v1.stat().st_mtime == v1_mtime
+        # ... unless a daily-video it's made of is changed (the latest day's is still being added to)
+        os.utime("daily-videos/2019-10-23.mp4", (0, 0))
         vd.run_tasks()
         assert v1.stat().st_mtime > v1_mtime
+        # recorded beside the recap
+        assert Path("recap-videos/.last-1-days.mp4.manifest.json").is_file()
 
 
 def test_preview_videos(setup_test):
@@ -174,6 +214,32 @@ def test_preview_videos(setup_test):
     assert run1_files == run2_files, f"{run1_files} != {run2_files}"
 
 
+def test_renditions(setup_test, monkeypatch):
+    c = """
+        [daily-videos]
+        renditions = ["preview", "poster"]
+        [preview-videos]
+        filters.scale="128:-2"
+        """
+    vd = TaskRunner()
+    vd.configs(c)
+    vd.raise_task_exceptions = True
+    assert vd.tasks['DailyVideosTask'].preview_filters['scale'] == "128:-2"
+
+    # previews are made with the daily videos, so the PreviewVideosTask has nothing to do
+    def no_ffmpeg_run(*args, **kwargs):
+        raise AssertionError("Preview was not fresh")
+    monkeypatch.setattr(tmv.videod, "ffmpeg_run", no_ffmpeg_run)
+    Path("daily-videos").mkdir(exist_ok=True)
+    for v in Path("daily-videos").glob("**/*.mp4"):
+        v.unlink()
+    vd.tasks = {k: t for k, t in vd.tasks.items() if k in ('DailyVideosTask', 'PreviewVideosTask')}
+    vd.run_tasks()
+    assert Path("daily-videos/previews/2000-01-01.mp4").is_file()
+    assert Path("daily-videos/previews/2000-01-01.jpg").is_file()
+    assert fps("daily-videos/previews/2000-01-01.mp4") == 5
+
+
 def test_diagonal_videos(setup_test_cal_cross):
     logging.basicConfig(format=LOG_FORMAT)
     logging.getLogger("tmv.video").setLevel(logging.DEBUG)
@@ -234,6 +300,46 @@ def test_recap_speeds(setup_test):
         vd.run_tasks()
 
 
+def test_recap_sample(setup_test):
+    vd = TaskRunner()
+    c = """
+    [recap-videos]
+    method = "sample"
+    create = [
+        { label = "All", days = 0, speed = 2 },
+        { label = "All in a second", days = 0, seconds = 1, fps = 10 },
+    ]
+    """
+    vd.configs(c)
+    vd.raise_task_exceptions = True
+    vd.tasks = {k: t for k, t in vd.tasks.items() if k == 'RecapVideosTask'}
+    vd.run_tasks()
+    n_images = len(list(Path("daily-photos").glob("**/*.jpg")))
+    assert frames("recap-videos/all.mp4") == pytest.approx(n_images / 2, abs=2)
+    assert frames("recap-videos/all-in-a-second.mp4") == 10
+
+
+def test_recap_copy(setup_test):
+    vd = TaskRunner()
+    c = """
+    [daily-videos]
+    [recap-videos]
+    method = "copy"
+    create = [
+        { label = "All", days = 0, speed = 4 },
+    ]
+    """
+    vd.configs(c)
+    vd.raise_task_exceptions = True
+    assert vd.tasks['DailyVideosTask'].speeds == [4]
+    vd.tasks = {k: t for k, t in vd.tasks.items() if k in ('DailyVideosTask', 'RecapVideosTask')}
+    shutil.rmtree("daily-videos", ignore_errors=True)
+    vd.run_tasks()
+    assert Path("daily-videos/.speeds/x4/2000-01-01.mp4").is_file()
+    n_frames = sum(frames(v) for v in Path("daily-videos").glob("*.mp4"))
+    assert frames("recap-videos/all.mp4") == pytest.approx(n_frames / 4, abs=6)
+
+
 def test_recap_after_finish(daily_photos):
     # daily-videos are : 2019-10-22, 23, 24
     # We set the time to 2020
@@ -396,3 +502,268 @@ def test_errors(setup_test, caplog):
     v3 = Path("recap-videos/complete.mp4")
 
     assert v1.is_file() and v2.is_file() and v3.is_file()
+
+
+def test_budget(caplog):
+    caplog.set_level("INFO")
+    ran = []
+
+    class Estimated(tmv.videod.Task):
+        def __init__(self, name, seconds):
+            super().__init__(".", ".")
+            self.name = name
+            self.seconds = seconds
+
+        def run(self):
+            ran.append(self.name)
+
+        def estimate(self):
+            return self.seconds
+
+    vd = TaskRunner()
+    vd.tasks = {'slow': Estimated('slow', 20), 'quick': Estimated('quick', 10), 'unknown': Estimated('unknown', None)}
+    assert vd.run_tasks() == (3, 0)
+    vd.budget = 15
+    ran.clear()
+    # quickest first, then those that fit
+    assert vd.run_tasks() == (2, 0)
+    assert ran == ['unknown', 'quick']
+    assert 'Deferring slow' in caplog.text
+
+
+def test_concurrent_locations(tmp_path):
+    for cam in ("cam1", "cam2", "cam3"):
+        (tmp_path / cam).mkdir()
+    manager = TaskRunnerManager()
+    manager.configs(f"""
+        tmv_root = "{tmp_path}"
+        locations = ['cam1', 'cam2', 'cam3', 'missing']
+        concurrency = 3
+        """)
+    running = []
+    most = []
+
+    class Slow(tmv.videod.Task):
+        def run(self):
+            running.append(self.src_path)
+            most.append(len(running))
+            sleep(0.5)
+            running.remove(self.src_path)
+
+    for vd in manager.vds.values():
+        vd.tasks = {'slow': Slow(".", ".")}
+        vd.rebase(vd.path)
+    # another videod is running cam3's tasks
+    with open(tmp_path / "cam3" / TaskRunnerManager.LOCK_FILENAME, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        results = manager.run_locations()
+    assert results == {'cam1': (1, 0), 'cam2': (1, 0), 'cam3': None}
+    assert max(most) == 2
+    assert manager.vds['cam1'].tasks['slow'].src_path == tmp_path / "cam1"
+
+
+
+def test_task_graph(tmp_path, caplog):
+    caplog.set_level("INFO")
+    ran = []
+
+    class Step(tmv.videod.Task):
+        def __init__(self, name, src, dest, priority, fail=False):
+            super().__init__(tmp_path / src, tmp_path / dest)
+            self.name = name
+            self.priority = priority
+            self.fail = fail
+
+        def inputs(self):
+            return [self.src_path]
+
+        def run(self):
+            ran.append(self.name)
+            if self.fail:
+                raise RuntimeError(f"{self.name} failed")
+
+    (tmp_path / "photos").mkdir()
+    vd = TaskRunner()
+    vd.cpus = 2
+    vd.tasks = {'videos': Step('videos', "photos", "videos", 10, fail=True),
+                'recap': Step('recap', "videos", "recap", 20),
+                'other': Step('other', "photos", "other", 20)}
+    assert vd.run_tasks() == (1, 1)
+    assert sorted(ran) == ['other', 'videos']
+    assert 'Skipping recap: videos failed' in caplog.text
+
+    vd.tasks['videos'].fail = False
+    ran.clear()
+    assert vd.run_tasks() == (3, 0)
+    # other's inputs haven't changed since it succeeded
+    assert ran == ['videos', 'recap']
+
+
+def test_watch(tmp_path):
+    for cam in ("cam1", "cam2"):
+        (tmp_path / cam / "daily-photos" / "2000-01-01").mkdir(parents=True)
+    manager = TaskRunnerManager()
+    manager.configs(f"""
+        tmv_root = "{tmp_path}"
+        locations = ['cam1', 'cam2']
+        watch = true
+        debounce = 0.1
+        """)
+    ran = []
+
+    class Step(tmv.videod.Task):
+        def inputs(self):
+            return [self.src_path]
+
+        def run(self):
+            ran.append(self.src_path.relative_to(tmp_path))
+
+    for vd in manager.vds.values():
+        vd.tasks = {'photos': Step("daily-photos", "daily-videos"), 'other': Step("other", "other-videos")}
+        vd.rebase(vd.path)
+    dirty = tmv.videod.DirtyDays({l: vd.path for l, vd in manager.vds.items()}, manager.debounce)
+    image = tmp_path / "cam2" / "daily-photos" / "2000-01-01" / "2000-01-01T00-00-00.jpg"
+
+    def upload():
+        image.write_bytes(b"jpg")
+        dirty.add(image)
+
+    threading.Timer(0.5, upload).start()
+    # everything, then only what the new image affects
+    results = manager.watch_locations(2, dirty)
+    assert sorted(map(str, ran)) == ["cam1/daily-photos", "cam1/other", "cam2/daily-photos", "cam2/daily-photos", "cam2/other"]
+    assert results == {'cam2': (1, 0)}
+
+
+def test_queue(tmp_path):
+    (tmp_path / "cam1" / "photos").mkdir(parents=True)
+    log = tmp_path / "log"
+
+    class Step(tmv.videod.Task):
+        def inputs(self):
+            return [self.src_path]
+
+        def run(self):
+            with open(log, "a") as f:
+                f.write(f"{self.dest_path.name} {os.getpid()}\n")
+            self.dest_path.mkdir(exist_ok=True)
+            (self.dest_path / "out").write_text(str(os.getpid()))
+
+    def manager(role):
+        m = TaskRunnerManager()
+        m.configs(f"""
+            tmv_root = "{tmp_path}"
+            locations = ['cam1']
+            role = "{role}"
+            [queue]
+            poll = 0.1
+            """)
+        for vd in m.vds.values():
+            vd.tasks = {'videos': Step("photos", "videos"), 'recap': Step("videos", "recap")}
+            vd.tasks['videos'].priority = 10
+            vd.tasks['recap'].priority = 20
+            vd.rebase(vd.path)
+        m.open_queue()
+        return m
+
+    def work():
+        manager("worker").work(idle=0.5)
+
+    planner = manager("planner")
+    assert planner.run(1) == {'cam1': (2, 0)}
+    workers = [Process(target=work) for _ in range(2)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    # in order, each once
+    assert [line.split()[0] for line in log.read_text().splitlines()] == ["videos", "recap"]
+    assert planner.queue.counts()['done'] == 2
+    # nothing's changed since
+    assert planner.run(1) == {'cam1': (0, 0)}
+    (tmp_path / "cam1" / "photos" / "image.jpg").write_bytes(b"jpg")
+    assert planner.run(1) == {'cam1': (2, 0)}
+
+
+def test_admission(tmp_path, caplog):
+    caplog.set_level("INFO")
+    running = []
+    most = []
+
+    class Step(tmv.videod.Task):
+        def run(self):
+            running.append(self)
+            most.append(len(running))
+            sleep(0.1)
+            running.remove(self)
+
+    vd = TaskRunner()
+    vd.cpus = 2
+    vd.tasks = {'a': Step(tmp_path / "a", tmp_path / "a-videos"), 'b': Step(tmp_path / "b", tmp_path / "b-videos")}
+    admission = tmv.ffrunner.RUNNER.admission
+    admission.max_load = -1  # always exceeded
+    try:
+        assert vd.run_tasks() == (2, 0)
+    finally:
+        admission.max_load = None
+    # one at a time
+    assert max(most) == 1
+    assert "Holding b until running nodes finish: load" in caplog.text
+
+
+def test_metrics(tmp_path):
+    class Step(tmv.videod.Task):
+        def run(self):
+            sleep(0.1)
+            if self.src_path.name == "fails":
+                raise RuntimeError("failed")
+
+    vd = TaskRunner()
+    vd.tasks = {'ok': Step("ok", "ok-videos"), 'fails': Step("fails", "fails-videos")}
+    vd.metrics.textfile_dir = str(tmp_path)
+    vd.rebase(tmp_path)
+    assert vd.run_tasks() == (1, 1)
+    runs = json.loads((tmp_path / tmv.metrics.Metrics.FILENAME).read_text())
+    assert runs[-1]['tasks']['ok']['nodes'] == 1 and runs[-1]['tasks']['ok']['wall_seconds'] >= 0.1
+    assert runs[-1]['tasks']['fails']['failed'] == 1
+    assert (tmp_path / "tmv-videod-root.prom").is_file()
+
+
+def test_cleanup(tmp_path):
+    with pytest.raises(ConfigError):
+        # the default recaps need every 3.4th image
+        TaskRunner().configs("""
+            [recap-videos]
+            [cleanup]
+            tiers = [{days = 2, action = "thin", every = 4}]
+            """)
+    photos = tmp_path / "daily-photos"
+    for day in range(1, 6):
+        (photos / f"2000-01-0{day}").mkdir(parents=True)
+        for i in range(4):
+            Image.new("RGB", (200, 100)).save(photos / f"2000-01-0{day}" / f"2000-01-0{day}T00-0{i}-00.jpg")
+    empty = photos / "2000-01-05" / "2000-01-05T01-00-00.jpg"
+    empty.write_bytes(b"")
+    os.utime(empty, (0, 0))
+    vd = TaskRunner()
+    vd.configs("""
+        [cleanup]
+        tiers = [{days = 2, action = "downscale", width = 100}, {days = 3, action = "thin", every = 2}, {days = 4, action = "archive"}]
+        """)
+    vd.rebase(tmp_path)
+    assert vd.run_tasks() == (1, 0)
+    # by age before the latest day, 2000-01-05
+    assert sorted(p.name for p in photos.iterdir()) == ["2000-01-01.tar", "2000-01-02", "2000-01-03", "2000-01-04", "2000-01-05"]
+    assert len(list((photos / "2000-01-02").glob("*.jpg"))) == 2
+    with Image.open(photos / "2000-01-03" / "2000-01-03T00-03-00.jpg") as im:
+        assert im.width == 100
+    with Image.open(photos / "2000-01-04" / "2000-01-04T00-03-00.jpg") as im:
+        assert im.width == 200
+    assert not empty.exists()
+    # nothing more to do, until the next day
+    assert vd.graph()[0] == []
+    # thinned by an earlier config's tier, whose every isn't a factor of this one's: applied once
+    vd.tasks['CleanupTask'].tiers = [{'days': 3, 'action': "thin", 'every': 3}]
+    assert vd.run_tasks() == (1, 0)
+    assert len(list((photos / "2000-01-02").glob("*.jpg"))) == 2
+    assert vd.graph()[0] == []
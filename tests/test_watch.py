@@ -0,0 +1,52 @@
+# pylint: disable=line-too-long, import-error
+import threading
+from pathlib import Path
+from time import monotonic, sleep
+
+from watchdog.events import FileCreatedEvent, FileMovedEvent, DirCreatedEvent, FileOpenedEvent
+from watchdog.observers import Observer
+
+from tmv.watch import DirtyDays
+
+
+def test_dirty_days(tmp_path):
+    cam1, cam2 = tmp_path / "cam1", tmp_path / "cam2"
+    dirty = DirtyDays({'cam1': cam1, 'cam2': cam2}, debounce=10, debounce_max=60)
+    day = cam1 / "daily-photos" / "2000-01-01"
+    dirty.on_any_event(FileCreatedEvent(str(day / "2000-01-01T00-00-00.jpg")))
+    dirty.on_any_event(FileMovedEvent(str(day / ".upload.tmp"), str(day / "2000-01-01T00-01-00.JPG")))
+    # not images, not in a day dir, or not changes
+    dirty.on_any_event(DirCreatedEvent(str(cam2 / "daily-photos" / "2000-01-02")))
+    dirty.on_any_event(FileCreatedEvent(str(cam2 / "daily-videos" / "previews" / "2000-01-01.jpg")))
+    dirty.on_any_event(FileCreatedEvent(str(cam2 / "daily-photos" / "2000-01-02" / "notes.txt")))
+    dirty.on_any_event(FileOpenedEvent(str(cam2 / "daily-photos" / "2000-01-02" / "2000-01-02T00-00-00.jpg")))
+    now = monotonic()
+    assert dirty.ready(now) == {}
+    assert dirty.ready(now + 10) == {'cam1': {day}}
+    assert dirty.ready(now + 20) == {}
+
+
+def test_debounce_max():
+    dirty = DirtyDays({'cam1': "/cam1"}, debounce=10, debounce_max=60)
+    for t in range(0, 70, 5):
+        # a burst that never settles
+        dirty.add(Path(f"/cam1/daily-photos/2000-01-01/{t}.jpg"), now=t)
+        if t < 60:
+            assert dirty.ready(t) == {}
+    assert list(dirty.ready(65)) == ['cam1']
+
+
+def test_observer(tmp_path):
+    day = tmp_path / "cam1" / "daily-photos" / "2000-01-01"
+    day.mkdir(parents=True)
+    dirty = DirtyDays({'cam1': tmp_path / "cam1"}, debounce=0.2)
+    observer = Observer()
+    observer.schedule(dirty, str(tmp_path), recursive=True)
+    observer.start()
+    try:
+        threading.Thread(target=lambda: (sleep(0.2), (day / "2000-01-01T00-00-00.jpg").write_bytes(b"jpg"))).start()
+        assert dirty.wait(5) == {'cam1': {day}}
+        assert dirty.wait(0.5) == {}
+    finally:
+        observer.stop()
+        observer.join()
@@ -0,0 +1,173 @@
+"""
+Admission control: check the host before starting an encode, so videod doesn't swamp other services on the
+same box (e.g. MinIO and nginx).
+
+An encode is deferred while the host exceeds a limit: the 1-minute load average per cpu (/proc/loadavg),
+available memory (MemAvailable in /proc/meminfo) or free space on the outputs' filesystem. If it's still
+exceeded after max_wait seconds, the encode runs downscaled (fewer threads and a faster preset), or for
+disk space, fails. The TaskRunner also starts no more nodes while a limit is exceeded.
+
+ [ffmpeg.admission]
+ max_load = 1.5
+ min_memory = 1024   # MB
+ min_disk = 2048     # MB
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import errno
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from time import monotonic
+
+from tmv.util import Tomlable
+
+LOGGER = logging.getLogger(__name__)
+
+# libx264 and libx265's presets, slowest last
+X264_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow", "placebo")
+# fastest libsvtav1 -preset and libvpx-vp9 -cpu-used
+FASTEST = {'libsvtav1': 13, 'libvpx-vp9': 8}
+
+
+def load_per_cpu():
+    """ 1-minute load average per cpu, or None if unknown """
+    try:
+        with open("/proc/loadavg") as f:
+            load = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return load / (os.cpu_count() or 1)
+
+
+def memory_available():
+    """ Bytes of memory available without swapping, or None if unknown """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def disk_free(path):
+    """ Bytes free on path's filesystem (or its nearest existing parent's) """
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return shutil.disk_usage(path).free
+
+
+def downscale(cl, threads=1, faster=2):
+    """ Return cl with at most threads encoder threads and a preset faster steps faster, and a description of the changes """
+    cl = list(cl)
+    changes = []
+    codec = next((cl[i + 1] for i, a in enumerate(cl[:-1]) if a in ("-vcodec", "-c:v")), None)
+    for option in ("-preset", "-cpu-used"):
+        if option in cl[:-1]:
+            i = cl.index(option) + 1
+            if cl[i] in X264_PRESETS:
+                cl[i] = X264_PRESETS[max(0, X264_PRESETS.index(cl[i]) - faster)]
+            elif cl[i].isdigit():
+                cl[i] = str(min(int(cl[i]) + faster, FASTEST.get(codec, int(cl[i]) + faster)))
+            changes.append(f"{option} {cl[i]}")
+    if "-threads" in cl[:-1]:
+        i = cl.index("-threads") + 1
+        cl[i] = str(min(int(cl[i]), threads))
+        changes.append(f"-threads {cl[i]}")
+    elif codec:
+        i = cl.index(codec) + 1
+        cl[i:i] = ["-threads", str(threads)]
+        changes.append(f"-threads {threads}")
+    return cl, ", ".join(changes) or "unchanged"
+
+
+class Admission(Tomlable):
+    """
+    Limits on the host, checked before each encode. Each is None (the default) for no limit.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.max_load = None  # 1-minute load average per cpu
+        self.min_memory = None  # MB available
+        self.min_disk = None  # MB free on the outputs' filesystem
+        self.max_wait = 300  # seconds to defer an encode before running it downscaled
+        self.poll = 10  # seconds between checks while deferred
+        self.threads = 1  # of downscaled encodes
+        self.faster = 2  # preset steps faster, for downscaled encodes
+        self._cond = threading.Condition()
+        self._cancels = 0
+
+    def __str__(self):
+        return f"Admission: max_load:{self.max_load} min_memory:{self.min_memory} min_disk:{self.min_disk} max_wait:{self.max_wait}"
+
+    def configd(self, config_dict):
+        self.setattr_from_dict("max_load", config_dict)
+        self.setattr_from_dict("min_memory", config_dict)
+        self.setattr_from_dict("min_disk", config_dict)
+        self.setattr_from_dict("max_wait", config_dict)
+        self.setattr_from_dict("poll", config_dict)
+        self.setattr_from_dict("threads", config_dict)
+        self.setattr_from_dict("faster", config_dict)
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in (self.max_load, self.min_memory, self.min_disk))
+
+    def exceeded(self, path=None):
+        """ Descriptions of the limits exceeded (empty if none). path: where outputs are written, to check min_disk """
+        reasons = []
+        if self.max_load is not None:
+            load = load_per_cpu()
+            if load is not None and load > self.max_load:
+                reasons.append(f"load {load:.2f}/cpu > {self.max_load}")
+        if self.min_memory is not None:
+            memory = memory_available()
+            if memory is not None and memory < self.min_memory * 2 ** 20:
+                reasons.append(f"memory {memory / 2 ** 20:.0f}MB < {self.min_memory}MB")
+        if self.min_disk is not None and path is not None:
+            disk = disk_free(path)
+            if disk < self.min_disk * 2 ** 20:
+                reasons.append(f"disk {disk / 2 ** 20:.0f}MB < {self.min_disk}MB")
+        return reasons
+
+    def admit(self, cl, path=None, name="ffmpeg"):
+        """
+        Wait (up to max_wait) for the host to be within the limits, and return (cl to run, True if it's downscaled):
+        cl as is, or downscaled if the host isn't within the limits by then.
+        Raise OSError (ENOSPC) if disk space is still short, or InterruptedError if cancel()'d while waiting.
+        """
+        if not self.enabled:
+            return cl, False
+        reasons = self.exceeded(path)
+        if not reasons:
+            return cl, False
+        LOGGER.info(f"Deferring {name}: {', '.join(reasons)}")
+        start = monotonic()
+        with self._cond:
+            cancels = self._cancels
+        while reasons and monotonic() - start < self.max_wait:
+            with self._cond:
+                if self._cond.wait_for(lambda: self._cancels != cancels, min(self.poll, self.max_wait - (monotonic() - start))):
+                    raise InterruptedError(f"Cancelled {name} while deferred")
+            reasons = self.exceeded(path)
+        waited = monotonic() - start
+        if not reasons:
+            LOGGER.info(f"Admitting {name} after waiting {waited:.0f}s")
+            return cl, False
+        if any(r.startswith("disk") for r in reasons):
+            raise OSError(errno.ENOSPC, f"Not running {name} after waiting {waited:.0f}s: {', '.join(reasons)}")
+        cl, changes = downscale(cl, self.threads, self.faster)
+        LOGGER.warning(f"Running {name} downscaled ({changes}) after waiting {waited:.0f}s: {', '.join(reasons)}")
+        return cl, True
+
+    def cancel(self):
+        """ Stop waiting: deferred admit()s raise InterruptedError """
+        with self._cond:
+            self._cancels += 1
+            self._cond.notify_all()
@@ -0,0 +1,260 @@
+"""
+Persistent catalog (SQLite) of the images under a tmv_root.
+
+Instead of globbing the whole tree on each run, the catalog keeps a table of frames with their
+location (camera), timestamp, path, size, mtime and optionally validity and pixel average.
+refresh() only rescans directories whose mtime has changed since the last refresh.
+
+ tmv_root/
+    .tmv-catalog.sqlite
+    cam1/daily-photos/2000-01-01/2000-01-01T00-00-00.jpg      location="cam1"
+    cam2/...                                                  location="cam2"
+
+Paths are stored relative to tmv_root, keyed by (location, path): nested locations (e.g. "." and "cam1") each have
+their own rows, refreshed independently. Timestamps are stored as integer seconds since 1970-01-01
+of the (naive, local) time in the filename.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import os
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime as dt, timedelta, time
+
+from tmv.util import str2dt
+
+LOGGER = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg")
+EPOCH = dt(1970, 1, 1)
+
+# bump when SCHEMA changes: the tables are dropped, to be rebuilt by refresh()
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    path TEXT NOT NULL,
+    location TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    taken INTEGER NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    valid INTEGER,
+    pixel_average REAL,
+    PRIMARY KEY (location, path)
+);
+CREATE INDEX IF NOT EXISTS frames_location_taken ON frames (location, taken);
+CREATE INDEX IF NOT EXISTS frames_location_dir ON frames (location, dir);
+CREATE INDEX IF NOT EXISTS frames_path ON frames (path);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT NOT NULL,
+    location TEXT NOT NULL,
+    parent TEXT,
+    mtime_ns INTEGER,
+    PRIMARY KEY (location, path)
+);
+"""
+
+
+def dt2epoch(d: dt) -> int:
+    return int((d - EPOCH).total_seconds())
+
+
+def is_image_name(name: str) -> bool:
+    """ Case insensitive match of IMAGE_SUFFIXES """
+    return name.lower().endswith(IMAGE_SUFFIXES)
+
+
+class Catalog:
+    """
+    Indexed table of the frames under tmv_root. Safe to share between threads (each uses its own connection).
+    """
+
+    FILENAME = ".tmv-catalog.sqlite"
+
+    def __init__(self, tmv_root=".", path=None):
+        self.tmv_root = Path(tmv_root).absolute()
+        self.path = Path(path) if path else self.tmv_root / self.FILENAME
+        self._local = threading.local()
+        with self._db:
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._db.executescript("DROP TABLE IF EXISTS frames; DROP TABLE IF EXISTS dirs;")
+                self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._db.executescript(SCHEMA)
+
+    def __str__(self):
+        return f"Catalog: {self.path} tmv_root: {self.tmv_root}"
+
+    @property
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(str(self.path), timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def _rel(self, p) -> str:
+        return os.path.relpath(os.path.join(str(self.tmv_root), str(p)), str(self.tmv_root))
+
+    def refresh(self, location="."):
+        """
+        Bring the catalog up to date with the files under tmv_root/location.
+        Only directories with a changed mtime are rescanned. Return (n_added_or_updated, n_removed).
+        """
+        db = self._db
+        location = self._rel(location)
+        known = {}
+        children = {}
+        for path, parent, mtime_ns in db.execute("SELECT path, parent, mtime_ns FROM dirs WHERE location = ?", (location,)):
+            known[path] = mtime_ns
+            children.setdefault(parent, []).append(path)
+
+        n_updated = n_removed = 0
+        seen = set()
+        stack = [(location, None)]
+        with db:
+            while stack:
+                rel_dir, parent = stack.pop()
+                abs_dir = os.path.join(str(self.tmv_root), rel_dir)
+                try:
+                    mtime_ns = os.stat(abs_dir).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                seen.add(rel_dir)
+                if known.get(rel_dir) == mtime_ns:
+                    # unchanged entries: only subdirectories need checking
+                    stack.extend((c, rel_dir) for c in children.get(rel_dir, []))
+                    continue
+                u, r, subdirs = self._rescan_dir(db, location, rel_dir, abs_dir)
+                n_updated += u
+                n_removed += r
+                db.execute("INSERT OR REPLACE INTO dirs (path, location, parent, mtime_ns) VALUES (?, ?, ?, ?)",
+                           (rel_dir, location, parent, mtime_ns))
+                stack.extend((d, rel_dir) for d in subdirs)
+
+            for gone in set(known) - seen:
+                n_removed += db.execute("DELETE FROM frames WHERE location = ? AND dir = ?", (location, gone)).rowcount
+                db.execute("DELETE FROM dirs WHERE location = ? AND path = ?", (location, gone))
+        LOGGER.debug(f"Refreshed {location}: {n_updated} updated, {n_removed} removed, {len(seen)} dirs")
+        return n_updated, n_removed
+
+    @staticmethod
+    def _rescan_dir(db, location, rel_dir, abs_dir):
+        rows = []
+        subdirs = []
+        try:
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(os.path.join(rel_dir, entry.name) if rel_dir != "." else entry.name)
+                    elif is_image_name(entry.name) and entry.is_file(follow_symlinks=False):
+                        taken = str2dt(entry.name, throw=False)
+                        if taken is None:
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                        rel_path = os.path.join(rel_dir, entry.name) if rel_dir != "." else entry.name
+                        rows.append((rel_path, location, rel_dir, dt2epoch(taken), st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+        existing = {path: (size, mtime_ns) for path, size, mtime_ns in db.execute("SELECT path, size, mtime_ns FROM frames WHERE location = ? AND dir = ?", (location, rel_dir))}
+        changed = [r for r in rows if existing.get(r[0]) != (r[4], r[5])]
+        # changed files lose their cached validity and stats
+        db.executemany("INSERT OR REPLACE INTO frames (path, location, dir, taken, size, mtime_ns) VALUES (?, ?, ?, ?, ?, ?)", changed)
+        gone = set(existing) - set(r[0] for r in rows)
+        db.executemany("DELETE FROM frames WHERE location = ? AND path = ?", ((location, g) for g in gone))
+        return len(changed), len(gone), subdirs
+
+    def _where(self, location, start=None, end=None, start_time=None, end_time=None, subdir=None, valid_only=False):
+        clauses = ["location = ?"]
+        params = [self._rel(location)]
+        if start is not None and start > dt.min:
+            clauses.append("taken >= ?")
+            params.append(dt2epoch(start))
+        if end is not None and end < dt.max:
+            clauses.append("taken <= ?")
+            params.append(dt2epoch(end))
+        if start_time is not None and start_time > time.min:
+            clauses.append("taken % 86400 >= ?")
+            params.append(start_time.hour * 3600 + start_time.minute * 60 + start_time.second)
+        if end_time is not None and end_time < time.max:
+            clauses.append("taken % 86400 <= ?")
+            params.append(end_time.hour * 3600 + end_time.minute * 60 + end_time.second)
+        if subdir is not None:
+            prefix = self._rel(Path(location) / subdir)
+            clauses.append("(dir = ? OR dir LIKE ? ESCAPE '\\')")
+            escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.extend([prefix, escaped + "/%"])
+        if valid_only:
+            clauses.append("(valid IS NULL OR valid = 1)")
+        return " AND ".join(clauses), params
+
+    def paths(self, location=".", **kwargs):
+        """ Return (absolute paths, datetime64[s] array), sorted by time. kwargs: see frames() """
+        import numpy as np  # pylint: disable=import-outside-toplevel
+        where, params = self._where(location, **kwargs)
+        rows = self._db.execute(f"SELECT path, taken FROM frames WHERE {where} ORDER BY taken, path", params).fetchall()
+        root = str(self.tmv_root)
+        paths = [os.path.join(root, r[0]) for r in rows]
+        taken = np.array([r[1] for r in rows], dtype="int64").astype("datetime64[s]")
+        return paths, taken
+
+    def frames(self, location=".", start=None, end=None, start_time=None, end_time=None, subdir=None, valid_only=False):
+        """
+        Return a list of TLFiles, sorted by time.
+        start, end: datetime range (inclusive)
+        start_time, end_time: time-of-day range (inclusive)
+        subdir: only frames under tmv_root/location/subdir, e.g. "daily-photos/2000-01-01"
+        valid_only: exclude frames known to be invalid
+        """
+        from tmv.video import TLFile  # pylint: disable=import-outside-toplevel, cyclic-import
+        paths, taken = self.paths(location, start=start, end=end, start_time=start_time, end_time=end_time,
+                                  subdir=subdir, valid_only=valid_only)
+        return [TLFile(p, t) for p, t in zip(paths, taken.astype(object))]
+
+    def count(self, location=".", **kwargs):
+        where, params = self._where(location, **kwargs)
+        return self._db.execute(f"SELECT COUNT(*) FROM frames WHERE {where}", params).fetchone()[0]
+
+    def days(self, location=".", subdir=None):
+        """ Sorted list of dates with at least one frame """
+        where, params = self._where(location, subdir=subdir)
+        rows = self._db.execute(f"SELECT DISTINCT taken / 86400 FROM frames WHERE {where} ORDER BY 1", params)
+        return [(EPOCH + timedelta(days=r[0])).date() for r in rows]
+
+    def latest(self, location=".", subdir=None):
+        """ Absolute path of the most recent frame, or None """
+        where, params = self._where(location, subdir=subdir)
+        row = self._db.execute(f"SELECT path FROM frames WHERE {where} ORDER BY taken DESC, path DESC LIMIT 1", params).fetchone()
+        return self.tmv_root / row[0] if row else None
+
+    def set_valid(self, path_valids):
+        """ path_valids: iterable of (path, bool). Set in every location the path is in """
+        with self._db:
+            self._db.executemany("UPDATE frames SET valid = ? WHERE path = ?",
+                                 ((int(v), self._rel(p)) for p, v in path_valids))
+
+    def set_pixel_average(self, path_averages):
+        """ path_averages: iterable of (path, float 0-1). Set in every location the path is in """
+        with self._db:
+            self._db.executemany("UPDATE frames SET pixel_average = ? WHERE path = ?",
+                                 ((a, self._rel(p)) for p, a in path_averages))
+
+    def pixel_averages(self, paths):
+        """ Return a list of cached pixel averages (or None), one per path """
+        averages = {}
+        rel_paths = [self._rel(p) for p in paths]
+        for i in range(0, len(rel_paths), 500):
+            chunk = rel_paths[i:i + 500]
+            q = f"SELECT path, pixel_average FROM frames WHERE path IN ({','.join('?' * len(chunk))}) AND pixel_average IS NOT NULL"
+            averages.update(self._db.execute(q, chunk).fetchall())
+        return [averages.get(p) for p in rel_paths]
@@ -0,0 +1,104 @@
+"""
+Deflicker frames using their brightness, instead of ffmpeg's "deflicker" filter.
+
+1. Each frame's mean luma (0-1) is measured on a small, draft-mode decode of the JPEG (cheap),
+   or read from the catalog's pixel_average if already known.
+2. The luma curve is smoothed with a moving average over a window of *real* time, so the result
+   doesn't depend on where a video (or a day) starts or ends.
+3. Each frame is scaled by gain = smoothed / luma as it's decoded (a FrameFeed frame filter).
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import logging
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = timedelta(minutes=10)
+MAX_GAIN = 2.0
+# size to measure luma at: JPEGs are decoded at 1/2, 1/4 or 1/8 scale towards this
+LUMA_SIZE = (64, 64)
+DEFAULT_WORKERS = 8
+
+
+def frame_luma(filename):
+    """ Mean luma (0-1) of an image, or NaN if it can't be read """
+    try:
+        with Image.open(filename) as im:
+            im.draft("L", LUMA_SIZE)
+            return float(np.asarray(im.convert("L")).mean()) / 255
+    except OSError as exc:
+        LOGGER.warning(f"Can't get luma of {filename}: {exc}")
+        return float("nan")
+
+
+def frame_lumas(filenames, catalog=None, workers=DEFAULT_WORKERS):
+    """
+    Return an array of the mean luma of each file. Use and update the catalog's pixel_average, if a catalog is given.
+    """
+    filenames = [str(f) for f in filenames]
+    cached = catalog.pixel_averages(filenames) if catalog else [None] * len(filenames)
+    to_measure = [i for i, c in enumerate(cached) if c is None]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        measured = list(pool.map(frame_luma, (filenames[i] for i in to_measure)))
+    lumas = np.array([np.nan if c is None else c for c in cached], dtype="float64")
+    lumas[to_measure] = measured
+    if catalog and to_measure:
+        catalog.set_pixel_average((filenames[i], lumas[i]) for i in to_measure if not np.isnan(lumas[i]))
+    LOGGER.debug(f"Lumas of {len(filenames)} frames: {len(filenames) - len(to_measure)} cached, {len(to_measure)} measured")
+    return lumas
+
+
+def smooth(taken, values, window=DEFAULT_WINDOW):
+    """
+    Centred moving average of values over a window of real time.
+    taken: sorted datetime64 array of each value's time. NaN values are ignored.
+    """
+    taken = np.asarray(taken, dtype="datetime64[us]")
+    values = np.asarray(values, dtype="float64")
+    half_window = np.timedelta64(window, "us") / 2
+    lo = np.searchsorted(taken, taken - half_window, side="left")
+    hi = np.searchsorted(taken, taken + half_window, side="right")
+    known = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(known, values, 0))))
+    counts = np.concatenate(([0], np.cumsum(known)))
+    n = counts[hi] - counts[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n > 0, (sums[hi] - sums[lo]) / n, np.nan)
+
+
+def gains(lumas, smoothed, max_gain=MAX_GAIN):
+    """ Per-frame gain to bring each luma to the smoothed luma. 1 where unknown. """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        g = np.asarray(smoothed) / np.asarray(lumas)
+    g[~np.isfinite(g)] = 1.0
+    return np.clip(g, 1 / max_gain, max_gain)
+
+
+class Deflicker:
+    """
+    Frame filter (see FrameFeed) to apply a gain to each frame, via a lookup table.
+    """
+
+    def __init__(self, frame_gains):
+        self.gains = np.asarray(frame_gains, dtype="float64")
+        self._levels = np.arange(256, dtype="float64")
+
+    def __str__(self):
+        return f"Deflicker: frames:{len(self.gains)} gain:{self.gains.min():.2f}-{self.gains.max():.2f}"
+
+    @classmethod
+    def from_frames(cls, filenames, taken, window=DEFAULT_WINDOW, catalog=None, max_gain=MAX_GAIN):
+        """ Measure the frames and return a Deflicker for them """
+        lumas = frame_lumas(filenames, catalog=catalog)
+        return cls(gains(lumas, smooth(taken, lumas, window), max_gain))
+
+    def __call__(self, frame, i):
+        gain = self.gains[i]
+        if gain == 1.0:
+            return frame
+        lut = np.clip(self._levels * gain + 0.5, 0, 255).astype("uint8")
+        return lut[frame]
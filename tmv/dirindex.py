@@ -0,0 +1,175 @@
+"""
+Cached directory listings, for videod's tasks to find images and videos without globbing every run.
+
+Each directory is listed with one os.scandir (and a stat of each entry), and kept until the directory's mtime changes,
+which it does when entries are added, removed or renamed into it (e.g. images uploaded, or videos written: see
+JobRunner's atomic outputs). A file changed in place isn't seen until then: invalidate() its directory (as videod's
+watch mode does) or clear() the index. Except that files changed as their directory was listed (e.g. still being
+uploaded) are stat'd again by stat() until they settle, so a partial upload's size and mtime aren't kept.
+The counts of syscalls made show what the cache saves.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from stat import S_ISDIR
+
+from tmv.metrics import record
+
+LOGGER = logging.getLogger(__name__)
+
+# listings of directories changed this recently (seconds) aren't kept: on filesystems with coarse mtimes, a later
+# change could leave the mtime the same. Likewise, files changed this recently are stat'd again
+RACY_SECONDS = 2
+
+
+class Listing:
+    """ A directory's entries: {name: (is_dir, size, mtime_ns)}, and its mtime when listed """
+
+    def __init__(self, path, mtime_ns, entries, listed_ns=None):
+        self.path = Path(path)
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        listed_ns = time.time_ns() if listed_ns is None else listed_ns
+        # files changed as they were listed, which may be changing still
+        self.unsettled = {name for name, (is_dir, _, mtime_ns) in entries.items() if not is_dir and listed_ns - mtime_ns < RACY_SECONDS * 1e9}
+
+    def __str__(self):
+        return f"Listing: {self.path} entries:{len(self.entries)}"
+
+    def dirs(self):
+        return sorted(self.path / name for name, (is_dir, _, _) in self.entries.items() if is_dir)
+
+    def files(self, suffixes=None):
+        """ Sorted paths of the files, with one of suffixes (case insensitive, e.g. (".jpg", ".jpeg")) if given """
+        return sorted(self.path / name for name, (is_dir, _, _) in self.entries.items()
+                      if not is_dir and (suffixes is None or name.lower().endswith(suffixes)))
+
+
+class DirIndex:
+    """
+    Listings of directories, cached until their mtime changes. Safe to share between threads.
+    counts: syscalls made: 'stat' (incl. those of each entry) and 'scandir', and listings 'cached' (reused)
+    """
+
+    def __init__(self):
+        self._listings = {}  # Path: Listing
+        self._lock = threading.Lock()
+        self.counts = Counter()
+
+    def __str__(self):
+        return f"DirIndex: {len(self._listings)} dirs {dict(self.counts)}"
+
+    def listing(self, path):
+        """ The Listing of directory path, or None if it isn't one """
+        path = Path(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        finally:
+            self._count('stat')
+        if not S_ISDIR(st.st_mode):
+            return None
+        with self._lock:
+            cached = self._listings.get(path)
+        if cached and cached.mtime_ns == st.st_mtime_ns:
+            self._count('cached')
+            return cached
+        entries = {}
+        listed_ns = time.time_ns()
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        est = e.stat()  # follow symlinks, e.g. most-recent-*.mp4
+                        entries[e.name] = (S_ISDIR(est.st_mode), est.st_size, est.st_mtime_ns)
+                    except OSError:
+                        pass  # removed since listed, or a broken link
+                    finally:
+                        self._count('stat')
+        except OSError:
+            return None
+        finally:
+            self._count('scandir')
+        record(files_scanned=len(entries))
+        listing = Listing(path, st.st_mtime_ns, entries, listed_ns)
+        with self._lock:
+            if time.time_ns() - st.st_mtime_ns > RACY_SECONDS * 1e9:
+                self._listings[path] = listing
+            else:
+                self._listings.pop(path, None)
+        return listing
+
+    def dirs(self, path, hidden=False):
+        """ Sorted subdirectories of path (none if it isn't a directory) """
+        listing = self.listing(path)
+        return [d for d in listing.dirs() if hidden or not d.name.startswith(".")] if listing else []
+
+    def files(self, path, suffixes=None):
+        """ Sorted files in path, with one of suffixes if given (see Listing.files) """
+        listing = self.listing(path)
+        return listing.files(suffixes) if listing else []
+
+    def walk_files(self, path, suffixes=None, hidden=False):
+        """ Sorted files under path (recursively), with one of suffixes if given. hidden: include hidden directories' files """
+        files = self.files(path, suffixes)
+        for d in self.dirs(path, hidden):
+            files.extend(self.walk_files(d, suffixes, hidden))
+        return sorted(files)
+
+    def stat(self, path):
+        """ (size, mtime_ns) of path, or None if it doesn't exist. Directories' are current, files' as of their directory's listing """
+        path = Path(path)
+        listing = self.listing(path.parent)
+        entry = listing.entries.get(path.name) if listing else None
+        if entry is None:
+            return None
+        if entry[0]:
+            # its mtime changes without its parent's
+            try:
+                return 0, os.stat(path).st_mtime_ns
+            except OSError:
+                return None
+            finally:
+                self._count('stat')
+        if path.name in listing.unsettled:
+            return self._restat(listing, path)
+        return entry[1], entry[2]
+
+    def _restat(self, listing, path):
+        """ (size, mtime_ns) of a file in listing that was changing as it was listed. Kept once it's settled """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        finally:
+            self._count('stat')
+        if time.time_ns() - st.st_mtime_ns > RACY_SECONDS * 1e9:
+            with self._lock:
+                listing.entries[path.name] = (False, st.st_size, st.st_mtime_ns)
+                listing.unsettled.discard(path.name)
+        return st.st_size, st.st_mtime_ns
+
+    def invalidate(self, path):
+        """ Forget path's listing, e.g. as a file in it has changed in place """
+        with self._lock:
+            self._listings.pop(Path(path), None)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+    def take_counts(self):
+        """ Return counts, and start counting again """
+        with self._lock:
+            counts, self.counts = self.counts, Counter()
+        return counts
+
+    def _count(self, syscall):
+        with self._lock:
+            self.counts[syscall] += 1
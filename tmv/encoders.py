@@ -0,0 +1,116 @@
+"""
+Named encoder profiles: the codec, preset, CRF and threads used to encode videos.
+
+The built-in PROFILES can be changed, or others added, in videod.toml:
+
+ [encoders.small]
+ codec = "libx265"
+ preset = "medium"
+ crf = 30
+ threads = 2
+
+and chosen per task (encoder = "small") or with tmv-video-compile --encoder.
+To choose with data, tmv-video-bench encodes a synthetic clip with each profile and reports its fps and size.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import logging
+
+from tmv.exceptions import ConfigError
+from tmv.ffrunner import run_ffmpeg
+from tmv.util import Tomlable
+
+LOGGER = logging.getLogger(__name__)
+
+# preset is libx264/libx265's -preset (e.g. "veryfast"), libsvtav1's -preset (0-13) or libvpx-vp9's -cpu-used (0-8). Larger/faster is quicker.
+CODECS = ("libx264", "libx265", "libsvtav1", "libvpx-vp9")
+
+
+class EncoderProfile(Tomlable):
+    """
+    How to encode: codec, preset and (optional) crf and threads. Unset options are left to ffmpeg's defaults.
+    """
+
+    def __init__(self, name, codec="libx264", preset=None, crf=None, threads=None):
+        super().__init__()
+        self.name = name
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+
+    def __str__(self):
+        return f"EncoderProfile: {self.name} codec:{self.codec} preset:{self.preset} crf:{self.crf} threads:{self.threads}"
+
+    def configd(self, config_dict):
+        self.setattr_from_dict("codec", config_dict)
+        self.setattr_from_dict("preset", config_dict)
+        self.setattr_from_dict("crf", config_dict)
+        self.setattr_from_dict("threads", config_dict)
+        if self.codec not in CODECS:
+            raise ConfigError(f"Unknown codec: {self.codec} in encoder {self.name}. Use one of {CODECS}")
+
+    def as_dict(self):
+        return {'codec': self.codec, 'preset': self.preset, 'crf': self.crf, 'threads': self.threads}
+
+    def output_parameters(self):
+        """ ffmpeg output options """
+        p = ["-vcodec", self.codec]
+        if self.codec == "libvpx-vp9":
+            if self.preset is not None:
+                p.extend(["-deadline", "good", "-cpu-used", str(self.preset)])
+            if self.crf is not None:
+                # constant quality, not the default constrained bitrate
+                p.extend(["-crf", str(self.crf), "-b:v", "0"])
+            p.extend(["-row-mt", "1"])
+        else:
+            if self.preset is not None:
+                p.extend(["-preset", str(self.preset)])
+            if self.crf is not None:
+                p.extend(["-crf", str(self.crf)])
+        if self.codec == "libx265":
+            # playable by Apple's players
+            p.extend(["-tag:v", "hvc1"])
+        if self.threads:
+            p.extend(["-threads", str(self.threads)])
+        return p
+
+    def job_preset(self):
+        """ preset (and crf) of an encode_job, to predict from similar encodes """
+        return f"{self.preset}" + (f" crf={self.crf}" if self.crf is not None else "")
+
+
+PROFILES = {
+    "x264": EncoderProfile("x264", "libx264", "veryfast"),
+    "x265": EncoderProfile("x265", "libx265", "fast", crf=28),
+    "svt-av1": EncoderProfile("svt-av1", "libsvtav1", 8, crf=35),
+    "vp9": EncoderProfile("vp9", "libvpx-vp9", 5, crf=33),
+}
+DEFAULT_ENCODER = "x264"
+
+
+def encoder_profile(encoder=None) -> EncoderProfile:
+    """ encoder: an EncoderProfile, the name of one in PROFILES or None for the DEFAULT_ENCODER """
+    if isinstance(encoder, EncoderProfile):
+        return encoder
+    try:
+        return PROFILES[encoder or DEFAULT_ENCODER]
+    except KeyError as exc:
+        raise ConfigError(f"Unknown encoder: {encoder}. Use one of {list(PROFILES)}, or add it in [encoders]") from exc
+
+
+def configure_encoders(config_dict):
+    """ Add or change PROFILES from an [encoders] table of {name: {codec, preset, crf, threads}} """
+    for name, profile_dict in config_dict.items():
+        # start from the existing profile (if any), rather than changing it in place
+        profile = EncoderProfile(name, **PROFILES[name].as_dict()) if name in PROFILES else EncoderProfile(name)
+        profile.configd(profile_dict)
+        PROFILES[name] = profile
+
+
+def available_codecs():
+    """ The CODECS this ffmpeg can encode with """
+    stdout, _ = run_ffmpeg(["ffmpeg", "-hide_banner", "-encoders"])
+    # e.g. " V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC"
+    encoders = {line.split()[1] for line in stdout.splitlines() if len(line.split()) > 1 and line.startswith(" V")}
+    return [c for c in CODECS if c in encoders]
@@ -0,0 +1,375 @@
+"""
+Run ffmpeg (and ffprobe) jobs, with:
+- concurrency limits: max_jobs in this process and max_host_jobs across all processes on the host
+  (a flock'd slot file each, in lock_dir)
+- nice and ionice
+- a wall-clock timeout, after which the job is killed
+- live progress from "-progress pipe:N" (ffmpeg only), passed to an on_progress callback
+- a bounded tail of stderr, instead of all of ffmpeg's (verbose) output
+- a history of encodes (see predict.py): jobs run with a description are recorded, to predict()
+  the time and size of future ones
+- cancellation: on timeout, signal (e.g. SIGTERM's SignalException) or cancel_all(), the job is
+  killed and its partial outputs removed
+- atomic outputs: written to hidden temporary files, renamed over the outputs only if the job succeeds
+- admission control: encodes (jobs with outputs) wait, before taking a slot, while the host is loaded, or run downscaled (see admission.py)
+- metrics: each job's cpu time, frames and bytes written are recorded for the videod task running it (see metrics.py)
+
+Failed jobs raise CalledProcessError (with the stderr tail), and write it to log_filename.
+
+ [ffmpeg]
+ max_jobs = 2
+ max_host_jobs = 4
+ nice = 10
+ ionice = "idle"
+ timeout = 7200
+ history = "~/.cache/tmv/encode-history.sqlite"   # or false. Default: in $XDG_CACHE_HOME (or ~/.cache)
+ [ffmpeg.admission]
+ max_load = 1.5
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import fcntl
+import logging
+import os
+import resource
+import shutil
+import signal
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from subprocess import PIPE, CalledProcessError, TimeoutExpired
+
+from tmv.admission import Admission
+from tmv.exceptions import ConfigError
+from tmv.metrics import record
+from tmv.predict import EncodeHistory, default_history_path
+from tmv.util import Tomlable, unlink_safe
+
+LOGGER = logging.getLogger(__name__)
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+SLOT_POLL = 0.5  # seconds between checks for a free host slot
+EXIT_POLL = 0.05  # seconds between checks for a job's exit, with a timeout
+# held while reaping a job, so the change in RUSAGE_CHILDREN is its alone
+REAP_LOCK = threading.Lock()
+
+
+class JobRunner(Tomlable):
+    """
+    Runs jobs (command lines) subject to its limits. Use the module's RUNNER (see run_ffmpeg) to share the limits.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.max_jobs = None  # in this process. None for no limit
+        self.max_host_jobs = None  # across processes on this host, via lock_dir. None for no limit
+        self.lock_dir = Path(tempfile.gettempdir()) / "tmv-ffmpeg-slots"
+        self.nice = None  # e.g. 10
+        self.ionice = None  # e.g. "idle". See IONICE_CLASSES
+        self.timeout = None  # seconds
+        self.stderr_lines = 200  # tail of stderr kept
+        self.history = True  # path of the encode history, True for predict.default_history_path(). False or None to not record
+        self.admission = Admission()
+        self._history = None
+        self._slots = None
+        self._running = {}  # proc: outputs
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"JobRunner: max_jobs:{self.max_jobs} max_host_jobs:{self.max_host_jobs} nice:{self.nice} ionice:{self.ionice} timeout:{self.timeout}"
+
+    def configd(self, config_dict):
+        self.setattr_from_dict("max_jobs", config_dict)
+        self.setattr_from_dict("max_host_jobs", config_dict)
+        self.lock_dir = Path(config_dict.get("lock_dir", self.lock_dir))
+        self.setattr_from_dict("nice", config_dict)
+        self.setattr_from_dict("ionice", config_dict)
+        self.setattr_from_dict("timeout", config_dict)
+        self.setattr_from_dict("stderr_lines", config_dict)
+        if 'history' in config_dict:
+            history = config_dict['history']
+            self.history = history if history is True else Path(history).expanduser() if history else None
+            self._history = None
+        if 'admission' in config_dict:
+            self.admission.configd(config_dict['admission'])
+        if self.ionice is not None and self.ionice not in IONICE_CLASSES:
+            raise ConfigError(f"ionice must be one of {list(IONICE_CLASSES)}, not {self.ionice}")
+        self._slots = None
+
+    def run(self, cl, feed=None, log_filename=None, outputs=(), timeout=None, on_progress=None, text=True, job=None, atomic=False):
+        """
+        Run cl (a list) when a slot is free, and return (stdout, stderr tail)
+        feed: iterable of bytes to write to stdin (e.g. a FrameFeed)
+        outputs: files the job writes, removed if it's cancelled or times out
+        timeout: seconds, overriding self.timeout. Raises TimeoutExpired.
+        on_progress: callable(dict of ffmpeg's progress, e.g. 'frame', 'out_time_us', 'speed')
+        text: decode stdout, else return bytes
+        job: description of the encode (see predict.JOB_KEYS) to record, with its time and the size of its outputs
+        atomic: write the outputs (arguments of cl) to temporary files in their directories, and rename them over
+                the outputs once the job succeeds. A failed job leaves the outputs as they were.
+        """
+        cl = [str(c) for c in cl]
+        timeout = timeout or self.timeout
+        outputs = [Path(o) for o in outputs]
+        partials = {}
+        if atomic:
+            partials = {o: partial_path(o) for o in outputs}
+            cl = [str(partials[Path(c)]) if Path(c) in partials else c for c in cl]
+        if outputs:
+            # before taking a slot, so a deferred encode doesn't hold up others
+            cl, downscaled = self.admission.admit(cl, outputs[0].parent, f"{Path(cl[0]).name} {outputs[0].name}")
+            if downscaled:
+                job = None  # not representative of its encoder settings
+        with self._process_slot(), self._host_slot():
+            start = time.monotonic()
+            try:
+                result = self._run(cl, feed, log_filename, list(partials.values()) or outputs, timeout, on_progress, text)
+                for o, p in partials.items():
+                    if p.exists():
+                        os.replace(p, o)
+            finally:
+                for p in partials.values():
+                    unlink_safe(p)
+            if outputs:
+                n_bytes = sum(o.stat().st_size for o in outputs if o.is_file())
+                record(bytes_written=n_bytes)
+                if job:
+                    self._record(job, time.monotonic() - start, n_bytes)
+            return result
+
+    def predict(self, job):
+        """ Estimate of job's encode time and size (see predict.JOB_KEYS) """
+        try:
+            history = self._encode_history()
+            if history:
+                return history.predict(job)
+        except (OSError, sqlite3.Error) as exc:
+            LOGGER.warning(f"Can't read encode history in {self._history and self._history.path}: {exc}")
+        return EncodeHistory.guess(job)
+
+    def _encode_history(self):
+        if not self.history:
+            return None
+        # resolved on use, as $XDG_CACHE_HOME may change (e.g. in tests)
+        path = default_history_path() if self.history is True else Path(self.history)
+        if self._history is None or self._history.path != path:
+            if self._history is not None:
+                self._history.close()
+            self._history = EncodeHistory(path)
+        return self._history
+
+    def _record(self, job, seconds, n_bytes):
+        try:
+            history = self._encode_history()
+            if history:
+                history.record(job, seconds, n_bytes)
+        except (OSError, sqlite3.Error) as exc:
+            LOGGER.warning(f"Can't record encode in {self._history and self._history.path}: {exc}")
+
+    def cancel_all(self):
+        """ Kill all running jobs and remove their outputs. Their run() raises CalledProcessError. Deferred jobs raise InterruptedError. """
+        self.admission.cancel()
+        with self._lock:
+            running = list(self._running.items())
+        for proc, outputs in running:
+            LOGGER.info(f"Cancelling {proc.args[0]} (pid {proc.pid})")
+            self._kill(proc, outputs)
+
+    def _command(self, cl):
+        prefix = []
+        if self.ionice is not None and shutil.which("ionice"):
+            prefix.extend(["ionice", "-c", str(IONICE_CLASSES[self.ionice])])
+        if self.nice is not None and shutil.which("nice"):
+            prefix.extend(["nice", "-n", str(self.nice)])
+        return prefix + cl
+
+    def _run(self, cl, feed, log_filename, outputs, timeout, on_progress, text):
+        progress_r, progress_w = None, None
+        if Path(cl[0]).name == "ffmpeg":
+            progress_r, progress_w = os.pipe()
+            cl = cl[:1] + ["-nostats", "-progress", f"pipe:{progress_w}"] + cl[1:]
+        try:
+            proc = subprocess.Popen(self._command(cl), stdin=PIPE if feed is not None else subprocess.DEVNULL, stdout=PIPE, stderr=PIPE,
+                                    pass_fds=(progress_w,) if progress_w is not None else ())
+        except OSError as e:
+            raise OSError("Subprocess failed to even run") from e
+        finally:
+            if progress_w is not None:
+                os.close(progress_w)
+        with self._lock:
+            self._running[proc] = outputs
+
+        # drain outputs in the background, so the process can't block on a full pipe
+        out = []
+        err = deque(maxlen=self.stderr_lines)
+        progress = {}
+        readers = [threading.Thread(target=lambda: out.append(proc.stdout.read()), daemon=True),
+                   threading.Thread(target=lambda: err.extend(line.decode("UTF-8", errors="replace") for line in proc.stderr), daemon=True)]
+        if progress_r is not None:
+            readers.append(threading.Thread(target=self._read_progress, args=(progress_r, progress, on_progress), daemon=True))
+        for r in readers:
+            r.start()
+        start = time.monotonic()
+        try:
+            if feed is not None:
+                try:
+                    for data in feed:
+                        proc.stdin.write(data)
+                        if timeout and time.monotonic() - start > timeout:
+                            raise TimeoutExpired(cl, timeout)
+                except BrokenPipeError:
+                    pass  # process exited early: report via its returncode
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        pass
+            remaining = timeout - (time.monotonic() - start) if timeout else None
+            returncode, cpu_seconds = self._wait(proc, max(remaining, 0) if remaining is not None else None)
+        except BaseException as exc:
+            # timeout, signal or error: don't leave partial outputs
+            LOGGER.warning(f"Killing {cl[0]} (pid {proc.pid}): {type(exc).__name__} {exc}")
+            self._kill(proc, outputs)
+            record(cpu_seconds=self._reap(proc)[1])
+            raise
+        finally:
+            for r in readers:
+                r.join()
+            with self._lock:
+                self._running.pop(proc, None)
+
+        record(cpu_seconds=cpu_seconds, frames=int(progress.get('frame', 0) or 0))
+        stdout = out[0] if out else b""
+        if text:
+            stdout = stdout.decode("UTF-8", errors="replace")
+        stderr = "".join(err)
+        if progress:
+            LOGGER.debug(f"{cl[0]} finished in {time.monotonic() - start:.1f}s: frame={progress.get('frame')} speed={progress.get('speed')}")
+        if returncode != 0:
+            if log_filename:
+                Path(log_filename).write_text(f"*** command ***\n{cl}\n{' '.join(cl)}\n*** returned ***\n{returncode}\n" +
+                                              f"*** stderr (last {self.stderr_lines} lines) ***\n{stderr}\n")
+            raise CalledProcessError(returncode, cl, stdout, stderr)
+        return stdout, stderr
+
+    @classmethod
+    def _wait(cls, proc, timeout=None):
+        """ Wait for proc to exit, and return its (returncode, cpu seconds: the change in RUSAGE_CHILDREN as it's reaped) """
+        cls._wait_exit(proc, timeout)
+        return cls._reap(proc)
+
+    @staticmethod
+    def _wait_exit(proc, timeout=None):
+        """ Wait for proc to exit, without reaping it """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            while not os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT | (os.WNOHANG if deadline else 0)):
+                if time.monotonic() > deadline:
+                    raise TimeoutExpired(proc.args, timeout)
+                time.sleep(EXIT_POLL)
+        except ChildProcessError:
+            pass  # already reaped, by the thread running it
+
+    @staticmethod
+    def _reap(proc):
+        """ Reap proc once it's exited. Return its (returncode, cpu seconds), 0 if it was already reaped """
+        with REAP_LOCK:
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            returncode = proc.wait()
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return returncode, (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+
+    @staticmethod
+    def _read_progress(fd, progress, on_progress):
+        """ Parse ffmpeg's key=value progress lines. Each block ends with progress=continue|end. """
+        with open(fd, "r", encoding="UTF-8", errors="replace") as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                progress[key] = value
+                if key == "progress" and on_progress:
+                    try:
+                        on_progress(dict(progress))
+                    except Exception as exc:  # pylint: disable=broad-except
+                        LOGGER.debug(f"on_progress failed: {exc}", exc_info=exc)
+
+    @classmethod
+    def _kill(cls, proc, outputs):
+        """ Kill proc and remove its outputs once it's exited. It's left to the thread running it to _reap() """
+        with REAP_LOCK:
+            # not proc.kill(), which polls (and so may reap) it outside the lock. It's only reaped under the lock, so its pid isn't reused
+            if proc.returncode is None:
+                os.kill(proc.pid, signal.SIGKILL)
+        cls._wait_exit(proc)
+        for o in outputs:
+            unlink_safe(o)
+
+    def _process_slot(self):
+        if self.max_jobs is None:
+            return _NoSlot()
+        with self._lock:
+            if self._slots is None:
+                self._slots = threading.BoundedSemaphore(self.max_jobs)
+        return self._slots
+
+    def _host_slot(self):
+        if self.max_host_jobs is None:
+            return _NoSlot()
+        return _HostSlot(self.lock_dir, self.max_host_jobs)
+
+
+class _NoSlot:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _HostSlot:
+    """ One of n slots on this host: an flock'd file in lock_dir. Released if the process dies. """
+
+    def __init__(self, lock_dir, n):
+        self.lock_dir = Path(lock_dir)
+        self.n = n
+        self._f = None
+
+    def __enter__(self):
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        waited = False
+        while True:
+            for i in range(self.n):
+                f = open(self.lock_dir / f"slot-{i}.lock", "w")
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self._f = f
+                    return self
+                except BlockingIOError:
+                    f.close()
+            if not waited:
+                LOGGER.debug(f"Waiting for one of {self.n} slots in {self.lock_dir}")
+                waited = True
+            time.sleep(SLOT_POLL)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        return False
+
+
+def partial_path(output) -> Path:
+    """ A unique, hidden path beside output, with its suffix (so ffmpeg chooses the same format) """
+    output = Path(output)
+    return output.parent / f".partial-{uuid.uuid4().hex[:12]}{output.suffix}"
+
+
+RUNNER = JobRunner()
+
+
+def run_ffmpeg(cl, **kwargs):
+    """ Run cl with the shared RUNNER. See JobRunner.run """
+    return RUNNER.run(cl, **kwargs)
@@ -0,0 +1,164 @@
+"""
+Feed frames to ffmpeg over a pipe, instead of writing a concat-demuxer file list.
+
+Files are read (and optionally decoded, resized and filtered) ahead on a thread pool, and streamed
+in order to ffmpeg's stdin. Up to read_ahead frames are read ahead, and fewer if they'd take more than read_ahead_mb
+(e.g. a decoded 4056x3040 frame is 37MB). No list file is written, so concurrent encodes can't collide.
+- pass-through: each JPEG's bytes are sent as-is ("-f image2pipe"). ffmpeg decodes.
+- decoded: frames are decoded to RGB (PIL), resized and passed through frame_filters and sent
+  as "-f rawvideo". Enabled by setting size, frame_filters or decode.
+
+A frame filter is a callable (frame, i) -> frame, where frame is an HxWx3 uint8 numpy array and
+i is the frame's index in filenames. Filters run in order, one frame at a time, so may keep state between frames.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_READ_AHEAD = 32
+DEFAULT_READ_AHEAD_MB = 256
+# frames read ahead however big they are
+MIN_READ_AHEAD = 2
+
+
+class FrameFeed:
+    """
+    Iterable of frames (bytes) to write to ffmpeg's stdin. See input_parameters() for the matching ffmpeg options.
+    """
+
+    def __init__(self, filenames, size=None, frame_filters=None, workers=DEFAULT_WORKERS, read_ahead=DEFAULT_READ_AHEAD, decode=False,
+                 read_ahead_mb=DEFAULT_READ_AHEAD_MB):
+        self.filenames = [str(f) for f in filenames]
+        self.size = tuple(size) if size else None   # (width, height) of decoded frames
+        self.frame_filters = list(frame_filters or [])
+        self.force_decode = decode  # e.g. if frame_filters will be added later
+        self.workers = workers
+        self.read_ahead = read_ahead  # frames
+        self.read_ahead_mb = read_ahead_mb  # of frames read ahead. None for no limit
+        self.n_skipped = 0
+
+    def __str__(self):
+        return f"FrameFeed: frames:{len(self.filenames)} decode:{self.decode} size:{self.size} filters:{len(self.frame_filters)}"
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @property
+    def decode(self):
+        """ True to decode frames in python, else pass-through the JPEG bytes """
+        return self.force_decode or self.size is not None or bool(self.frame_filters)
+
+    def input_parameters(self, fps):
+        """ ffmpeg parameters to read this feed from stdin at fps (input) frames per second """
+        if self.decode:
+            if self.size is None:
+                self.size = self._first_size()
+            return ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{self.size[0]}x{self.size[1]}",
+                    "-framerate", str(fps), "-i", "-"]
+        return ["-f", "image2pipe", "-c:v", "mjpeg", "-framerate", str(fps), "-i", "-"]
+
+    def __iter__(self):
+        if self.decode:
+            if self.size is None:
+                self.size = self._first_size()
+            for i, frame in enumerate(self._read_ahead(self._decode)):
+                if frame is None:
+                    continue
+                for frame_filter in self.frame_filters:
+                    frame = frame_filter(frame, i)
+                yield frame.astype("uint8", copy=False).tobytes()
+        else:
+            for data in self._read_ahead(self._read):
+                if data is not None:
+                    yield data
+
+    def _read_ahead(self, read):
+        """ Yield read(filename) for each file in order, running up to frames_ahead() reads ahead on the pool """
+        frames_ahead = self.frames_ahead()
+        with ThreadPoolExecutor(max_workers=min(self.workers, frames_ahead)) as pool:
+            pending = deque()
+            for fn in self.filenames:
+                pending.append(pool.submit(read, fn))
+                if len(pending) >= frames_ahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def frames_ahead(self):
+        """ Frames to read ahead: read_ahead, or fewer if they'd take more than read_ahead_mb """
+        if self.decode:
+            if self.size is None:
+                self.size = self._first_size()
+            frame_bytes = self.size[0] * self.size[1] * 3
+        else:
+            # as sent, so about the size of each file
+            try:
+                frame_bytes = os.path.getsize(self.filenames[0])
+            except (OSError, IndexError):
+                frame_bytes = 0
+        if not self.read_ahead_mb or not frame_bytes:
+            return self.read_ahead
+        return max(MIN_READ_AHEAD, min(self.read_ahead, int(self.read_ahead_mb * 1e6 // frame_bytes)))
+
+    def _read(self, filename):
+        try:
+            with open(filename, "rb") as f:
+                return f.read()
+        except OSError as exc:
+            self.n_skipped += 1
+            LOGGER.warning(f"Skipping frame {filename}: {exc}")
+            return None
+
+    def _decode(self, filename):
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+        try:
+            with Image.open(filename) as im:
+                # JPEG: decode at a reduced scale if that's still >= size
+                im.draft("RGB", self.size)
+                im = im.convert("RGB")
+                if im.size != self.size:
+                    im = im.resize(self.size, Image.BILINEAR)
+                return np.asarray(im)
+        except OSError as exc:
+            self.n_skipped += 1
+            LOGGER.warning(f"Skipping frame {filename}: {exc}")
+            return None
+
+    def _first_size(self):
+        """ Size of the first image, rounded down to even (for yuv420p) """
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+        with Image.open(self.filenames[0]) as im:
+            width, height = im.size
+        return width - width % 2, height - height % 2
+
+
+class FrameBlend:
+    """
+    Frame filter: each frame is the average of it and the previous n-1 frames (a cheap motion blur)
+    """
+
+    def __init__(self, n=3):
+        self.n = n
+        self._frames = deque()
+        self._sum = None
+
+    def __str__(self):
+        return f"FrameBlend: n:{self.n}"
+
+    def __call__(self, frame, i):
+        frame = frame.astype("int32")
+        if self._sum is None or self._sum.shape != frame.shape:
+            self._frames.clear()
+            self._sum = np.zeros_like(frame)
+        self._frames.append(frame)
+        self._sum += frame
+        if len(self._frames) > self.n:
+            self._sum -= self._frames.popleft()
+        return (self._sum // len(self._frames)).astype("uint8")
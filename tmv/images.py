@@ -100,7 +100,8 @@ class Label(Overlay):
         text_size = 10
         font = ImageFont.truetype(FONT_FILE_IMAGE, text_size, encoding='unic')
         # Get the size of the time to write, so we can correctly place it
-        text_box_size = draw.textsize(text=text, font=font)
+        left, top, right, bottom = draw.textbbox((0, 0), text=text, font=font)  # textsize was removed in Pillow 10
+        text_box_size = (right - left, bottom - top)
         # centre text
         x = int((self.im.width / 2) - (text_box_size[0] / 2))
         # place one line above bottom
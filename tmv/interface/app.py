@@ -188,10 +188,7 @@ def req_journal():
 @socketio.on('req-files')
 @report_errors
 def req_files():
-    fls = []
-    for f in Path(interface.tmv_root).glob("**/*.jpg"):
-        fls.append(str(f))
-    fls.sort()
+    fls = interface.image_files()
     emit("n-files", len(fls))
     emit("files", fls)
  
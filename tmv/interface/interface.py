@@ -9,6 +9,7 @@ import os
 from pathlib import Path
 
 from tmv.buttons import StatefulButton, StatefulHWButton, StatesCircle, OFF
+from tmv.catalog import Catalog
 from tmv.util import Tomlable, interval_speeded, timed_lru_cache
 from tmv.config import *  # pylint: disable=wildcard-import, unused-wildcard-import
 
@@ -33,6 +34,7 @@ class Interface(Tomlable):
 
         self.port = 5000    # Where Flask server is started
         self.screen = None
+        self.catalog = None  # optional Catalog of tmv_root, used instead of globbing
 
     def poke(self):
         """ Stop interface's screen from sleeping """
@@ -50,9 +52,20 @@ class Interface(Tomlable):
 
     @timed_lru_cache(seconds=10, maxsize=10)
     def n_images(self):
+        if self.catalog:
+            self.catalog.refresh()
+            return self.catalog.count()
         # Resurive as often stores in day-named-folders under root
         return len(glob.glob(str(self.tmv_root / "**/*.jpg"), recursive=True))
 
+    def image_files(self):
+        """ All images under tmv_root, sorted """
+        if self.catalog:
+            self.catalog.refresh()
+            paths, _ = self.catalog.paths()
+            return sorted(paths)
+        return sorted(str(f) for f in Path(self.tmv_root).glob("**/*.jpg"))
+
     @property
     def interval(self):
         return interval_speeded(self._interval, self.speed_button.value)
@@ -105,6 +118,8 @@ class Interface(Tomlable):
                     LOGGER.info("Interface will use a screen. Ensure your pins for speed and mode buttons are set in mode|speed_button")
 
             self.setattr_from_dict('port', c)
+            if c.get('catalog', False):
+                self.catalog = Catalog(self.tmv_root)
 
         LOGGER.debug(f"Using screen: {self.screen}")
         LOGGER.debug(f"Using mode_button: {self.mode_button}")
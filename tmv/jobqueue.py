@@ -0,0 +1,236 @@
+"""
+A durable queue (SQLite) of jobs in tmv_root, so videod's work can be shared by several worker processes, on this or
+other hosts sharing tmv_root, without two doing the same work.
+
+A planner (videod --role planner) finds each location's nodes (see tmv.scheduler) whose inputs or outputs have changed
+since their last job, and enqueues a job for each, after the jobs of the nodes it depends on. Workers
+(videod --role worker) claim the highest priority job that's ready, with a lease that they renew (heartbeat) while
+it runs. A job that fails, or whose lease expires (e.g. its worker died), is retried up to max_attempts times.
+
+ tmv_root/
+    .tmv-queue.sqlite
+
+The queue uses SQLite's rollback journal, not WAL, as WAL needs shared memory that hosts can't share. Its locking
+needs a filesystem with working locks (e.g. NFSv4, not NFSv3 without lockd), and leases need the hosts' clocks to
+agree to well within 'lease' seconds (e.g. with NTP).
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+
+from tmv.util import Tomlable
+
+LOGGER = logging.getLogger(__name__)
+
+STATES = ("pending", "running", "done", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    location TEXT NOT NULL,
+    node TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    enqueued REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    signature TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_node ON jobs (location, node, id);
+CREATE TABLE IF NOT EXISTS after (
+    job INTEGER NOT NULL,
+    after INTEGER NOT NULL,
+    PRIMARY KEY (job, after)
+);
+"""
+
+# a job, as claimed by a worker
+Job = namedtuple("Job", "id location node priority attempts")
+
+# the latest job of a node: see JobQueue.latest()
+Latest = namedtuple("Latest", "id state signature")
+
+
+class JobQueue(Tomlable):
+    """
+    Jobs to run a location's node, each after the jobs it was enqueued after are done.
+    Safe to share between threads (each uses its own connection) and processes.
+    """
+
+    FILENAME = ".tmv-queue.sqlite"
+
+    def __init__(self, tmv_root=".", path=None):
+        super().__init__()
+        self.tmv_root = Path(tmv_root).absolute()
+        self.path = Path(path) if path else self.tmv_root / self.FILENAME
+        self.lease = 60  # seconds a claimed job is held without a heartbeat
+        self.max_attempts = 3
+        self.retry_delay = 60  # seconds before a failed job is retried, times its attempts so far
+        self.poll = 5  # seconds between a worker's claims when there are no jobs
+        self.keep = 7 * 24 * 3600  # seconds finished jobs are kept (see purge)
+        self._local = threading.local()
+        self._db.executescript(SCHEMA)
+
+    def __str__(self):
+        return f"JobQueue: {self.path} lease:{self.lease} max_attempts:{self.max_attempts}"
+
+    def configd(self, config_dict):
+        self.setattr_from_dict("lease", config_dict)
+        self.setattr_from_dict("max_attempts", config_dict)
+        self.setattr_from_dict("retry_delay", config_dict)
+        self.setattr_from_dict("poll", config_dict)
+        self.setattr_from_dict("keep", config_dict)
+
+    @property
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # autocommit: transactions are explicit
+            db = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    @contextmanager
+    def _transaction(self):
+        """ Hold the database's write lock, so claims by other processes wait """
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def enqueue(self, location, node, priority, after=()):
+        """
+        Add a job to run node in location, once the jobs (ids) in after are done, and return its id.
+        If the node has a job that isn't finished, return its id instead (adding after, if it's pending).
+        """
+        now = time()
+        with self._transaction() as db:
+            row = db.execute("SELECT id, state FROM jobs WHERE location = ? AND node = ? AND state IN ('pending', 'running') ORDER BY id DESC LIMIT 1",
+                             (location, node)).fetchone()
+            if row:
+                job_id = row[0]
+                if row[1] != "pending":
+                    return job_id
+            else:
+                job_id = db.execute("INSERT INTO jobs (location, node, priority, state, not_before, enqueued) VALUES (?, ?, ?, 'pending', ?, ?)",
+                                    (location, node, priority, now, now)).lastrowid
+            db.executemany("INSERT OR IGNORE INTO after (job, after) VALUES (?, ?)", ((job_id, a) for a in after if a != job_id))
+        return job_id
+
+    def latest(self, location):
+        """ {node: Latest} of the latest job of each of location's nodes """
+        rows = self._db.execute("SELECT node, id, state, signature FROM jobs WHERE id IN (SELECT MAX(id) FROM jobs WHERE location = ? GROUP BY node)",
+                                (location,))
+        return {node: Latest(job_id, state, signature) for node, job_id, state, signature in rows}
+
+    def claim(self, worker):
+        """ Return the highest priority Job that's ready (the jobs it's after are done), leased to worker. None if there's none """
+        now = time()
+        with self._transaction() as db:
+            self._expire(db, now)
+            self._fail_dependants(db, now)
+            row = db.execute("""
+                SELECT id, location, node, priority, attempts FROM jobs
+                WHERE state = 'pending' AND not_before <= ?
+                AND NOT EXISTS (SELECT 1 FROM after JOIN jobs AS a ON a.id = after.after WHERE after.job = jobs.id AND a.state != 'done')
+                ORDER BY priority, id LIMIT 1""", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, started = ?, error = NULL WHERE id = ?",
+                       (worker, now + self.lease, now, row[0]))
+        job = Job(row[0], row[1], row[2], row[3], row[4] + 1)
+        LOGGER.debug(f"{worker} claimed {job}")
+        return job
+
+    def heartbeat(self, job, worker):
+        """ Renew worker's lease of job. Return False if it's lost it (e.g. it expired and was claimed by another) """
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                              (time() + self.lease, job.id, worker)).rowcount == 1
+
+    def done(self, job, worker, signature=None):
+        """ Record that worker has run job. signature: of the node's paths after it ran (see digest()), for the planner """
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'done', finished = ?, signature = ?, lease_until = NULL WHERE id = ? AND worker = ? AND state = 'running'",
+                              (time(), signature, job.id, worker)).rowcount == 1
+
+    def fail(self, job, worker, error):
+        """ Record that job failed: retry it later, unless it's had max_attempts """
+        now = time()
+        with self._transaction() as db:
+            if job.attempts < self.max_attempts:
+                return db.execute("UPDATE jobs SET state = 'pending', not_before = ?, error = ?, worker = NULL, lease_until = NULL WHERE id = ? AND worker = ? AND state = 'running'",
+                                  (now + self.retry_delay * job.attempts, str(error), job.id, worker)).rowcount == 1
+            return db.execute("UPDATE jobs SET state = 'failed', finished = ?, error = ?, lease_until = NULL WHERE id = ? AND worker = ? AND state = 'running'",
+                              (now, str(error), job.id, worker)).rowcount == 1
+
+    def release(self, job, worker):
+        """ Return job, not run (e.g. as worker is stopping), for another worker to claim. It's not counted as an attempt """
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'pending', attempts = attempts - 1, worker = NULL, lease_until = NULL WHERE id = ? AND worker = ? AND state = 'running'",
+                              (job.id, worker)).rowcount == 1
+
+    def counts(self):
+        """ {state: number of jobs} """
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+        return counts
+
+    def purge(self, before):
+        """ Remove jobs finished before (a time()), except each node's latest, which the planner compares with """
+        with self._transaction() as db:
+            n = db.execute("""DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?
+                              AND id NOT IN (SELECT MAX(id) FROM jobs GROUP BY location, node)""", (before,)).rowcount
+            db.execute("DELETE FROM after WHERE job NOT IN (SELECT id FROM jobs) OR after NOT IN (SELECT id FROM jobs)")
+        return n
+
+    def _expire(self, db, now):
+        """ Retry (or fail, after max_attempts) running jobs whose leases have expired """
+        for job_id, node, worker, attempts in db.execute("SELECT id, node, worker, attempts FROM jobs WHERE state = 'running' AND lease_until < ?", (now,)).fetchall():
+            LOGGER.warning(f"Lease of {node} (job {job_id}) by {worker} expired after {attempts} attempts")
+            if attempts < self.max_attempts:
+                db.execute("UPDATE jobs SET state = 'pending', not_before = ?, worker = NULL, lease_until = NULL, error = 'lease expired' WHERE id = ?", (now, job_id))
+            else:
+                db.execute("UPDATE jobs SET state = 'failed', finished = ?, lease_until = NULL, error = 'lease expired' WHERE id = ?", (now, job_id))
+
+    @staticmethod
+    def _fail_dependants(db, now):
+        """ Fail pending jobs that are after failed ones, and those after them """
+        while db.execute("""
+                UPDATE jobs SET state = 'failed', finished = ?, error = 'skipped: a job it is after failed'
+                WHERE state = 'pending' AND EXISTS (SELECT 1 FROM after JOIN jobs AS a ON a.id = after.after WHERE after.job = jobs.id AND a.state = 'failed')""",
+                         (now,)).rowcount:
+            pass
+
+
+def digest(signature, root):
+    """ Hash of a node's signature (see tmv.scheduler.signature), with its paths relative to root so it's the same on hosts that mount tmv_root elsewhere """
+    h = hashlib.sha256()
+    for entry in signature:
+        name = entry[0]
+        h.update(repr((os.path.relpath(name, root) if os.path.isabs(name) else name,) + tuple(entry[1:])).encode())
+    return h.hexdigest()
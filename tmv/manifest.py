@@ -0,0 +1,118 @@
+"""
+Manifests: what each output (e.g. daily-videos/2000-01-01.mp4) was made from, to remake it exactly when that changes.
+
+A manifest is a fingerprint of the output's inputs (their names, sizes and mtimes) and the parameters used (e.g. fps
+and encoder), written beside the output (daily-videos/.2000-01-01.mp4.manifest.json) once the output is complete.
+Unlike comparing mtimes, it sees images added to old days (e.g. late uploads from a camera with a skewed clock), and
+an output without a manifest (e.g. a failed encode) is never taken as done.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime as dt
+from pathlib import Path
+
+from tmv.util import str2dt
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def manifest_path(output) -> Path:
+    """ Hidden, beside output """
+    output = Path(output)
+    return output.parent / f".{output.name}{MANIFEST_SUFFIX}"
+
+
+class Manifest:
+    """
+    The inputs (paths) and params (a json-able dict) of output. Its fingerprint is of the inputs when first required:
+    write() it when output is made from them.
+    stat: callable(path) returning (size, mtime_ns), or None if it doesn't exist, e.g. DirIndex.stat. Default: file_stat
+    """
+
+    def __init__(self, output, inputs, params=None, stat=None):
+        self.output = Path(output)
+        self.inputs = sorted(Path(i) for i in inputs)
+        self.params = params or {}
+        self.stat = stat or file_stat
+        self._fingerprint = None
+
+    def __str__(self):
+        return f"Manifest: {self.output} inputs:{len(self.inputs)} fingerprint:{self.fingerprint}"
+
+    @property
+    def path(self) -> Path:
+        return manifest_path(self.output)
+
+    @property
+    def fingerprint(self) -> str:
+        if self._fingerprint is None:
+            h = hashlib.sha256(json.dumps(self.params, sort_keys=True, default=str).encode())
+            for i in self.inputs:
+                # relative, so the location can move
+                st = self.stat(i)
+                h.update(f"{os.path.relpath(i, self.output.parent)}\0{st[0]}\0{st[1]}\n".encode() if st else
+                         f"{os.path.relpath(i, self.output.parent)}\0missing\n".encode())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def read(self):
+        """ The recorded fingerprint, or None """
+        try:
+            return json.loads(self.path.read_text())['fingerprint']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def fresh(self, adopt=True) -> bool:
+        """
+        True if output exists and was made from the same inputs and params.
+        adopt: take an output without a manifest (made before manifests) as fresh if it's newer than its inputs, and write its manifest
+        """
+        if not self.output.exists():
+            return False
+        recorded = self.read()
+        if recorded is not None:
+            return recorded == self.fingerprint
+        if adopt and self.output.stat().st_size > 0 and self.inputs:
+            newest = max((st[1] for st in map(self.stat, self.inputs) if st), default=None)
+            if newest is not None and self.output.stat().st_mtime_ns >= newest:
+                LOGGER.debug(f"Adopting {self.output}: newer than its inputs")
+                self.write()
+                return True
+        return False
+
+    def write(self):
+        """ Record that output was made from the inputs. Atomic, so a manifest is never partial. """
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps({'fingerprint': self.fingerprint, 'inputs': len(self.inputs), 'params': self.params,
+                                   'written': dt.now().isoformat(timespec="seconds")}, indent=1, default=str))
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def file_stat(path):
+    """ (size, mtime_ns) of path, or None if it doesn't exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def by_day(paths, day):
+    """ {date (or None): [paths]} of paths grouped by day(path) (e.g. its parent dir's name) parsed as a date """
+    days = {}
+    for p in paths:
+        d = str2dt(day(p), throw=False)
+        days.setdefault(d.date() if d else None, []).append(p)
+    return days
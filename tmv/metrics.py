@@ -0,0 +1,150 @@
+"""
+Metrics of videod's runs, to see which location (camera) and task is using the host: for each task, the nodes run
+(and failed), their wall time, the cpu time of the ffmpeg jobs they ran, frames processed, bytes written and files
+scanned.
+
+What does the work (e.g. JobRunner, DirIndex) record() counts into the Meter of the node running in its thread
+(see metering()). After each run, the TaskRunner writes its tasks' Meters:
+- to a rolling history in the location: .videod-metrics.json, of the last 'history' runs
+- as a Prometheus textfile, tmv-videod-<location>.prom, if textfile_dir is set (e.g. node_exporter's
+  --collector.textfile.directory)
+
+ [metrics]
+ textfile_dir = "/var/lib/node_exporter/textfile_collector"
+ history = 100
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime as dt
+from pathlib import Path
+from time import time
+
+from tmv.util import Tomlable, slugify
+
+LOGGER = logging.getLogger(__name__)
+
+# field: Prometheus metric (with a 'location' and 'task' label), and its help
+FIELDS = {
+    'nodes': ("tmv_videod_task_nodes", "Nodes of the task run in its last run"),
+    'failed': ("tmv_videod_task_failed_nodes", "Nodes of the task that failed in its last run"),
+    'wall_seconds': ("tmv_videod_task_wall_seconds", "Wall time of the task's nodes in its last run"),
+    'cpu_seconds': ("tmv_videod_task_cpu_seconds", "CPU time (user and system) of the ffmpeg jobs of the task's last run"),
+    'frames': ("tmv_videod_task_frames", "Frames processed by the ffmpeg jobs of the task's last run"),
+    'bytes_written': ("tmv_videod_task_bytes_written", "Bytes of outputs written by the ffmpeg jobs of the task's last run"),
+    'files_scanned': ("tmv_videod_task_files_scanned", "Directory entries listed by the task's last run"),
+}
+
+_local = threading.local()
+
+
+class Meter:
+    """ Counts (see FIELDS) of a task's run. Safe to share between threads """
+
+    def __init__(self):
+        self.counts = dict.fromkeys(FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        c = self.counts
+        return (f"{c['nodes']} nodes ({c['failed']} failed), {c['wall_seconds']:.1f}s wall, {c['cpu_seconds']:.1f}s cpu, "
+                f"{c['frames']} frames, {c['bytes_written'] / 2 ** 20:.1f}MB written, {c['files_scanned']} files scanned")
+
+    def add(self, **counts):
+        with self._lock:
+            for field, n in counts.items():
+                self.counts[field] += n
+
+    def as_dict(self):
+        with self._lock:
+            return {field: round(n, 3) if isinstance(n, float) else n for field, n in self.counts.items()}
+
+
+@contextmanager
+def metering(meter):
+    """ record() into meter in this thread, until the context exits """
+    previous = getattr(_local, "meter", None)
+    _local.meter = meter
+    try:
+        yield meter
+    finally:
+        _local.meter = previous
+
+
+def record(**counts):
+    """ Add counts (see FIELDS) to this thread's Meter, if it's metering() """
+    meter = getattr(_local, "meter", None)
+    if meter is not None:
+        meter.add(**counts)
+
+
+class Metrics(Tomlable):
+    """
+    Where to write the TaskRunners' Meters after each run
+    """
+
+    FILENAME = ".videod-metrics.json"
+
+    def __init__(self):
+        super().__init__()
+        self.textfile_dir = None  # for Prometheus
+        self.history = 100  # runs kept in each location's history. 0 for none
+
+    def __str__(self):
+        return f"Metrics: textfile_dir:{self.textfile_dir} history:{self.history}"
+
+    def configd(self, config_dict):
+        self.setattr_from_dict("textfile_dir", config_dict)
+        self.setattr_from_dict("history", config_dict)
+
+    def write(self, location, path, meters):
+        """ Record a run of location (in directory path): {task: Meter} """
+        run = {'time': dt.now().isoformat(timespec="seconds"), 'tasks': {task: m.as_dict() for task, m in meters.items()}}
+        try:
+            if self.history:
+                self.write_history(Path(path) / self.FILENAME, run)
+            if self.textfile_dir:
+                self.write_textfile(location, run)
+        except OSError as exc:
+            LOGGER.warning(f"Can't write metrics of {path}: {exc}")
+
+    def write_history(self, filename, run):
+        """ Append run to the history in filename, keeping the last 'history' runs. Locked, as workers may share it """
+        with open(filename, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                runs = json.loads(f.read() or "[]")
+            except ValueError:
+                LOGGER.warning(f"Replacing unreadable metrics history: {filename}")
+                runs = []
+            runs = (runs + [run])[-self.history:]
+            f.seek(0)
+            f.truncate()
+            json.dump(runs, f, indent=1)
+
+    def write_textfile(self, location, run):
+        """ Replace location's Prometheus textfile with run's metrics (atomically, as it may be read at any time) """
+        lines = []
+        for field, (metric, text) in FIELDS.items():
+            lines.append(f"# HELP {metric} {text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for task, counts in run['tasks'].items():
+                lines.append(f'{metric}{{location="{_escape(location)}",task="{_escape(task)}"}} {counts[field]}')
+        lines.append("# HELP tmv_videod_last_run_timestamp_seconds When the location's last run finished")
+        lines.append("# TYPE tmv_videod_last_run_timestamp_seconds gauge")
+        lines.append(f'tmv_videod_last_run_timestamp_seconds{{location="{_escape(location)}"}} {time():.0f}')
+        filename = Path(self.textfile_dir) / f"tmv-videod-{slugify(location) or 'root'}.prom"
+        tmp = filename.with_name(f".{filename.name}.tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        os.replace(tmp, filename)
+
+
+def _escape(label):
+    """ A Prometheus label value """
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
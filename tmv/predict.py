@@ -0,0 +1,121 @@
+"""
+Predict how long an encode will take and how big it'll be, from this host's history of encodes.
+
+The JobRunner records each encode it runs with a job description:
+ (frames, width, height, codec, preset, filters) -> (seconds, bytes)
+Encodes are assumed to cost time and bytes in proportion to their pixels (frames * width * height).
+A prediction uses the median rate of the most similar past encodes: same codec, preset and filters
+if there are any, else same codec and preset, else same codec, else any.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import logging
+import os
+import socket
+import sqlite3
+import statistics
+import threading
+import time
+from pathlib import Path
+from datetime import timedelta
+
+LOGGER = logging.getLogger(__name__)
+
+# recent encodes used for each prediction
+RECENT = 50
+# keys of a job description
+JOB_KEYS = ("frames", "width", "height", "codec", "preset", "filters")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS encodes (
+    host TEXT NOT NULL,
+    at REAL NOT NULL,
+    frames INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    codec TEXT,
+    preset TEXT,
+    filters TEXT,
+    seconds REAL NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS encodes_host_codec ON encodes (host, codec, preset, filters);
+"""
+
+
+def default_history_path() -> Path:
+    """ Per-user history file, e.g. ~/.cache/tmv/encode-history.sqlite """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "tmv" / "encode-history.sqlite"
+
+
+class Estimate:
+    """ Predicted encode seconds and bytes, and how many past encodes it's based on (0: a guess) """
+
+    def __init__(self, seconds, n_bytes, based_on=0):
+        self.seconds = seconds
+        self.bytes = n_bytes
+        self.based_on = based_on
+
+    def __str__(self):
+        return f"{timedelta(seconds=round(self.seconds))} {self.bytes / 1e6:.1f}MB (from {self.based_on} encodes)"
+
+
+class EncodeHistory:
+    """
+    SQLite table of this host's encodes.
+    """
+    # with no history: roughly libx264 veryfast on a small host
+    DEFAULT_SECONDS_PER_MEGAPIXEL = 0.02
+    DEFAULT_BYTES_PER_PIXEL = 0.05
+
+    def __init__(self, path=None, host=None):
+        self.path = Path(path) if path else default_history_path()
+        self.host = host or socket.gethostname()
+        self._db = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"EncodeHistory: {self.path} host:{self.host}"
+
+    @property
+    def db(self):
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def record(self, job, seconds, n_bytes):
+        """ Add an encode. job: dict with JOB_KEYS """
+        with self._lock, self.db:
+            self.db.execute("INSERT INTO encodes VALUES (?,?,?,?,?,?,?,?,?,?)",
+                            (self.host, time.time(), job['frames'], job['width'], job['height'], job.get('codec'),
+                             job.get('preset'), job.get('filters'), seconds, n_bytes))
+
+    def predict(self, job) -> Estimate:
+        """ Estimate for job (a dict with JOB_KEYS) """
+        pixels = job['frames'] * job['width'] * job['height']
+        criteria = [("codec", "preset", "filters"), ("codec", "preset"), ("codec",), ()]
+        with self._lock:
+            for keys in criteria:
+                where = " AND ".join(["host = ?"] + [f"{k} IS ?" for k in keys])
+                rows = self.db.execute(f"SELECT seconds, bytes, frames * width * height FROM encodes WHERE {where} ORDER BY at DESC LIMIT {RECENT}",
+                                       [self.host] + [job.get(k) for k in keys]).fetchall()
+                rows = [r for r in rows if r[2] > 0]
+                if rows:
+                    seconds_per_pixel = statistics.median(r[0] / r[2] for r in rows)
+                    bytes_per_pixel = statistics.median(r[1] / r[2] for r in rows)
+                    return Estimate(seconds_per_pixel * pixels, round(bytes_per_pixel * pixels), len(rows))
+        return self.guess(job)
+
+    @classmethod
+    def guess(cls, job) -> Estimate:
+        """ Estimate for job without any history """
+        pixels = job['frames'] * job['width'] * job['height']
+        return Estimate(cls.DEFAULT_SECONDS_PER_MEGAPIXEL * pixels / 1e6, round(cls.DEFAULT_BYTES_PER_PIXEL * pixels))
@@ -0,0 +1,172 @@
+"""
+Retention of daily-photos, so they don't fill the disk and slow every scan. As a day ages (in days before the
+location's latest day), its images go through tiers, each from its 'days' on:
+- "downscale": to at most 'width' pixels wide (JPEG 'quality')
+- "thin": keep only every 'every'th image
+- "archive": bundle the day's dir into daily-photos/YYYY-MM-DD.tar (or 'format' "zip") and remove it. See restore()
+
+The tiers applied to a day are recorded in its .retention.json. The CleanupTask (see tmv.videod) applies them, limiting
+the bytes read and written by all its nodes to io_rate MB/s.
+
+ [cleanup]
+ tiers = [
+     {days = 30, action = "downscale", width = 1280},
+     {days = 90, action = "thin", every = 3},
+     {days = 365, action = "archive", format = "tar"},
+ ]
+ io_rate = 20
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import zipfile
+from pathlib import Path
+from time import monotonic, sleep
+
+from PIL import Image
+
+from tmv.exceptions import ConfigError
+
+LOGGER = logging.getLogger(__name__)
+
+ACTIONS = ("downscale", "thin", "archive")
+ARCHIVE_FORMATS = ("tar", "zip")
+STATE_FILENAME = ".retention.json"
+
+
+def check_tiers(tiers):
+    """ Raise ConfigError if tiers (a list of dicts, as per [cleanup] tiers) aren't valid """
+    for tier in tiers:
+        if tier.get('action') not in ACTIONS:
+            raise ConfigError(f"action must be one of {ACTIONS} in {tier}")
+        if not isinstance(tier.get('days'), int) or tier['days'] < 1:
+            raise ConfigError(f"Need 'days' of 1 or more (the latest day is never cleaned up) in {tier}")
+        if tier['action'] == "downscale" and not (isinstance(tier.get('width'), int) and tier['width'] > 0):
+            raise ConfigError(f"Need a 'width' in pixels to downscale to in {tier}")
+        if tier['action'] == "thin" and not (isinstance(tier.get('every'), int) and tier['every'] > 0):
+            raise ConfigError(f"Need 'every' (keep every nth image) in {tier}")
+        if tier['action'] == "archive" and tier.get('format', "tar") not in ARCHIVE_FORMATS:
+            raise ConfigError(f"format must be one of {ARCHIVE_FORMATS} in {tier}")
+    every = 1
+    for tier in sorted((t for t in tiers if t['action'] == "thin"), key=lambda t: t['days']):
+        # each thins what the one before kept
+        if tier['every'] % every:
+            raise ConfigError(f"Each thin tier's 'every' must be a multiple of the previous one's ({every}) in {tier}")
+        every = tier['every']
+
+
+class RateLimiter:
+    """ Limit the bytes per second that threads consume() (None for no limit). Safe to share between threads """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next = 0  # when the bytes consumed so far are paid for
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """ Wait until n more bytes are within the rate """
+        if not self.rate:
+            return
+        with self._lock:
+            now = monotonic()
+            start = max(self._next, now)
+            self._next = start + n / self.rate
+        if start > now:
+            sleep(start - now)
+
+
+def read_state(day_dir):
+    """ Tiers applied to day_dir: {'downscale': width, 'every': n} """
+    try:
+        return json.loads((Path(day_dir) / STATE_FILENAME).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(day_dir, state):
+    path = Path(day_dir) / STATE_FILENAME
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, path)
+
+
+def due(tiers, age, state):
+    """ The tiers that day of age (days) has reached and that aren't applied (as per its state) """
+    applied = {'downscale': lambda t: state.get('downscale') is not None and state['downscale'] <= t['width'],
+               'thin': lambda t: state.get('every', 1) >= t['every'],
+               'archive': lambda t: False}
+    return [t for t in tiers if age >= t['days'] and not applied[t['action']](t)]
+
+
+def downscale_image(path, width, quality=90, limiter=None):
+    """ Replace the image at path with one at most width pixels wide, keeping its mtime. Return True if it was reduced """
+    path = Path(path)
+    limiter = limiter or RateLimiter()
+    st = path.stat()
+    limiter.consume(st.st_size)
+    tmp = path.with_name(f".{path.name}.tmp")
+    try:
+        with Image.open(path) as im:
+            if im.width <= width:
+                return False
+            exif = im.info.get('exif')
+            reduced = im.resize((width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+            reduced.save(tmp, format=im.format, quality=quality, **({'exif': exif} if exif else {}))
+    except OSError as exc:
+        LOGGER.warning(f"Not downscaling {path}: {exc}")
+        tmp.unlink(missing_ok=True)
+        return False
+    limiter.consume(tmp.stat().st_size)
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, path)
+    return True
+
+
+def thinned(images, every):
+    """ The images (sorted by time) to remove to keep only every nth """
+    return [p for i, p in enumerate(sorted(images)) if i % every]
+
+
+def archive_day(day_dir, fmt="tar", limiter=None):
+    """ Bundle day_dir (e.g. daily-photos/2000-01-01) into daily-photos/2000-01-01.tar (or .zip) and remove it. Return the bundle """
+    day_dir = Path(day_dir)
+    limiter = limiter or RateLimiter()
+    bundle = day_dir.with_name(f"{day_dir.name}.{fmt}")
+    tmp = bundle.with_name(f".{bundle.name}.tmp")
+    files = sorted(p for p in day_dir.rglob("*") if p.is_file())
+    if fmt == "zip":
+        # JPEGs don't compress
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as z:
+            for p in files:
+                limiter.consume(2 * p.stat().st_size)
+                z.write(p, p.relative_to(day_dir.parent))
+    else:
+        with tarfile.open(tmp, "w") as t:
+            for p in files:
+                limiter.consume(2 * p.stat().st_size)
+                t.add(p, str(p.relative_to(day_dir.parent)))
+    os.replace(tmp, bundle)
+    shutil.rmtree(day_dir)
+    return bundle
+
+
+def restore(bundle):
+    """ Extract an archive_day() bundle back into its day dir (e.g. to remake outputs from it), and remove it. Return the day dir """
+    bundle = Path(bundle)
+    day_dir = bundle.with_suffix("")
+    if bundle.suffix == ".zip":
+        with zipfile.ZipFile(bundle) as z:
+            z.extractall(bundle.parent)
+    else:
+        with tarfile.open(bundle) as t:
+            for member in t.getmembers():
+                if not (member.isfile() or member.isdir()) or Path(member.name).parts[0] != day_dir.name or ".." in Path(member.name).parts:
+                    raise ValueError(f"Not a bundle of {day_dir.name}: {member.name}")
+            t.extractall(bundle.parent)  # nosec: checked above
+    bundle.unlink()
+    return day_dir
@@ -0,0 +1,180 @@
+"""
+Run a location's tasks as a graph of nodes, instead of one after another.
+
+Each node is a task's work (or part of it, e.g. one day of daily-videos) with the paths it reads (inputs)
+and writes (outputs):
+
+ daily-photos/2000-01-01 -> [daily 2000-01-01] -> daily-videos/2000-01-01.mp4 --+
+ daily-photos/2000-01-02 -> [daily 2000-01-02] -> daily-videos/2000-01-02.mp4 --+-> [recap] -> recap-videos
+ daily-photos            -> [diagonal] -> diagonal-videos -> [preview diagonal-videos]
+
+A node depends on the nodes of higher priority (smaller number) tasks that write to its inputs.
+Ready nodes run concurrently, each holding its task's 'cpus' of a CpuBudget (which can be shared between
+locations). A node is skipped if a node it depends on failed, or if its inputs and outputs are unchanged
+since it last succeeded.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import logging
+import os
+import threading
+from pathlib import Path
+from stat import S_ISDIR
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Node:
+    """
+    A unit of work: call run() to read inputs and write outputs (lists of Paths: files or directories).
+    A node that doesn't declare inputs always runs, after the nodes of higher priority tasks.
+    """
+
+    def __init__(self, name, task, run, inputs=(), outputs=()):
+        self.name = name
+        self.task = task
+        self.run = run
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+
+    def __str__(self):
+        return f"Node: {self.name}"
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def priority(self):
+        return self.task.priority
+
+    @property
+    def cpus(self):
+        return getattr(self.task, "cpus", 1)
+
+    def signature(self, index=None):
+        """ Summary of the inputs' and outputs' state (see signature()), or None if the inputs aren't known """
+        if not self.inputs:
+            return None
+        return signature(self.inputs + self.outputs, index)
+
+
+def overlap(a: Path, b: Path) -> bool:
+    """ True if a and b are the same path, or one is under the other """
+    return a == b or a in b.parents or b in a.parents
+
+
+def dependencies(nodes):
+    """ {node: set of the nodes it depends on}: those of higher priority writing to its inputs """
+    return {n: {d for d in nodes if d.priority < n.priority and any(overlap(o, i) for o in d.outputs for i in n.inputs)}
+            for n in nodes}
+
+
+def affected(depends, changed):
+    """ The nodes (of depends: see dependencies()) reading any of the changed paths, and those depending on them """
+    changed = [Path(c) for c in changed]
+    nodes = {n for n in depends if any(overlap(c, i) for c in changed for i in n.inputs)}
+    added = nodes
+    while added:
+        added = {n for n, ds in depends.items() if n not in nodes and ds & nodes}
+        nodes |= added
+    return nodes
+
+
+def signature(paths, index=None):
+    """
+    Hashable state of paths: for each file, its mtime and size, and for each directory, those of its entries.
+    Cheap (no recursion), and changes when files are added, removed or replaced in the directory, or when
+    files are added to its subdirectories. Hidden entries (videod's: e.g. manifests, locks and metrics) are ignored.
+    index: a DirIndex to list directories with, instead of scanning them each time
+    """
+    if index:
+        return _indexed_signature(paths, index)
+    sig = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            sig.append((str(p), None))
+            continue
+        if not S_ISDIR(st.st_mode):
+            sig.append((str(p), st.st_mtime_ns, st.st_size))
+        else:
+            sig.append((str(p), "dir"))
+            entries = []
+            with os.scandir(p) as it:
+                for e in it:
+                    if e.name.startswith("."):
+                        continue
+                    try:
+                        est = e.stat(follow_symlinks=False)
+                        entries.append((e.path, est.st_mtime_ns, est.st_size))
+                    except OSError:
+                        pass  # removed since listed
+            sig.extend(sorted(entries))
+    return tuple(sig)
+
+
+def _indexed_signature(paths, index):
+    sig = []
+    for p in paths:
+        listing = index.listing(p)
+        if not listing:
+            sig.append((str(p), index.stat(p)))
+        else:
+            sig.append((str(p), "dir"))
+            for name, (is_dir, size, mtime_ns) in sorted(listing.entries.items()):
+                if name.startswith("."):
+                    continue
+                if is_dir:
+                    # subdirectories' mtimes change without p's: check them
+                    sig.append((name, index.stat(listing.path / name)))
+                elif name in listing.unsettled:
+                    # changing as p was listed (e.g. being uploaded): as it is now
+                    sig.append((name, *(index.stat(listing.path / name) or (None, None))))
+                else:
+                    sig.append((name, size, mtime_ns))
+    return tuple(sig)
+
+
+class CpuBudget:
+    """
+    Number of cpus that running nodes can hold. Nodes needing more than the whole budget run on their own.
+    """
+
+    def __init__(self, cpus=1):
+        self.cpus = cpus
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        return f"CpuBudget: {self._used}/{self.cpus} used"
+
+    def acquire(self, n):
+        n = min(n, self.cpus)
+        with self._cond:
+            self._cond.wait_for(lambda: self._used + n <= self.cpus)
+            self._used += n
+        return n
+
+    def release(self, n):
+        with self._cond:
+            self._used -= n
+            self._cond.notify_all()
+
+    def hold(self, n):
+        """ Context manager holding n cpus """
+        return _Held(self, n)
+
+
+class _Held:
+    def __init__(self, budget, n):
+        self.budget = budget
+        self.n = n
+
+    def __enter__(self):
+        self.n = self.budget.acquire(self.n)
+        return self
+
+    def __exit__(self, *exc):
+        self.budget.release(self.n)
+        return False
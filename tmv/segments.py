@@ -0,0 +1,195 @@
+"""
+Build a video incrementally from segments, instead of re-encoding all its frames on each update.
+
+Each update encodes only the frames added since the last one into a new segment, then stream-copies
+(concat, "-c copy") the segments into the video. A manifest in the segments dir records the encoder
+parameters, the timing (fps and PTS factor: worked out from the whole video when the first segment is encoded, and
+used for every segment, so they play at one frame rate) and each segment's frames. If the parameters change, or a frame arrives out of order
+(i.e. before the end of an existing segment), the affected segments are re-encoded.
+
+Each segment is a separate encode, so starts with a keyframe, and segments encoded with identical
+parameters (including the encoder profile: see tmv.encoders) can be copied together. Filters that smooth over
+neighbouring frames would restart at each segment, so the ffmpeg deflicker filter and motion blur aren't allowed.
+The "numpy" deflicker's gains are worked out with the frames before each segment, as if over the whole video.
+
+ daily-videos/
+    2000-01-01.mp4
+    .segments/2000-01-01/manifest.json
+                        /00000.mp4
+                        /00001.mp4
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from tmv.deflicker import Deflicker
+from tmv.encoders import encoder_profile
+from tmv.exceptions import VideoMakerError
+from tmv.ffrunner import run_ffmpeg
+from tmv.util import dt2str, unlink_safe
+from tmv.video import VideoMaker, output_format_parameters, output_path
+
+LOGGER = logging.getLogger(__name__)
+
+SEGMENTS_DIR = ".segments"
+# a single new frame can't be encoded alone: re-encode it with the last segment
+MIN_SEGMENT_FRAMES = 2
+
+
+class SegmentManifest:
+    """
+    A video's segments: the encoder parameters, their timing and, for each segment, its file, number of frames and last frame
+    """
+    FILENAME = "manifest.json"
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.params = None
+        self.timing = None  # {'fps', 'pts_factor'} of every segment
+        self.segments = []
+
+    def __str__(self):
+        return f"SegmentManifest: {self.directory} segments:{len(self.segments)} frames:{self.n_frames}"
+
+    @property
+    def n_frames(self):
+        return sum(s['n_frames'] for s in self.segments)
+
+    @classmethod
+    def load(cls, directory):
+        """ Read the manifest in directory, or return an empty one """
+        manifest = cls(directory)
+        try:
+            with open(manifest.directory / cls.FILENAME) as f:
+                d = json.load(f)
+            manifest.params = d['params']
+            manifest.timing = d.get('timing')
+            manifest.segments = d['segments']
+        except (OSError, ValueError, KeyError) as exc:
+            LOGGER.debug(f"New manifest in {directory}: {exc}")
+        return manifest
+
+    def save(self):
+        """ Write atomically, so an interrupted update leaves the previous manifest """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.directory / (self.FILENAME + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({'params': self.params, 'timing': self.timing, 'segments': self.segments}, f, indent=1)
+        os.replace(tmp, self.directory / self.FILENAME)
+
+    def plan(self, names, params):
+        """
+        Drop segments that don't match names (the video's frames, in order) or params.
+        Return the index of the first frame to encode into a new segment.
+        """
+        if params != self.params:
+            self.params = params
+            self.drop(0)
+        done = 0
+        for i, segment in enumerate(self.segments):
+            last = done + segment['n_frames'] - 1
+            if last >= len(names) or names[last] != segment['last'] or not (self.directory / segment['file']).is_file():
+                self.drop(i)
+                break
+            done = last + 1
+        if done < len(names) < done + MIN_SEGMENT_FRAMES and self.segments:
+            done -= self.segments[-1]['n_frames']
+            self.drop(len(self.segments) - 1)
+        return done
+
+    def drop(self, i):
+        """ Remove segments i onwards """
+        if i == 0:
+            self.timing = None
+        for segment in self.segments[i:]:
+            unlink_safe(self.directory / segment['file'])
+        del self.segments[i:]
+
+    def add(self, names):
+        """ Add a segment of names (after those already added). Return its path, to be encoded. """
+        filename = f"{len(self.segments):05d}{VideoMaker.VIDEO_SUFFIX}"
+        self.segments.append({'file': filename, 'n_frames': len(names), 'last': names[-1]})
+        return self.directory / filename
+
+    def concat(self, filename, description, output_format="mp4"):
+        """ Stream-copy the segments into filename """
+        list_filename = self.directory / "segments.txt"
+        with open(list_filename, "w") as f:
+            f.write("# Auto-generated\n")
+            for segment in self.segments:
+                f.write(f"file '{segment['file']}'\n")
+        the_call = ["ffmpeg", "-hide_banner", "-y", "-f", "concat", "-safe", "0", "-i", str(list_filename), "-c", "copy",
+                    "-metadata", "author=TimeMakeVisible", "-metadata", f"description={description}"]
+        the_call.extend(output_format_parameters(filename, output_format, copy=True))
+        the_call.append(output_path(filename, output_format))
+        try:
+            run_ffmpeg(the_call, log_filename=Path(str(filename) + ".log"), outputs=[output_path(filename, output_format)], atomic=True)
+        finally:
+            unlink_safe(list_filename)
+
+
+def segments_dir(filename):
+    """ Where the segments of filename are kept """
+    filename = Path(filename)
+    return filename.parent / SEGMENTS_DIR / filename.stem
+
+
+def remove_segments(filename):
+    """ Remove the segments of filename, e.g. once it's complete """
+    shutil.rmtree(segments_dir(filename), ignore_errors=True)
+
+
+def deflicker_gains(video, start):
+    """ Deflicker gains of video's frames from start on, as if measured over all its frames """
+    taken = np.asarray(video.images.taken, dtype="datetime64[us]")
+    # only frames within half a window affect each frame's gain
+    first = int(np.searchsorted(taken, taken[start] - np.timedelta64(video.deflicker_window, "us") / 2))
+    context = video[first:]
+    return Deflicker.from_frames(context.images.filenames, context.images.taken, video.deflicker_window, video.catalog).gains[start - first:]
+
+
+def write_video_incremental(video, filename, output_format="mp4", **kwargs):
+    """
+    Write video to filename, encoding only the frames added since the last call.
+    kwargs are passed to Video.write_video and must be the same each call, or all frames are re-encoded.
+    Renditions aren't supported: make previews of filename with the PreviewVideosTask.
+    """
+    if kwargs.get('vsync', "cfr-even") != "cfr-even":
+        raise VideoMakerError("Incremental videos require vsync=cfr-even")
+    if kwargs.get('deflicker', "ffmpeg") == "ffmpeg":
+        raise VideoMakerError("Incremental videos can't use the ffmpeg deflicker filter, which restarts at each segment: use \"numpy\" or \"none\"")
+    if kwargs.get('motion_blur') not in (None, False, "none"):
+        raise VideoMakerError(f"Incremental videos can't use motion blur, which restarts at each segment, not {kwargs['motion_blur']}")
+    names = [os.path.basename(f) for f in video.images.filenames]
+    params = {k: v for k, v in sorted(kwargs.items()) if k not in ('force', 'dry_run', 'renditions', 'encoder')}
+    params['encoder'] = encoder_profile(kwargs.get('encoder')).as_dict()
+    params['blur_frames'] = video.blur_frames
+    params['deflicker_window'] = video.deflicker_window
+    params = json.loads(json.dumps(params, default=str))  # as read back from the manifest
+    manifest = SegmentManifest.load(segments_dir(filename))
+    done = manifest.plan(names, params)
+    if manifest.timing is None and manifest.segments:
+        # encoded before timings were recorded
+        manifest.drop(0)
+        done = 0
+    if done < len(names):
+        segment = video[done:]
+        if kwargs['deflicker'] == "numpy":
+            segment.deflicker_gains = deflicker_gains(video, done)
+        segment_path = manifest.add(names[done:])
+        LOGGER.info(f"Encoding frames {done}-{len(names) - 1} of {filename} to {segment_path}")
+        manifest.directory.mkdir(parents=True, exist_ok=True)
+        if manifest.timing is None:
+            fps, pts_factor, _ = video.timing(kwargs.get('fps'), kwargs.get('speedup'))
+            manifest.timing = {'fps': fps, 'pts_factor': pts_factor}
+        segment.write_video(str(segment_path), force=True, **dict(kwargs, **manifest.timing))
+    manifest.save()
+    LOGGER.debug(manifest)
+    manifest.concat(filename, f"{dt2str(video.stats['earliest'])},{video.duration_real().total_seconds():.0f}", output_format)
+    return output_path(filename, output_format)
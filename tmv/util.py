@@ -1,6 +1,7 @@
 
 # pylint: disable=line-too-long, logging-fstring-interpolation, dangerous-default-value, logging-not-lazy
 
+import re
 from re import search, sub
 from pathlib import Path
 from collections import Counter
@@ -175,38 +176,96 @@ def dt2iso(d):
     return local_time.isoformat()
 
 
+# str2dt fast path: TMV's own DATETIME_FORMAT names, e.g. "2000-01-31T23-59-59.jpg"
+_DATETIME_FORMAT_RX = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2})-(\d{2})-(\d{2})")
+_NON_DIGITS_RX = re.compile(r"\D+")
+
+
 def str2dt(filename: str, throw=True) -> dt:
     """Returns the datetime of string.
        Uses first 14 digits = 4,2,2,2,2,2 and ignores non-digits.
        Expects RFC3399 order of %Y%m%d%H%M%S
        If no time is given, 00:00:00 is returned as the datetime's time.
+       TMV's own DATETIME_FORMAT is recognised by fixed offsets; other strings fall back to a digit scan.
       """
-    datetime_pattern = '%Y%m%d%H%M%S'
-    datetime_length = 14
-    date_pattern = "%Y%m%d"
-    date_length = 8
-    datetime_digits = ''
-    date_digits = ''
-
-    for c in os.path.basename(filename):
-        if c.isdigit():
-            datetime_digits = datetime_digits + c
-    datetime_digits = datetime_digits[0:datetime_length]
-    date_digits = datetime_digits[0:date_length]
+    basename = os.path.basename(filename)
+    match = _DATETIME_FORMAT_RX.match(basename)
+    if match:
+        try:
+            return dt(*map(int, match.groups()))
+        except ValueError:
+            pass  # let the generic scan decide (and raise) as usual
+    datetime_digits = _NON_DIGITS_RX.sub("", basename)[0:14]
+    if len(datetime_digits) == 14:
+        try:
+            return dt(int(datetime_digits[0:4]), int(datetime_digits[4:6]), int(datetime_digits[6:8]),
+                      int(datetime_digits[8:10]), int(datetime_digits[10:12]), int(datetime_digits[12:14]))
+        except ValueError:
+            pass
+    return _str2dt_strptime(datetime_digits, throw)
+
+
+def _str2dt_strptime(datetime_digits: str, throw=True) -> dt:
+    """ Slow path of str2dt: strptime allows variable width fields and date-only strings """
     try:
-        file_datetime = dt.strptime(datetime_digits, datetime_pattern)
-        return file_datetime
+        return dt.strptime(datetime_digits, '%Y%m%d%H%M%S')
     except ValueError:
         try:
-            # LOGGER.warning(e)
-            file_date_only = dt.strptime(date_digits, date_pattern)
-            return file_date_only
+            return dt.strptime(datetime_digits[0:8], "%Y%m%d")
         except ValueError:
             if throw:
                 raise
             return None
 
 
+# str2dt_array: where the separators are in DATETIME_FORMAT; all other columns are digits
+_DATETIME_SEPARATOR_COLUMNS = {4: "-", 7: "-", 10: "T", 13: "-", 16: "-"}
+
+
+def str2dt_array(filenames):
+    """
+    Bulk str2dt: return a numpy datetime64[s] array of the filenames' datetimes. NaT where unparseable.
+    Names in TMV's DATETIME_FORMAT are parsed vectorised; others use str2dt one by one.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    basenames = [str(f).rpartition(os.sep)[2] for f in filenames]
+    n = len(basenames)
+    result = np.full(n, np.datetime64("NaT"), dtype="datetime64[s]")
+    if n == 0:
+        return result
+    # Fixed width code points: "YYYY-MM-DDTHH-MM-SS" is 19 characters (shorter names are zero padded)
+    try:
+        chars = np.array(basenames, dtype="S19").view(np.uint8).reshape(n, 19)
+    except UnicodeEncodeError:
+        chars = np.array(basenames, dtype="U19").view(np.uint32).reshape(n, 19)
+        chars = np.minimum(chars, 0xFF).astype(np.uint8)  # non-latin code points can't be digits or separators
+    # column-major: each character position is contiguous
+    chars = np.ascontiguousarray(chars.T)
+    digits = chars - np.uint8(ord("0"))  # non-digits wrap around to > 9
+    fast = np.ones(n, dtype=bool)
+    for col in range(19):
+        if col in _DATETIME_SEPARATOR_COLUMNS:
+            fast &= chars[col] == ord(_DATETIME_SEPARATOR_COLUMNS[col])
+        else:
+            fast &= digits[col] <= 9
+    digits = digits.astype(np.int32)
+    year = digits[0] * 1000 + digits[1] * 100 + digits[2] * 10 + digits[3]
+    month, day, hour, minute, second = (digits[col] * 10 + digits[col + 1] for col in (5, 8, 11, 14, 17))
+    fast &= (month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & (minute < 60) & (second < 60)
+    months = ((year - 1970) * 12 + (month - 1)).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    # day-of-month overflow (e.g. 02-30) rolls into the next month: leave those to the slow path
+    fast &= days.astype("datetime64[M]") == months
+    seconds = (hour * 3600 + minute * 60 + second).astype("timedelta64[s]")
+    result = np.where(fast, days.astype("datetime64[s]") + seconds, result)
+    for i in np.flatnonzero(~fast):
+        parsed = str2dt(basenames[i], throw=False)
+        if parsed is not None:
+            result[i] = np.datetime64(parsed, "s")
+    return result
+
+
 def today_at(hours, minutes=0, seconds=0):
     return dt.combine(dt.today(), datetime.time(hours, minutes, seconds))
 
@@ -0,0 +1,186 @@
+"""
+Cheap image validity checks, run in parallel and cached between runs.
+
+An image is checked by its markers, not decoded:
+- JPEG: starts with SOI (FF D8 FF) and has an EOI (FF D9) after the start of its image data. Truncated uploads lack the EOI.
+  It's usually the last two bytes, but some cameras append data (e.g. previews or a motion photo's video) after it.
+- PNG: starts with the PNG signature and ends with an IEND chunk.
+- The other formats imghdr recognised (e.g. GIF, TIFF, BMP, WebP) are checked by their header only, as imghdr did.
+
+Results are cached in an SQLite file, keyed by (path, size, mtime_ns), so unchanged images are
+never reopened.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import os
+import logging
+import sqlite3
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+JPEG_SOI = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"IEND\xaeB`\x82"
+HEAD_LENGTH = 32
+# bytes read from the end: allows for some trailing padding after the EOI
+TAIL_LENGTH = 64
+# bytes read at a time when searching further back for the EOI
+EOI_SEARCH_CHUNK = 1 << 16
+# as per imghdr (removed in python 3.13): header checks of the other formats
+HEADER_CHECKS = {
+    'gif': lambda h: h[:6] in (b"GIF87a", b"GIF89a"),
+    'tiff': lambda h: h[:2] in (b"MM", b"II"),
+    'bmp': lambda h: h.startswith(b"BM"),
+    'webp': lambda h: h.startswith(b"RIFF") and h[8:12] == b"WEBP",
+    'exr': lambda h: h.startswith(b"\x76\x2f\x31\x01"),
+    'rgb': lambda h: h.startswith(b"\x01\xda"),
+    'rast': lambda h: h.startswith(b"\x59\xa6\x6a\x95"),
+    'xbm': lambda h: h.startswith(b"#define "),
+    'pnm': lambda h: len(h) >= 3 and h[:1] == b"P" and h[1:2] in b"123456" and h[2:3] in b" \t\n\r",
+}
+# bump when the checks change, to drop results cached by earlier ones
+CHECKS_VERSION = 2
+
+DEFAULT_WORKERS = 8
+
+
+def default_cache_path() -> Path:
+    """ Per-user cache file, e.g. ~/.cache/tmv/image-validity.sqlite """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "tmv" / "image-validity.sqlite"
+
+
+def image_valid(filename) -> bool:
+    """ True if the file looks like a complete JPEG or PNG, or has the header of another image format. Reads little more than its head and tail. """
+    try:
+        with open(filename, "rb") as f:
+            head = f.read(HEAD_LENGTH)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - TAIL_LENGTH))
+            tail = f.read().rstrip(b"\x00")
+            if head.startswith(JPEG_SOI):
+                if size <= len(JPEG_SOI) + len(JPEG_EOI):
+                    return False
+                if tail.endswith(JPEG_EOI):
+                    return True
+                return _jpeg_has_eoi(f, filename, size)
+    except OSError:
+        return False
+    if head.startswith(PNG_SIGNATURE):
+        return tail.endswith(PNG_IEND)
+    return any(check(head) for check in HEADER_CHECKS.values())
+
+
+def _jpeg_has_eoi(f, filename, size) -> bool:
+    """ True if the JPEG open as f has an EOI after the start of its image data (before which, e.g. an EXIF thumbnail's may be) """
+    start = _jpeg_scan_start(f)
+    if start is None:
+        return False
+    # searching back from the end, as trailing data is usually short. Image data can't contain an EOI (FF is followed by 00)
+    end = size
+    while end > start:
+        chunk_start = max(start, end - EOI_SEARCH_CHUNK)
+        f.seek(chunk_start)
+        # overlapping the next chunk by a byte, to find an EOI across them
+        eoi = f.read(end - chunk_start + 1).rfind(JPEG_EOI)
+        if eoi >= 0:
+            LOGGER.debug(f"{filename} has {size - chunk_start - eoi - len(JPEG_EOI)} bytes after its EOI")
+            return True
+        end = chunk_start
+    return False
+
+
+def _jpeg_scan_start(f):
+    """ Offset of the JPEG's image data, after its first SOS segment, or None if the segments before it are broken """
+    f.seek(2)  # after the SOI marker
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return None
+        if header[1] == 0xFF:
+            # fill byte
+            f.seek(-3, os.SEEK_CUR)
+            continue
+        length = int.from_bytes(header[2:], "big")
+        if length < 2:
+            return None
+        if header[1] == 0xDA:
+            return f.tell() - 2 + length
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+class ValidationCache:
+    """
+    Persistent (path, size, mtime_ns) -> valid lookup. Use from a single thread.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else default_cache_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), timeout=30)
+        with self._db:
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != CHECKS_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS validity")
+                self._db.execute(f"PRAGMA user_version = {CHECKS_VERSION}")
+            self._db.execute("CREATE TABLE IF NOT EXISTS validity "
+                             "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, valid INTEGER)")
+
+    def __str__(self):
+        return f"ValidationCache: {self.path}"
+
+    def close(self):
+        self._db.close()
+
+    def get(self, path: str, size: int, mtime_ns: int):
+        """ Return cached validity, or None if unknown or the file has changed """
+        row = self._db.execute("SELECT size, mtime_ns, valid FROM validity WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == size and row[1] == mtime_ns:
+            return bool(row[2])
+        return None
+
+    def put_many(self, entries):
+        """ entries: iterable of (path, size, mtime_ns, valid) """
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO validity (path, size, mtime_ns, valid) VALUES (?, ?, ?, ?)",
+                                 ((p, s, m, int(v)) for p, s, m, v in entries))
+
+
+def _stat_key(filename):
+    """ Return (abspath, size, mtime_ns) or None if the file can't be stat'd """
+    try:
+        st = os.stat(filename)
+        return os.path.abspath(filename), st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+
+def validate_images(filenames, cache=None, workers=DEFAULT_WORKERS):
+    """
+    Return a list of bools, one per filename, from the cache where possible and otherwise
+    by checking the files on a thread pool (overlapping IO, e.g. on network filesystems).
+    cache: a ValidationCache, or None to not cache
+    """
+    filenames = [str(f) for f in filenames]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        keys = list(pool.map(_stat_key, filenames, chunksize=256))
+        results = [None] * len(filenames)
+        to_check = []
+        for i, key in enumerate(keys):
+            if key is None:
+                results[i] = False
+            elif cache is not None:
+                results[i] = cache.get(*key)
+            if results[i] is None:
+                to_check.append(i)
+        checked = list(pool.map(image_valid, (filenames[i] for i in to_check), chunksize=16))
+
+    for i, valid in zip(to_check, checked):
+        results[i] = valid
+    if cache is not None and to_check:
+        cache.put_many((*keys[i], results[i]) for i in to_check)
+    LOGGER.debug(f"Validated {len(filenames)} images: {len(filenames) - len(to_check)} cached, {len(to_check)} checked")
+    return results
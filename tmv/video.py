@@ -44,30 +44,48 @@ import os
 import os.path
 import argparse
 import glob
-import subprocess
+import json
+import tempfile
 from subprocess import CalledProcessError
 from enum import Enum
 import sys
-import itertools
 import logging
-import imghdr
+from time import monotonic
 from signal import signal, SIGINT, SIGTERM
 from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime as dt, timedelta, time
-from nptime import nptime
+import numpy as np
 from dateutil.parser import parse
+import toml
 
-#from tmv.videotools import valid
-from tmv.util import LOG_FORMAT, add_stem_suffix, dt2str, neighborhood
-from tmv.util import LOG_LEVELS, cpe2str, run_and_capture, str2dt, strptimedelta, subprocess_stdout, unlink_safe
+#from tmv.videotools import jerkiness, valid
+from tmv.util import LOG_FORMAT, add_stem_suffix, dt2str
+from tmv.util import LOG_LEVELS, cpe2str, str2dt, str2dt_array, strptimedelta, unlink_safe
 from tmv.config import HH_MM
-from tmv.videotools import valid
-from tmv.exceptions import SignalException, VideoMakerError, ImageError
+from tmv.videotools import jerkiness, valid
+from tmv.catalog import Catalog
+from tmv.framefeed import DEFAULT_READ_AHEAD_MB, FrameBlend, FrameFeed
+from tmv.ffrunner import RUNNER, run_ffmpeg
+from tmv.encoders import DEFAULT_ENCODER, PROFILES, EncoderProfile, available_codecs, configure_encoders, encoder_profile
+from tmv.deflicker import DEFAULT_WINDOW, Deflicker
+from tmv.validation import ValidationCache, default_cache_path, image_valid, validate_images
+from tmv.exceptions import SignalException, VideoMakerError
 
 
 LOGGER = logging.getLogger(__name__)
 
+# how frames are input to ffmpeg: a list file (concat demuxer) or piped (see FrameFeed)
+ENGINES = ("concat", "pipe")
+# ffmpeg's deflicker filter, per-frame gain from brightness (see tmv.deflicker; uses the pipe engine) or none
+DEFLICKERS = ("ffmpeg", "numpy", "none")
+# minterpolate (slow), blend frames with ffmpeg's tmix, blend in numpy (uses the pipe engine), or none
+MOTION_BLURS = ("none", "minterpolate", "tmix", "blend")
+DEFAULT_BLUR_FRAMES = 3
+# mp4: a plain .mp4. fmp4: fragmented .mp4 (moov first: plays before fully downloaded). hls: .m3u8 playlist of fmp4 segments
+OUTPUT_FORMATS = ("mp4", "fmp4", "hls")
+HLS_SEGMENT_SECONDS = 4
 
 class VSyncType(Enum):
     """ ffmpeg vsync selections """
@@ -115,16 +133,8 @@ class VideoMaker:
 
     @staticmethod
     def group_by_day(images):
-        grouped_images = OrderedDict()
-        for day, dayFiles in itertools.groupby(
-                images, lambda x: x.taken.date()):
-            # print ("Day {}".format(day))
-            grouped_images[day] = []
-            for tlf in sorted(dayFiles):
-                grouped_images[day].append(tlf)
-            #    print ("\t{}".format(tlf.filename))
-        # grouped_images = sorted(grouped_images)
-        return grouped_images
+        """ Return an OrderedDict of date: FrameSet """
+        return FrameSet.from_tlfiles(images).group_by("D")
 
     def __init__(self):
         self.videos = []
@@ -132,7 +142,7 @@ class VideoMaker:
         self.fps_requested = None
         self.file_glob = ""
         self._file_list = []
-        self.images = []
+        self.images = FrameSet()
         self.motion = False
         self.start_time = time.min
         self.end_time = time.max
@@ -140,6 +150,11 @@ class VideoMaker:
         self.start = dt.min
         self.end = dt.max
         self.validate_images = True
+        self.validation_cache = default_cache_path()  # None to always re-validate
+        self.catalog = None
+        self.deflicker_window = DEFAULT_WINDOW
+        self.blur_frames = DEFAULT_BLUR_FRAMES
+        self.read_ahead_mb = DEFAULT_READ_AHEAD_MB
 
     def __str__(self):
         return f"{type(self).__name__}: videos:{self.videos}  speedup:{self.speedup}" + \
@@ -161,7 +176,6 @@ class VideoMaker:
         return s
 
     def read_image_times(self):
-        self.images = []
         n_errors = 0
         LOGGER.debug(f"Reading dates of {len(self._file_list)} files...")
         LOGGER.debug(f"start: {self.start} end: {self.end} start_time:{self.start_time} end_time:{self.end_time}")
@@ -169,35 +183,46 @@ class VideoMaker:
         if not self._file_list:
             raise VideoMakerError("No image files found in command-line")
 
-        for fn in self._file_list:
-            # Using second resolution can lead to *variable* intervals. For instance, if the interval is 4.1s,
-            # the durations with be 4/300 (0.0133) but then each 10 frames 5/300
-            # It's therefore better to use constant frame rate, or to adjust this function
-            # to millisecond resolution and/or round
+        # Using second resolution can lead to *variable* intervals. For instance, if the interval is 4.1s,
+        # the durations with be 4/300 (0.0133) but then each 10 frames 5/300
+        # It's therefore better to use constant frame rate, or to adjust this function
+        # to millisecond resolution and/or round
+        taken = str2dt_array(self._file_list).astype("datetime64[us]")
+        for i in np.flatnonzero(np.isnat(taken)):
+            n_errors += 1
             try:
-                datetime_taken = str2dt(fn)
-                if (self.end_time >= datetime_taken.time() >= self.start_time and
-                        self.end >= datetime_taken >= self.start):
-                    tlf = TLFile(fn, datetime_taken)
-                    if self.validate_images:
-                        if tlf.valid():
-                            self.images.append(tlf)
-                        else:
-                            raise ImageError("Invalid image")
-                    else:
-                        self.images.append(tlf)
-            except ImageError as exc:
-                n_errors += 1
-                LOGGER.warning(f"Ignoring {Path(fn).absolute()}: {exc}")
+                str2dt(self._file_list[i])  # raise with the reason
             except Exception as exc:
-                n_errors += 1
-                LOGGER.warning(f"Ignoring exception getting datetime of {Path(fn).absolute()}: {exc}")
+                LOGGER.warning(f"Ignoring exception getting datetime of {Path(self._file_list[i]).absolute()}: {exc}")
+        time_of_day = taken - taken.astype("datetime64[D]")
+        # NaT compares False, so unparsable names drop out here
+        in_range = ((taken >= np.datetime64(self.start, "us")) & (taken <= np.datetime64(self.end, "us")) &
+                    (time_of_day >= time2timedelta64(self.start_time)) & (time_of_day <= time2timedelta64(self.end_time)))
+        in_range_i = np.flatnonzero(in_range)
+        self.images = FrameSet([self._file_list[i] for i in in_range_i], taken[in_range_i])
+
+        if self.validate_images:
+            n_errors += self._remove_invalid_images()
 
         LOGGER.info(f"Got images for {len(self.images)}/{len(self._file_list)} files, and {n_errors} failures")
         if n_errors:
             LOGGER.warning(f"No dates available for {n_errors}/{len(self._file_list)} files. Ignoring them.")
         return self.images.sort()
 
+    def _remove_invalid_images(self):
+        """ Validate self.images in parallel, using the persistent cache if set. Return the number removed. """
+        cache = ValidationCache(self.validation_cache) if self.validation_cache else None
+        filenames = self.images.filenames
+        try:
+            valids = np.array(validate_images(filenames, cache=cache), dtype=bool)
+        finally:
+            if cache:
+                cache.close()
+        for i in np.flatnonzero(~valids):
+            LOGGER.warning(f"Ignoring {Path(filenames[i]).absolute()}: Invalid image")
+        self.images = self.images[valids]
+        return len(valids) - len(self.images)
+
     def files_from_glob(self, file_glob):        
         """
          From a glob-string or list of them, add the filenames of images matching the globs
@@ -214,12 +239,24 @@ class VideoMaker:
         self._file_list.sort()
         LOGGER.debug("Processing %d files" % (len(self._file_list)))
 
+    def files_from_catalog(self, catalog, location=".", subdir=None):
+        """
+         Use the images in a Catalog (instead of globbing), within this maker's start/end and start_time/end_time
+         subdir: e.g. "daily-photos" to restrict to tmv_root/location/subdir
+         """
+        self._file_list, _ = catalog.paths(location, start=self.start, end=self.end, start_time=self.start_time,
+                                           end_time=self.end_time, subdir=subdir)
+        self.file_glob = ""
+        self.catalog = catalog
+        LOGGER.debug("Processing %d files from %s" % (len(self._file_list), catalog))
+
     def load_videos(self):
         del self.videos[:]
         self.read_image_times()
 
     def write_videos(self, filename=None, vsync="cfr-even", speedup=None, fps=None,
-                     force=False, motion_blur=False, dry_run=False):
+                     force=False, motion_blur=False, dry_run=False, engine="concat", deflicker="ffmpeg", renditions=None,
+                     output_format="mp4", encoder=None):
 
         i = 0
         written_filenames = []
@@ -231,9 +268,14 @@ class VideoMaker:
             else:
                 fn = filename
 
+            m.catalog = self.catalog
+            m.deflicker_window = self.deflicker_window
+            m.blur_frames = self.blur_frames
+            m.read_ahead_mb = self.read_ahead_mb
             fn = m.write_video(filename=fn, vsync=vsync, fps=fps, speedup=speedup,
                                motion_blur=motion_blur,
-                               dry_run=dry_run, force=force, )
+                               dry_run=dry_run, force=force, engine=engine, deflicker=deflicker,
+                               renditions=renditions, output_format=output_format, encoder=encoder)
             written_filenames.append(fn)
         return written_filenames
 
@@ -305,17 +347,8 @@ class VideoMakerHour(VideoMaker):
 
     @staticmethod
     def group_by_time(localTLFiles):
-        grouped_images = OrderedDict()
-        for day_hour, day_files in itertools.groupby(localTLFiles,
-                                                     lambda x: dt.combine(x.taken.date(),
-                                                                          time(x.taken.hour, 0, 0, 0))):
-            LOGGER.debug("Hour {day_hour}")
-            grouped_images[day_hour] = []
-            for tlf in sorted(day_files):
-                grouped_images[day_hour].append(tlf)
-            #    print ("\t{}".format(tlf.filename))
-            # grouped_images = sorted(grouped_images)
-        return grouped_images
+        """ Return an OrderedDict of datetime (on the hour): FrameSet """
+        return FrameSet.from_tlfiles(localTLFiles).group_by("h")
 
 
 class VideoMakerDay(VideoMaker):
@@ -349,39 +382,321 @@ class VideoMakerDiagonal(VideoMaker):
     def load_videos(self):
         VideoMaker.load_videos(self)
 
-        daily = self.group_by_day(self.images)
-        if len(self.images) == 0:
+        frames = self.images
+        if len(frames) == 0:
             return
             #raise VideoMakerError("No images meet the criteria specified")
 
-        start_time = nptime.from_time(min([s.taken.time() for s in self.images]))
-        end_time = nptime.from_time(max([s.taken.time() for s in self.images]))
+        days = frames.taken.astype("datetime64[D]")
+        time_of_day = frames.taken - days
+        unique_days = np.unique(days)
+        start_time = time_of_day.min().item()
+        end_time = time_of_day.max().item()
         day_length = end_time - start_time
-        start_date = min([s.taken.date() for s in self.images])
-        end_date = max([s.taken.date() for s in self.images])
-        # Note that len (daily) = end_date - start_date + 1, iff continuous
+        # Note that len (unique_days) = end_date - start_date + 1, iff continuous
 
         # daily_advance is how much to advance the clock each day
         # like the 'descent angle' on the time v hours graph.
-        daily_advance = day_length / len(daily)
+        daily_advance = day_length / len(unique_days)
         # use this as the sliceage unless manually set. it will produce a continuous video
         # i.e. the cross moves down smoothly
         sliceage = self.sliceage or daily_advance
 
         LOGGER.debug(f"start_time={start_time} end_time={end_time}")
-        LOGGER.debug(f"start_date={start_date} end_date={end_date}")
-        LOGGER.info(f"Diagonal: days={len(daily)} sliceage={sliceage} (specified: {self.sliceage}) daily_advance={daily_advance}")
+        LOGGER.debug(f"start_date={unique_days[0]} end_date={unique_days[-1]}")
+        LOGGER.info(f"Diagonal: days={len(unique_days)} sliceage={sliceage} (specified: {self.sliceage}) daily_advance={daily_advance}")
+
+        # each day's slice starts at 'mark', which advances daily; times wrap at midnight
+        one_day = np.timedelta64(1, "D")
+        day_index = np.searchsorted(unique_days, days)
+        marks = (np.timedelta64(start_time) + np.arange(len(unique_days)) * np.timedelta64(daily_advance)) % one_day
+        slice_ends = (marks + np.timedelta64(sliceage)) % one_day
+        in_slice = (time_of_day >= marks[day_index]) & (time_of_day <= slice_ends[day_index])
+
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            n_day = np.bincount(day_index, minlength=len(unique_days))
+            n_slice = np.bincount(day_index[in_slice], minlength=len(unique_days))
+            for i, day in enumerate(unique_days):
+                LOGGER.debug(f"Day:{day} Slice:{marks[i].item()}->{slice_ends[i].item()} {n_slice[i]}/{n_day[i]} files")
+        self.videos.append(Video(frames[in_slice]))
+
+
+class Rendition:
+    """
+    An extra output made by the same ffmpeg call as the main video, from the same decoded frames.
+    kind: "preview" (a small video), "poster" (a JPEG of a representative frame) or "sprite" (a JPEG grid of frames)
+    dest_dir: relative to the main video's directory. e.g. daily-videos/2000-01-01.mp4 -> daily-videos/previews/2000-01-01.mp4
+    filters: for "preview", ffmpeg filters to apply, as for ffmpeg_run
+    width: for "poster" and "sprite" (of each tile), in pixels
+    """
+    KINDS = ("preview", "poster", "sprite")
+    DEFAULT_PREVIEW_FILTERS = {'scale': "128:-1", 'fps': "fps=5", 'setpts': "0.25*PTS"}
+
+    def __init__(self, kind, dest_dir="previews", filters=None, width=320, tiles=(5, 5)):
+        if kind not in Rendition.KINDS:
+            raise VideoMakerError(f"Unknown kind of rendition: {kind}. Use one of {Rendition.KINDS}")
+        self.kind = kind
+        self.dest_dir = Path(dest_dir)
+        self.filters = dict(filters if filters is not None else Rendition.DEFAULT_PREVIEW_FILTERS)
+        self.width = width
+        self.tiles = tiles
+
+    def __str__(self):
+        return f"Rendition: {self.kind} dest_dir:{self.dest_dir}"
+
+    def path(self, video_filename) -> Path:
+        video_path = Path(video_filename)
+        if self.kind == "preview":
+            return video_path.parent / self.dest_dir / video_path.name
+        if self.kind == "poster":
+            return video_path.parent / self.dest_dir / (video_path.stem + ".jpg")
+        return video_path.parent / self.dest_dir / (video_path.stem + "-sprite.jpg")
+
+    def filter_chain(self, n_frames):
+        """ ffmpeg filters to make this from the main video's frames. n_frames: approx. number of them """
+        if self.kind == "preview":
+            return ",".join([f"{k}={v}" for k, v in self.filters.items()])
+        if self.kind == "poster":
+            return f"thumbnail,scale={self.width}:-2"
+        columns, rows = self.tiles
+        every = max(1, n_frames // (columns * rows))
+        return f"select=not(mod(n\\,{every})),scale={self.width}:-2,tile={columns}x{rows}"
+
+    def output_parameters(self, video_filename):
+        path = self.path(video_filename)
+        if self.kind == "preview":
+            return ["-vcodec", "libx264", "-preset", "veryfast", str(path)]
+        return ["-frames:v", "1", "-update", "1", str(path)]
+
+
+def output_path(filename, output_format="mp4") -> str:
+    """ The file written for filename in output_format: the playlist for hls, else filename """
+    if output_format == "hls":
+        return str(Path(filename).with_suffix(".m3u8"))
+    return str(filename)
+
+
+def output_format_parameters(filename, output_format="mp4", append=False, copy=False, generation=None):
+    """
+    ffmpeg output parameters for output_format, to go before output_path(filename)
+    append: for hls, add segments to an existing playlist instead of replacing it
+    copy: the stream is copied ("-c copy"), so keyframes can't be forced: hls segments split at existing keyframes
+    generation: for hls, name the segments {stem}-{generation}-00000.m4s etc., so they don't overwrite the segments
+                of the playlist being replaced (see hls_generation)
+    """
+    if output_format == "mp4":
+        return []
+    if output_format == "fmp4":
+        return ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+    if output_format == "hls":
+        path = Path(filename)
+        prefix = f"{path.stem}-{generation}" if generation else path.stem
+        parameters = [] if copy else ["-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})"]
+        parameters += ["-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS),
+                       "-hls_playlist_type", "event" if append else "vod",
+                       "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", f"{prefix}-init.m4s",
+                       "-hls_segment_filename", str(path.parent / f"{prefix}-%05d.m4s")]
+        if append:
+            parameters.extend(["-hls_flags", "append_list"])
+        return parameters
+    raise VideoMakerError(f"Unknown output format: {output_format}. Use one of {OUTPUT_FORMATS}")
+
+
+def remove_hls_segments(filename, generation=None, keep=None):
+    """
+    Remove the segments (and init segment) of the hls output for filename: all of them, or only those of generation,
+    or all but those of generation keep
+    """
+    path = Path(filename)
+    for segment in path.parent.glob(f"{path.stem}-{generation}-*.m4s" if generation else f"{path.stem}-*.m4s"):
+        if not (keep and segment.name.startswith(f"{path.stem}-{keep}-")):
+            unlink_safe(segment)
+
+
+def hls_generation():
+    """ A new generation of segments for an hls output (see output_format_parameters) """
+    return os.urandom(4).hex()
+
+
+@contextmanager
+def replacing_hls_segments(filename, generation):
+    """
+    Around the (atomic) rewrite of filename's hls playlist with segments of generation: if it succeeds, remove
+    the old playlist's segments, else the new ones, so the playlist in place always has its segments. generation
+    None (not hls): nothing
+    """
+    if generation is None:
+        yield
+        return
+    try:
+        yield
+    except BaseException:
+        remove_hls_segments(filename, generation)
+        raise
+    remove_hls_segments(filename, keep=generation)
+
+
+def concat_list(name, lines):
+    """
+    Write lines to a temporary list file for ffmpeg's concat demuxer, named after name, and return its path.
+    It's not in the cwd, so videos can be made concurrently: list absolute paths.
+    """
+    fd, list_filename = tempfile.mkstemp(prefix=f"tmv-{Path(name).name}-", suffix=".txt")
+    with os.fdopen(fd, "w") as f:
+        f.writelines(lines)
+    return list_filename
 
-        TIME_FORMAT = "%H:%M"  # %S
-        mark = start_time
-        sliced_images = []
-        for day in sorted(daily.keys()):
-            day_slice = [tlf for tlf in daily[day] if mark <= tlf.taken.time() <= mark + sliceage]
-            sliced_images.extend(day_slice)
-            LOGGER.debug(f"Day:{day} Slice:{ mark.strftime(TIME_FORMAT)}->{(mark+sliceage).strftime(TIME_FORMAT)}" + f" {len(day_slice)}/{len(daily[day])} files")
-            mark += daily_advance
-        sliced_images.sort()
-        self.videos.append(Video(sliced_images))
+
+def encode_job(n_frames, frame_size=None, image=None, filters=None, encoder=None):
+    """
+    Description of an encode of n_frames (see predict.JOB_KEYS), of frame_size or else the size of image,
+    with encoder (see encoder_profile), for the RUNNER to record or predict()
+    """
+    profile = encoder_profile(encoder)
+    if frame_size is None:
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+        try:
+            with Image.open(image) as im:
+                frame_size = im.size
+        except (OSError, AttributeError, ValueError) as exc:
+            LOGGER.debug(f"No frame size from {image}: {exc}")
+            frame_size = (0, 0)
+    return {'frames': int(n_frames), 'width': frame_size[0], 'height': frame_size[1],
+            'codec': profile.codec, 'preset': profile.job_preset(), 'filters': filters}
+
+
+def time2timedelta64(t: time):
+    """ Time of day as a numpy timedelta since midnight """
+    return np.timedelta64(timedelta(hours=t.hour, minutes=t.minute, seconds=t.second, microseconds=t.microsecond), "us")
+
+
+class FrameSet:
+    """
+    Compact, columnar list of frames: numpy arrays of timestamps and durations, and paths stored as
+    an index into an interned table of directories plus a basename. Use instead of lists of TLFiles
+    for large videos (e.g. 1M frames).
+    Indexing with an int gives a TLFile view (changes to it are not stored). Indexing with a slice,
+    boolean mask or index array gives a FrameSet.
+    """
+    __slots__ = ("taken", "duration_real", "_dirs", "_dir_index", "_names")
+
+    def __init__(self, filenames=(), taken=()):
+        filenames = [str(f) for f in filenames]
+        self.taken = np.asarray(taken, dtype="datetime64[us]")
+        if len(filenames) != len(self.taken):
+            raise ValueError(f"Got {len(filenames)} filenames and {len(self.taken)} times")
+        self.duration_real = np.zeros(len(filenames), dtype="timedelta64[us]")
+        heads = [fn[:fn.rfind(os.sep) + 1] for fn in filenames]
+        self._dirs = list(dict.fromkeys(heads))
+        dir_ids = {d: i for i, d in enumerate(self._dirs)}
+        self._dir_index = np.fromiter((dir_ids[h] for h in heads), dtype=np.int32, count=len(heads))
+        self._names = np.array([fn[len(h):] for fn, h in zip(filenames, heads)], dtype=object)
+
+    @classmethod
+    def from_tlfiles(cls, tlfiles):
+        """ Convert a list of TLFiles (returning a FrameSet as-is) """
+        if isinstance(tlfiles, FrameSet):
+            return tlfiles
+        tlfiles = list(tlfiles)
+        frames = cls([tlf.filename for tlf in tlfiles], [tlf.taken for tlf in tlfiles])
+        frames.duration_real = np.array([tlf.duration_real for tlf in tlfiles], dtype="timedelta64[us]")
+        return frames
+
+    def __len__(self):
+        return len(self.taken)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._view(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self._view(range(len(self))[index])
+        frames = FrameSet.__new__(FrameSet)
+        frames.taken = self.taken[index]
+        frames.duration_real = self.duration_real[index]
+        frames._dirs = self._dirs
+        frames._dir_index = self._dir_index[index]
+        frames._names = self._names[index]
+        return frames
+
+    def __str__(self):
+        return f"FrameSet: frames:{len(self)} dirs:{len(self._dirs)}"
+
+    def _view(self, i):
+        tlf = TLFile(self.filename(i), self.taken[i].item())
+        tlf.duration_real = self.duration_real[i].item()
+        tlf.is_last = len(self) > 1 and i == len(self) - 1
+        return tlf
+
+    def filename(self, i):
+        return self._dirs[self._dir_index[i]] + self._names[i]
+
+    @property
+    def filenames(self):
+        """ List of all filenames """
+        dirs = self._dirs
+        return [dirs[d] + n for d, n in zip(self._dir_index.tolist(), self._names)]
+
+    def sort(self):
+        """ In-place (stable) sort by time taken """
+        order = np.argsort(self.taken, kind="stable")
+        self.taken = self.taken[order]
+        self.duration_real = self.duration_real[order]
+        self._dir_index = self._dir_index[order]
+        self._names = self._names[order]
+
+    def group_by(self, unit):
+        """
+        Return an OrderedDict of time (truncated to a numpy unit, e.g. "D" or "h"): FrameSet
+        Groups are in time order and sorted within.
+        """
+        grouped = OrderedDict()
+        if len(self) == 0:
+            return grouped
+        order = np.argsort(self.taken, kind="stable")
+        keys = self.taken[order].astype(f"datetime64[{unit}]")
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        ends = np.append(starts[1:], len(order))
+        for start, end in zip(starts, ends):
+            grouped[keys[start].item()] = self[order[start:end]]
+        return grouped
+
+    def calc_gaps(self, disjoint_threshold=timedelta.max):
+        """
+        Set duration_real for each frame. This is the time difference between this and the next's frame.
+        """
+        n = len(self)
+        if n <= 1:
+            return
+        durations = np.empty(n, dtype="timedelta64[us]")
+        durations[:-1] = np.diff(self.taken)
+        # last item's duration is unknown. assume is equal to penultimates's duration
+        durations[-1] = durations[-2]
+        if disjoint_threshold < timedelta.max:
+            # if there is a massive disjoint in the images' datetakens, skip this in the video
+            # (ie. set duration_real from BIG to a small value)
+            disjoint = durations > np.timedelta64(disjoint_threshold, "us")
+            for i in np.flatnonzero(disjoint):
+                LOGGER.warning(f"Closing disjoint gap of {self._view(i)}")
+            durations[disjoint] = np.timedelta64(1000, "ms")
+        self.duration_real = durations
+
+    def sample(self, n, disjoint_threshold=timedelta.max):
+        """
+        Return a FrameSet of up to n frames: those nearest to n times evenly spaced over this (sorted)
+        FrameSet's real time. Gaps greater than disjoint_threshold (e.g. nights) are closed, as per calc_gaps.
+        """
+        if n >= len(self):
+            return self[:]
+        gaps = np.diff(self.taken)
+        if disjoint_threshold < timedelta.max:
+            gaps[gaps > np.timedelta64(disjoint_threshold, "us")] = np.timedelta64(1000, "ms")
+        elapsed = np.concatenate(([0], np.cumsum(gaps.astype("int64"))))
+        targets = np.linspace(0, elapsed[-1], max(n, 1))
+        after = np.clip(np.searchsorted(elapsed, targets), 1, len(elapsed) - 1)
+        nearest = np.where(targets - elapsed[after - 1] <= elapsed[after] - targets, after - 1, after)
+        return self[np.unique(nearest)]
 
 
 class Video:
@@ -391,12 +706,65 @@ class Video:
 
     def __init__(self, images):
         self.disjoint_threshold = timedelta.max  # Gaps greater than this are considered disjoint - the gap is closed
+        self.frame_size = None  # (width, height) to resize frames to, with engine="pipe"
+        self.frame_filters = []  # callables (frame, i) -> frame to apply, with engine="pipe"
+        self.deflicker_window = DEFAULT_WINDOW  # real time to smooth brightness over, with deflicker="numpy"
+        self.deflicker_gains = None  # per-frame gains to use with deflicker="numpy", instead of measuring these frames alone (e.g. the whole video's, for a part of it)
+        self.catalog = None  # to get/cache frames' brightness
+        self.blur_frames = DEFAULT_BLUR_FRAMES  # frames to blend, with motion_blur="tmix" or "blend"
+        self.read_ahead_mb = DEFAULT_READ_AHEAD_MB  # of frames read ahead, with engine="pipe" (see FrameFeed)
+        self.estimate = None  # predict.Estimate of the last write_video's time and size
+        self._stats = None
         self.images = images
         self.calc_gaps()
 
     def __str__(self):
         return "Video: filename:{} frames:{} spfReal:{:.1f}".format(
-            self.default_video_filename(), len(self.images), self.spf_real_avg())
+            self.default_video_filename(), self.n_frames, self.spf_real_avg())
+
+    def __getitem__(self, index):
+        """ A new Video of a slice (or boolean mask) of the frames """
+        video = Video(self.images[index])
+        video.disjoint_threshold = self.disjoint_threshold
+        video.frame_size = self.frame_size
+        video.frame_filters = list(self.frame_filters)
+        video.deflicker_window = self.deflicker_window
+        video.catalog = self.catalog
+        video.blur_frames = self.blur_frames
+        video.read_ahead_mb = self.read_ahead_mb
+        video.calc_gaps()
+        return video
+
+    @property
+    def images(self):
+        """ FrameSet of the frames. Can be set with a FrameSet or list of TLFiles. """
+        return self._images
+
+    @images.setter
+    def images(self, images):
+        self._images = FrameSet.from_tlfiles(images)
+        self._stats = None
+
+    @property
+    def stats(self):
+        """
+        Aggregate statistics of the frames, computed once. Reset by setting images or calc_gaps().
+        """
+        if self._stats is None:
+            frames = self.images
+            self._stats = {
+                'n_frames': len(frames),
+                'duration_real': frames.duration_real.sum().item(),
+                'min_frame_duration': frames.duration_real.min().item() if len(frames) else timedelta(),
+                'start': frames.taken[0].item() if len(frames) else None,
+                'end': frames.taken[-1].item() if len(frames) else None,
+                'earliest': frames.taken.min().item() if len(frames) else None,
+            }
+        return self._stats
+
+    @property
+    def n_frames(self):
+        return self.stats['n_frames']
 
     def ls(self):
         s = ""
@@ -408,46 +776,24 @@ class Video:
         """
         Set duration_real for each frame. This is the time difference between this and the next's frame.
         """
-        if len(self.images) <= 1:
-            return
-        for prev, item, next_item in neighborhood(self.images):
-            if next_item is not None:
-                item.duration_real = next_item.taken - item.taken
-
-            if next_item is None:
-                # last item's duration is unknown. assume is equal to
-                # penultimates's duration
-                item.is_last = True
-                item.duration_real = prev.duration_real
-
-            if item.duration_real > self.disjoint_threshold:
-                # if there is a massive disjoint in the images' datetakens, skip this in the video
-                # (ie. set duration_real from BIG to a small value)
-                LOGGER.warning(f"Closing disjoint gap of {item}")
-                item.duration_real = timedelta(milliseconds=1000)
+        self.images.calc_gaps(self.disjoint_threshold)
+        self._stats = None
 
     # Since frames' time may be disjoint, add the gaps between all frames; see
     # "calc_gaps"
 
     def duration_real(self):
-        dr = timedelta()
-        for tlf in self.images:
-            dr += tlf.duration_real
-        return dr
+        return self.stats['duration_real']
 
     @property
     def start(self):
         """ instant of first image """
-        if len(self.images) < 1:
-            return None
-        return self.images[0].taken
+        return self.stats['start']
 
     @property
     def end(self):
         """ instant of last image """
-        if len(self.images) < 1:
-            return None
-        return self.images[-1].taken
+        return self.stats['end']
 
     def duration_video(self, speedup):
         # Run-around to avoid "TypeError: unsupported operand type(s) for /:
@@ -462,36 +808,86 @@ class Video:
         return self.fps_real_avg() * speedup
 
     def fps_real_avg(self):
-        if len(self.images) == 0:
+        if self.n_frames == 0:
             return 0
         if self.duration_real().total_seconds() == 0:
             return 0
-        return len(self.images) / self.duration_real().total_seconds()
+        return self.n_frames / self.duration_real().total_seconds()
 
     def fps_real_max(self):
-        if len(self.images) == 0:
+        if self.n_frames == 0:
             return 0
         if self.duration_real().total_seconds() == 0:
             return 0
-        min_frame_duration = min(
-            self.images,
-            key=lambda x: x.duration_real).duration_real.total_seconds()
-        return 1 / min_frame_duration
+        return 1 / self.stats['min_frame_duration'].total_seconds()
 
     def spf_real_avg(self):
-        if self.fps_real_avg() == 0:
+        fps_real_avg = self.fps_real_avg()
+        if fps_real_avg == 0:
             return 0
-        return 1 / self.fps_real_avg()
+        return 1 / fps_real_avg
 
-    def write_video(self, filename=None, force=False, vsync="cfr-even", motion_blur=False,
-                    dry_run=False, fps=None, speedup=None):
+    def timing(self, fps=None, speedup=None):
+        """
+        (fps, pts_factor, speedup) to write the video with vsync "cfr-even": frames are taken as equally spaced.
+        If fps(output) is specified:
+        - and speedup isn't, find the implied speedup (= duration_real / duration_video), for reporting
+        - and speedup is, change the video playback speed (via PTS). PTS factor = desired_speedup / implied_speedup
+        If only speedup is specified, set output fps to achieve it
+        """
         pts_factor = 1
-        if len(self.images) <= 1:
+        if fps:
+            if speedup:
+                implied_speedup = self.duration_real().total_seconds() / self.n_frames * fps
+                pts_factor = implied_speedup / speedup
+                if not 1000 > pts_factor > 0.001:
+                    raise VideoMakerError(f"pts of {pts_factor} is out of a sane range")
+            else:
+                speedup = self.duration_real().total_seconds() / self.n_frames * fps
+        elif speedup:
+            fps = self.fps_video_avg(speedup)
+        else:
+            raise VideoMakerError("Specify fps and/or speedup. (Using vsync=cfr-even)")
+        return fps, pts_factor, speedup
+
+    def write_video(self, filename=None, force=False, vsync="cfr-even", motion_blur=False,
+                    dry_run=False, fps=None, speedup=None, engine="concat", deflicker="ffmpeg", renditions=None,
+                    output_format="mp4", encoder=None, pts_factor=None):
+        """
+        fps, speedup: see timing()
+        pts_factor: with fps and vsync "cfr-even", instead of the one timing() finds (e.g. the whole video's, for a part of it)
+        engine: "concat" to write a list of images for ffmpeg to read, or "pipe" to stream them (see FrameFeed)
+        deflicker: "ffmpeg" filter, "numpy" to adjust each frame's brightness (implies engine="pipe"), or "none"
+        motion_blur: one of MOTION_BLURS ("blend" implies engine="pipe"). True for "minterpolate".
+        renditions: list of Renditions to make at the same time (each frame is only decoded once)
+        output_format: one of OUTPUT_FORMATS. Returns the filename written, which is a .m3u8 for hls.
+        encoder: an EncoderProfile or the name of one (see tmv.encoders). Default: DEFAULT_ENCODER
+        """
+        profile = encoder_profile(encoder)
+        list_filename = None
+        if self.n_frames <= 1:
             raise VideoMakerError(f"Less than one image to write for {filename}")
+        if engine not in ENGINES:
+            raise VideoMakerError(f"Unknown engine: {engine}. Use one of {ENGINES}")
+        if deflicker not in DEFLICKERS:
+            raise VideoMakerError(f"Unknown deflicker: {deflicker}. Use one of {DEFLICKERS}")
+        if motion_blur is True:
+            motion_blur = "minterpolate"
+        elif not motion_blur:
+            motion_blur = "none"
+        if motion_blur not in MOTION_BLURS:
+            raise VideoMakerError(f"Unknown motion_blur: {motion_blur}. Use one of {MOTION_BLURS}")
+        if deflicker == "numpy" or motion_blur == "blend":
+            # gains and blending are applied as frames are decoded
+            engine = "pipe"
+        if engine == "pipe" and vsync != "cfr-even":
+            raise VideoMakerError(f"The pipe engine requires vsync=cfr-even, not {vsync}")
         if not filename:
             filename = self.default_video_filename()
-        if not force and os.path.isfile(filename):
-            LOGGER.info("Not overwriting {}".format(filename))
+        if output_format not in OUTPUT_FORMATS:
+            raise VideoMakerError(f"Unknown output format: {output_format}. Use one of {OUTPUT_FORMATS}")
+        if not force and os.path.isfile(output_path(filename, output_format)):
+            LOGGER.info("Not overwriting {}".format(output_path(filename, output_format)))
             return None
         if vsync == 'vfr':
             # input frame rate is defined by the duration of each frame
@@ -502,30 +898,20 @@ class Video:
             list_filename = self.write_images_list_vfr(filename, speedup)
             # set to the maximum
             fps = self.fps_video_max(speedup)
+            pts_factor = 1
             input_parameters = []
         elif vsync == 'cfr-even':
             # assume frames are equally spaced between start and end time
             vsync = 'cfr'
-            list_filename = self.write_images_list_cfr(filename)
-            # if fps(output) is specified:
-            # - and if speedup is not specified, find the implied speedup (= duration_real / duration_video)
-            # - and speed is specified, change the video playback speed (via PTS). PTS factor = desired_speedup / implied_speedup
-            # if speed is specified:
-            # - and nothing else, set output fps to achieve the desired speedup
-            if fps:
-                if speedup:
-                    implied_speedup = self.duration_real().total_seconds() / \
-                        len(self.images) * fps
-                    pts_factor = implied_speedup / speedup
-                    if not 1000 > pts_factor > 0.001:
-                        raise VideoMakerError(f"pts of {pts_factor} is out of a sane range")
-                else:
-                    # use this fps value. calc speedup for reporting only
-                    speedup = self.duration_real().total_seconds() / len(self.images) * fps
-            elif speedup:
-                fps = self.fps_video_avg(speedup)
+            if engine == "concat":
+                list_filename = self.write_images_list_cfr(filename)
+            if pts_factor is None:
+                fps, pts_factor, speedup = self.timing(fps, speedup)
+            elif not fps:
+                raise VideoMakerError("Specify fps with pts_factor")
             else:
-                raise VideoMakerError("Specify fps and/or speedup. (Using vsync=cfr-even)")
+                # calc speedup for reporting only
+                speedup = speedup or self.duration_real().total_seconds() / self.n_frames * fps
             input_parameters = ["-r", str(round(fps, 0))]
         elif vsync == 'cfr-padded':
             # use a constant framerate, but pad 'slow' sections to reproduce original intervals
@@ -536,51 +922,100 @@ class Video:
             # set the input-frame-rate (images) and output-frame-rate (video) to be the same
             # otherwise defaults to 25 (?)
             # input_parameters = ["-r", str(round(fps,0))]
+            pts_factor = 1
             input_parameters = []
             raise NotImplementedError()
         else:
             raise VideoMakerError("Unknown type of vsync: {}".format(vsync))
         LOGGER.info("creating video: {} src-frames: {} speedup:{:.1f} fps_video:{:.1f} video:{}s real:{}s pts:{:.3f}".format(
-            filename, len(self.images), speedup, fps, self.duration_video(speedup).total_seconds(), self.duration_real().total_seconds(), pts_factor))
+            filename, self.n_frames, speedup, fps, self.duration_video(speedup).total_seconds(), self.duration_real().total_seconds(), pts_factor))
 
         # dfs = max(5, int(fps / 2.0))  # deflicker size. smooth across 0.5s
 
         # filter to add 2 seconds to end
         # tpad=stop_mode=clone:stop_duration=2,
-        if motion_blur:
+        vf = ["deflicker"] if deflicker == "ffmpeg" else []
+        if motion_blur == "minterpolate":
             # output_parameters = ["-vf", "deflicker,minterpolate,setpts=PTS*"+pts_factor]
-            output_parameters = [
-                "-vf", "deflicker,minterpolate", "-preset", "veryfast", ]
+            vf.append("minterpolate")
             fps *= 2
         else:
-            output_parameters = [
-                "-vf", "deflicker,setpts=PTS*{:.3f}".format(pts_factor), "-preset", "veryfast"]
+            if motion_blur == "tmix":
+                vf.append(f"tmix=frames={self.blur_frames}")
+            vf.append("setpts=PTS*{:.3f}".format(pts_factor))
+        renditions = renditions or []
+        if renditions:
+            # decode once: split the main video's frames into each rendition's filters
+            n_frames = self.n_frames * (2 if motion_blur == "minterpolate" else 1)
+            split = f"[0:v]{','.join(vf)},split={len(renditions) + 1}[main]" + "".join(f"[s{i}]" for i in range(len(renditions)))
+            chains = [f"[s{i}]{r.filter_chain(n_frames)}[r{i}]" for i, r in enumerate(renditions)]
+            output_parameters = ["-filter_complex", ";".join([split] + chains), "-map", "[main]"]
+        else:
+            output_parameters = ["-vf", ",".join(vf)]
 
         safe = "0"  # 0 = disable safe 1 = enable safe filenames
-        start_date = min([s.taken for s in self.images])
+        start_date = self.stats['earliest']
         #metadata1 = "comment=description has real start as str and real duration in seconds"
         metadata2 = "author=TimeMakeVisible"
         metadata3 = f"description={dt2str(start_date)},{self.duration_real().total_seconds():.0f}"
-        the_call = ["ffmpeg", "-hide_banner", "-loglevel", "verbose", "-y", "-f", "concat", "-vsync", vsync, "-safe", safe]
-        the_call.extend(input_parameters)
-        the_call.extend(["-i", list_filename])
+        the_call = ["ffmpeg", "-hide_banner", "-loglevel", "verbose", "-y"]
+        if engine == "pipe":
+            feed = FrameFeed(self.images.filenames, size=self.frame_size, frame_filters=self.frame_filters,
+                             decode=deflicker == "numpy" or motion_blur == "blend", read_ahead_mb=self.read_ahead_mb)
+            the_call.extend(["-vsync", vsync])
+            the_call.extend(feed.input_parameters(round(fps, 0)))
+        else:
+            the_call.extend(["-f", "concat", "-vsync", vsync, "-safe", safe])
+            the_call.extend(input_parameters)
+            the_call.extend(["-i", list_filename])
         #the_call.extend(["-metadata", metadata1])
         the_call.extend(["-metadata", metadata2])
         the_call.extend(["-metadata", metadata3])
         the_call.extend(output_parameters)
-        the_call.extend(["-vcodec", "libx264", "-r", str(round(fps, 0)), filename])
-
+        the_call.extend(profile.output_parameters())
+        the_call.extend(["-r", str(round(fps, 0))])
+        generation = hls_generation() if output_format == "hls" else None
+        the_call.extend(output_format_parameters(filename, output_format, generation=generation))
+        the_call.append(output_path(filename, output_format))
+        for i, r in enumerate(renditions):
+            the_call.extend(["-map", f"[r{i}]"])
+            the_call.extend(r.output_parameters(filename))
+
+        job = encode_job(self.duration_video(speedup).total_seconds() * fps, self.frame_size, self.images.filename(0), ",".join(vf), profile)
+        self.estimate = RUNNER.predict(job)
         if dry_run:
             LOGGER.info("Dryrun: {}\n".format(' '.join(the_call)))
-            return filename
+            LOGGER.info(f"Estimate: {filename}: {self.estimate}")
+            unlink_safe(list_filename)
+            return output_path(filename, output_format)
 
-        log_path = Path(Path(filename).name + ".log")
+        log_path = Path(str(filename) + ".log")
+        for r in renditions:
+            r.path(filename).parent.mkdir(parents=True, exist_ok=True)
+        # written atomically: replaced only if the job succeeds, as are the old hls segments
+        outputs = [output_path(filename, output_format)] + [r.path(filename) for r in renditions]
 
         # log file created on failure only
         # delete file list in all cases (could leave in debug mode)
         try:
-            run_and_capture(the_call, log_path)
-            return filename
+            with replacing_hls_segments(filename, generation):
+                if engine == "pipe":
+                    if deflicker == "numpy":
+                        if self.deflicker_gains is not None:
+                            deflicker_filter = Deflicker(self.deflicker_gains)
+                        else:
+                            deflicker_filter = Deflicker.from_frames(feed.filenames, self.images.taken, self.deflicker_window, self.catalog)
+                        LOGGER.debug(deflicker_filter)
+                        feed.frame_filters.insert(0, deflicker_filter)
+                    if motion_blur == "blend":
+                        feed.frame_filters.append(FrameBlend(self.blur_frames))
+                    run_ffmpeg(the_call, feed=feed, log_filename=log_path, outputs=outputs, job=job, atomic=True)
+                else:
+                    run_ffmpeg(the_call, log_filename=log_path, outputs=outputs, job=job, atomic=True)
+            for r in renditions:
+                # renditions are fresh: newer than the video (see PreviewVideosTask)
+                os.utime(r.path(filename))
+            return output_path(filename, output_format)
         except CalledProcessError:
             LOGGER.warning(f"failed subprocess call logged to {log_path.absolute()}")
             raise
@@ -588,31 +1023,22 @@ class Video:
             unlink_safe(list_filename)
 
     def write_images_list_vfr(self, filename, speedup):
-        f = open(os.path.basename(filename) + ".images", 'w')
-        for tlf in self.images:
-            f.write("file '" + tlf.filename + "'\n")
-            f.write(
-                "duration " + str(timedelta(seconds=tlf.duration_real.total_seconds() / speedup)) + "\n")
-        f.close()
-        return os.path.basename(filename) + ".images"
+        seconds = self.images.duration_real / np.timedelta64(1, "s") / speedup
+        return concat_list(filename, (f"file '{os.path.abspath(fn)}'\nduration {timedelta(seconds=s)}\n"
+                                      for fn, s in zip(self.images.filenames, seconds.tolist())))
 
     #
     # List of filenames only, without duration. Duration of each frame constant and defined by FPS
     #
     def write_images_list_cfr(self, video_filename):
-        f = open(os.path.basename(video_filename) + ".images", 'w')
-        for tlf in self.images:
-            f.write("file '" + tlf.filename + "'\n")
-        f.close()
-        return os.path.basename(video_filename) + ".images"
+        return concat_list(video_filename, (f"file '{os.path.abspath(fn)}'\n" for fn in self.images.filenames))
 
     def default_video_filename(self):
-        if len(self.images) == 0:
+        if self.n_frames == 0:
             return ""
             # bn = "empty"
         else:
-            bn = self.images[0].taken.strftime("%Y-%m-%dT%H") + "_to_" + self.images[
-                -1].taken.strftime("%Y-%m-%dT%H")
+            bn = self.start.strftime("%Y-%m-%dT%H") + "_to_" + self.end.strftime("%Y-%m-%dT%H")
         return bn + ".mp4"
 
 
@@ -620,12 +1046,12 @@ class TLFile:
     """
     Time-aware image
     """
+    __slots__ = ("filename", "taken", "tags", "ith", "duration_real", "is_first", "is_last", "motion")
     i = 0  # Simple counter, static
 
-    # Quick header check to see if valid
+    # Quick header and trailer check to see if valid
     def valid(self):
-        image_header = imghdr.what(self.filename)
-        return image_header  # i.e. not None and not ""
+        return image_valid(self.filename)
 
     def __repr__(self):
         return '{}\t\t{}\t\t{}\t{}'.format(self.taken, self.duration_real, self.filename,
@@ -662,13 +1088,16 @@ class TLFile:
 
 def find_matching_files(date_list, video_files):
     matches = []
+    # first video for each date
+    videos_by_date = {}
+    for video in video_files:
+        video_datetime = str2dt(video, throw=False)
+        if video_datetime is not None:
+            videos_by_date.setdefault(video_datetime.date(), video)
     for d in date_list:
-        try:
-            # match if filename starts with the date
-            match = next(video for video in video_files if
-                         d == str2dt(video).date())
-            matches.append(match)
-        except BaseException:
+        if d in videos_by_date:
+            matches.append(videos_by_date[d])
+        else:
             LOGGER.info("No video for {}".format(d))  # not found
 
     return matches
@@ -685,43 +1114,47 @@ def ffmpeg_run(input_path, output_path, vf=None):
         # god in the quotes
         the_call.extend([",".join(['{}={}'.format(k, v) for k, v in vf.items()])])
     the_call.extend([output_path])
-    subprocess_stdout(the_call)  # throw on fail
+    run_ffmpeg(the_call, outputs=[output_path], atomic=True)  # throw on fail
 
 
-def video_join(src_videos: list, dest_video: str, start_datetime, end_datetime, speed_rel, fps):
+def video_join(src_videos: list, dest_video: str, start_datetime, end_datetime, speed_rel, fps, output_format="mp4", append=False, encoder=None):
+    """
+    Concat the videos dated from start_datetime to end_datetime into dest_video, at speed_rel.
+    output_format: one of OUTPUT_FORMATS. append: for hls, add the videos to dest_video's playlist
+    as new segments (i.e. pass only the new videos) instead of rewriting it.
+    encoder: to re-encode (speed_rel != 1), see encoder_profile
+    """
 
     LOGGER.debug("Searching {} to {}".format(start_datetime.isoformat(), end_datetime.isoformat()))
     invalid_videos = []
+    video_datetimes = {}
     for v in src_videos:
-        if not valid(v) or str2dt(v, throw=False) is None:
+        video_datetime = str2dt(v, throw=False)
+        if video_datetime is None or not valid(v):
             invalid_videos.append(v)
+        else:
+            video_datetimes[v] = video_datetime
 
     if len(invalid_videos) > 0:
         LOGGER.warning("Ignoring {} invalid video(s) : {}".format(
             len(invalid_videos), invalid_videos))
 
-    video_files = list(set(src_videos) - set(invalid_videos))
-
-    video_files_in_range = [v for v in video_files if start_datetime.date(
-    ) <= str2dt(v).date() <= end_datetime.date()]
+    video_files_in_range = [v for v, v_dt in video_datetimes.items() if start_datetime.date(
+    ) <= v_dt.date() <= end_datetime.date()]
 
     if len(video_files_in_range) < 1:
         raise VideoMakerError("No videos found to concat")
 
     video_files_in_range.sort()  # probably redundant as ls returns in alphabetical order
     # logger.info("concat'ing: {}".format('\n'.join(video_files_in_range)))
-    videos_filename = 'filelist.txt'
-    with open(videos_filename, 'w') as f:
-        f.write("# Auto-generated\n")
-        for video in video_files_in_range:
-            f.write("file '%s'\n" % str(video))
+    videos_filename = concat_list(dest_video, ["# Auto-generated\n"] + [f"file '{os.path.abspath(video)}'\n" for video in video_files_in_range])
 
     ffmpeg_concat_rel_speed(
-        video_files_in_range, videos_filename, dest_video, speed_rel, fps)
+        video_files_in_range, videos_filename, dest_video, speed_rel, fps, output_format, append, encoder)
     unlink_safe(videos_filename)
 
 
-def ffmpeg_concat_rel_speed(filenames, filenames_file, output_file, rel_speed, fps):
+def ffmpeg_concat_rel_speed(filenames, filenames_file, output_file, rel_speed, fps, output_format="mp4", append=False, encoder=None):
     # Auto name FIRST_to_LAST
     if output_file is None:
         first_date = str2dt(filenames[0]).date()
@@ -730,29 +1163,90 @@ def ffmpeg_concat_rel_speed(filenames, filenames_file, output_file, rel_speed, f
 
     if rel_speed == 1:
         cl = "ffmpeg -hide_banner -y -f concat -safe 0 -i " + \
-            filenames_file + " -c copy " + f"-r {fps} {output_file}"
+            filenames_file + " -c copy " + f"-r {fps}"
     else:
         # output_file += "_xoutput_file" + "{0:.1f}".format(rel_speed)
         factor = 1 / rel_speed
-        cl = "ffmpeg -hide_banner -y -f concat -safe 0 -i " + filenames_file + " -preset veryfast -filter:v setpts=" + str(
-            factor) + "*PTS " + f"-r {fps} {output_file}"
-    the_call = cl.split(" ")
+        cl = "ffmpeg -hide_banner -y -f concat -safe 0 -i " + filenames_file + " -filter:v setpts=" + str(
+            factor) + "*PTS " + f"-r {fps}"
+    # appended segments are added to the playlist in place, else they replace the old ones once it's rewritten
+    generation = hls_generation() if output_format == "hls" and not append else None
+    the_call = cl.split(" ") + (encoder_profile(encoder).output_parameters() if rel_speed != 1 else []) + \
+        output_format_parameters(output_file, output_format, append, copy=rel_speed == 1, generation=generation) + [output_path(output_file, output_format)]
     # use abs path to easily report errors directing user to log
-    log_filename = os.path.abspath(os.path.basename(output_file) + ".ffmpeg")
-    p_log = open(log_filename, "w")
-    p_log.write("called: {}\n".format(' '.join(the_call)))  # ignored? overwriten
+    log_filename = os.path.abspath(str(output_file) + ".ffmpeg")
     LOGGER.debug("calling: {}\n".format(' '.join(the_call)))
+    try:
+        with replacing_hls_segments(output_file, generation):
+            run_ffmpeg(the_call, log_filename=log_filename, outputs=[] if append else [output_path(output_file, output_format)], atomic=True)
+    except CalledProcessError:
+        LOGGER.warning(f"Failed on ffmpeg concat. Check log: {log_filename}")
+        raise
 
-    r = subprocess.call(
-        the_call,
-        stdout=p_log,
-        stderr=subprocess.STDOUT)
-    if r == 0:
-        #  print(output_file)
-        unlink_safe(log_filename)
-    else:
-        raise RuntimeError(
-            "Failed on ffmpeg concat. Check log:{} Called:'{}' Return:{}".format(log_filename, ' '.join(the_call), r))
+
+def motion_blur_benchmark(filenames, dest_dir=".", modes=MOTION_BLURS, fps=25, speedup=None, blur_frames=DEFAULT_BLUR_FRAMES):
+    """
+    Write a video of the images with each motion blur mode. Return a list of dicts of
+    mode, seconds (to encode), jerkiness (lower is smoother, see videotools.jerkiness) and bytes.
+    """
+    vm = VideoMakerConcat()
+    vm.validation_cache = None
+    vm.file_list = filenames
+    vm.load_videos()
+    video = vm.videos[0]
+    video.blur_frames = blur_frames
+    results = []
+    for mode in modes:
+        filename = str(Path(dest_dir) / f"motion-blur-{mode}{VideoMaker.VIDEO_SUFFIX}")
+        start = monotonic()
+        video.write_video(filename, force=True, fps=fps, speedup=speedup, motion_blur=mode)
+        seconds = monotonic() - start
+        results.append({'mode': mode, 'seconds': seconds, 'jerkiness': jerkiness(filename),
+                        'bytes': os.path.getsize(filename)})
+        LOGGER.info(f"motion_blur={mode}: {seconds:.1f}s jerkiness={results[-1]['jerkiness']:.4f} size={results[-1]['bytes']}")
+    return results
+
+
+def encoder_benchmark(filenames, dest_dir=".", encoders=None, fps=25):
+    """
+    Write a video of the images with each encoder (names of PROFILES; default: all those ffmpeg can encode with).
+    Deflicker is off, to time just the encoder. Return a list of dicts of
+    encoder, codec, preset, crf, seconds (to encode), fps (frames encoded per second) and bytes.
+    """
+    vm = VideoMakerConcat()
+    vm.validation_cache = None
+    vm.file_list = filenames
+    vm.load_videos()
+    video = vm.videos[0]
+    codecs = available_codecs()
+    results = []
+    for name in encoders or list(PROFILES):
+        profile = encoder_profile(name)
+        if profile.codec not in codecs:
+            LOGGER.info(f"Skipping encoder {name}: ffmpeg can't encode {profile.codec}")
+            continue
+        filename = str(Path(dest_dir) / f"encoder-{name}{VideoMaker.VIDEO_SUFFIX}")
+        start = monotonic()
+        video.write_video(filename, force=True, fps=fps, deflicker="none", encoder=profile)
+        seconds = monotonic() - start
+        results.append({'encoder': name, 'codec': profile.codec, 'preset': profile.preset, 'crf': profile.crf,
+                        'seconds': seconds, 'fps': video.n_frames / seconds, 'bytes': os.path.getsize(filename)})
+        LOGGER.info(f"encoder={name}: {seconds:.1f}s fps={results[-1]['fps']:.1f} size={results[-1]['bytes']}")
+    return results
+
+
+def add_encoder_arguments(parser):
+    parser.add_argument("--encoder", default=DEFAULT_ENCODER, choices=list(PROFILES), help="Encoder profile: codec, preset, crf and threads. Compare them with tmv-video-bench")
+    parser.add_argument("--preset", default=None, help="Override the encoder's preset. libx264/5: e.g. veryfast, slow. libsvtav1: 0-13. libvpx-vp9: 0-8 (cpu-used)")
+    parser.add_argument("--crf", default=None, type=int, help="Override the encoder's constant rate factor: lower is better quality and bigger")
+    parser.add_argument("--threads", default=None, type=int, help="Override the encoder's threads")
+
+
+def encoder_from_args(args) -> EncoderProfile:
+    """ The --encoder profile with any --preset, --crf or --threads (see add_encoder_arguments) """
+    profile = EncoderProfile(args.encoder, **PROFILES[args.encoder].as_dict())
+    profile.configd({k: v for k, v in [("preset", args.preset), ("crf", args.crf), ("threads", args.threads)] if v is not None})
+    return profile
 
 
 def sig_handler(signal_received, frame):
@@ -764,7 +1258,9 @@ def video_compile_console(cl_args=sys.argv[1:]):
     signal(SIGTERM, sig_handler)
 
     parser = argparse.ArgumentParser("TMV Compiler", description="Compile timelapse videos from images. Outputs filename(s) of resultant video(s).")
-    parser.add_argument("file_glob", nargs='+', help="Multiple image files or glob strings. e.g. 1.jpg '2*.jpg' 3.jpg")
+    parser.add_argument("file_glob", nargs='*', help="Multiple image files or glob strings. e.g. 1.jpg '2*.jpg' 3.jpg")
+    parser.add_argument("--catalog", default=None, help="Use the image catalog of this tmv_root instead of file_glob")
+    parser.add_argument("--location", default=".", help="With --catalog, the location (camera directory) under tmv_root")
     parser.add_argument("--start", type=lambda s: parse(s, ignoretz=True), default=dt.min, help="Local datetime. eg. \"2 days ago\", 2000-01-20T16:00:00")
     parser.add_argument("--end", type=lambda s: parse(s, ignoretz=True), default=dt.max, help="Local datetime. eg. Today, 2000-01-20T16:00:00")
     parser.add_argument("--start-time", type=lambda s: dt.strptime(s, HH_MM).time(), default=time.min, help="Consider only images after HH:MM each day")
@@ -777,9 +1273,15 @@ def video_compile_console(cl_args=sys.argv[1:]):
     parser.add_argument("--speedup", "-s", default=None, type=int, help="Speed up video by this much: it's the ratio of real:video duration")
     parser.add_argument("--vsync", default="cfr-even", choices=['cfr-even', 'cfr-padded', 'vfr'], type=str, help="cfr-even uses start and end time, and makes frames are equally spaced. cfr-padded uses maximum framerate and pads slow bits. vfr uses exact time of each frame (less robust)")
     parser.add_argument("--sliceage", default=None, type=strptimedelta, help="For Diagonal slice types, MM:SS or \"1 minute\" to show each day. Default to auto-slice, the value to make a 'smooth' slice")
-    parser.add_argument("--motion-blur", "-b", action='store_true', default=False, help="FFMPEG Filter to motion-blur video to reduce jerkiness. Ya jerk.")
+    parser.add_argument("--motion-blur", "-b", nargs='?', const="minterpolate", default="none", choices=MOTION_BLURS, help="Motion-blur video to reduce jerkiness. Ya jerk. minterpolate (default if no value) is very slow. tmix and blend average --blur-frames frames, in ffmpeg or numpy.")
+    parser.add_argument("--blur-frames", default=DEFAULT_BLUR_FRAMES, type=int, help="Frames to average with --motion-blur tmix or blend")
     parser.add_argument("--output", "-o", type=str, help="Output here. Create this file (an extension is added) or folder (if multiple files are written)")
     parser.add_argument('--filenames', action="store_true", help="Write the videos created to stdout")
+    parser.add_argument("--engine", default="concat", choices=ENGINES, help="concat: ffmpeg reads a list of images. pipe: images are read ahead and piped to ffmpeg (cfr-even only)")
+    parser.add_argument("--deflicker", default="ffmpeg", choices=DEFLICKERS, help="ffmpeg: use its deflicker filter. numpy: adjust each frame's brightness to the average over --deflicker-window (implies --engine pipe)")
+    parser.add_argument("--deflicker-window", default=DEFAULT_WINDOW, type=strptimedelta, help="With --deflicker numpy, the real time to average brightness over. MM:SS or \"10 minutes\"")
+    parser.add_argument("--output-format", default="mp4", choices=OUTPUT_FORMATS, help="mp4, fmp4 (fragmented: playback starts before it's all downloaded) or hls (a .m3u8 playlist of segments)")
+    add_encoder_arguments(parser)
     parser.add_argument("--dry-run", action='store_true', default=False)
     # parser.add_argument("--filter-motion", action='store_true', default=False,    #                    help="Image selection to include only motiony images")
 
@@ -789,21 +1291,35 @@ def video_compile_console(cl_args=sys.argv[1:]):
         logging.basicConfig(format=LOG_FORMAT)
 
         mm = VideoMaker.Factory(args.slice.title())
-        mm.files_from_glob(args.file_glob)
         mm.start_time = args.start_time
         mm.end_time = args.end_time
         mm.sliceage = args.sliceage
         mm.start = args.start
         mm.end = args.end
+        if args.catalog:
+            catalog = Catalog(args.catalog)
+            catalog.refresh(args.location)
+            mm.files_from_catalog(catalog, args.location)
+        elif args.file_glob:
+            mm.files_from_glob(args.file_glob)
+        else:
+            parser.error("Specify file_glob or --catalog")
         mm.validate_images = not args.no_validate_images
+        mm.deflicker_window = args.deflicker_window
+        mm.blur_frames = args.blur_frames
 
         mm.load_videos()
 
         written_videos = mm.write_videos(filename=args.output,
                                          speedup=args.speedup, vsync=args.vsync, fps=args.fps,
-                                         force=args.force, motion_blur=args.motion_blur, dry_run=args.dry_run)
+                                         force=args.force, motion_blur=args.motion_blur, dry_run=args.dry_run,
+                                         engine=args.engine, deflicker=args.deflicker, output_format=args.output_format,
+                                         encoder=encoder_from_args(args))
         if args.filenames:
             print("\n".join(written_videos))
+        if args.dry_run:
+            for v, fn in zip(mm.videos, written_videos):
+                print(f"{fn}: estimated {v.estimate}")
 
     except CalledProcessError as exc:
         print(cpe2str(exc), file=sys.stderr)
@@ -831,6 +1347,9 @@ def video_join_console():
     speed_group = parser.add_mutually_exclusive_group()
     speed_group.add_argument("--speed-rel", default=1, help="Relative speed multipler. e.g. 1 is no change, 2 is twice as fast, 0.5 is twice as slow.")
     speed_group.add_argument("--speed-abs", default=None, help="Absolute speed (real time / video time)")
+    parser.add_argument("--output-format", default="mp4", choices=OUTPUT_FORMATS, help="mp4, fmp4 (fragmented: playback starts before it's all downloaded) or hls (a .m3u8 playlist of segments)")
+    parser.add_argument("--append", action='store_true', default=False, help="With --output-format hls, add the videos to the existing playlist as new segments")
+    add_encoder_arguments(parser)
 
     args = (parser.parse_args())
 
@@ -873,7 +1392,7 @@ def video_join_console():
             #  videos_filename, args.output, float(args.speed_abs))
         else:
             ffmpeg_concat_rel_speed(
-                video_files_in_range, videos_filename, args.output, float(args.speed_rel), 25)
+                video_files_in_range, videos_filename, args.output, float(args.speed_rel), 25, args.output_format, args.append, encoder_from_args(args))
         unlink_safe(videos_filename)
         sys.exit(0)
     except Exception as exc:
@@ -881,3 +1400,57 @@ def video_join_console():
         LOGGER.error(exc)
         LOGGER.debug(f"Exception: {exc}", exc_info=exc)
         sys.exit(1)
+
+
+def video_bench_console(cl_args=sys.argv[1:]):
+    signal(SIGINT, sig_handler)
+    signal(SIGTERM, sig_handler)
+
+    parser = argparse.ArgumentParser("TMV Video Bench", description="Encode a clip with each encoder profile, and report the speed (fps) and size of each. Encodes are added to the history used to predict encode times.")
+    parser.add_argument("file_glob", nargs='*', help="Encode these images instead of a synthetic clip. e.g. 'daily-photos/2000-01-01/*.jpg'")
+    parser.add_argument("--encoders", nargs="+", default=None, help="Profiles to compare. Default: all those whose codec ffmpeg has")
+    parser.add_argument("--config", default=None, help="Add or change profiles with the [encoders] in this toml file. e.g. videod.toml")
+    parser.add_argument("--frames", default=250, type=int, help="Frames in the synthetic clip")
+    parser.add_argument("--fps", default=25, type=int)
+    parser.add_argument("--dest", default=None, help="Keep the videos in this directory. Default: remove them")
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    parser.add_argument('--log-level', '-ll', default='WARNING', type=lambda s: LOG_LEVELS(s).name, choices=LOG_LEVELS.choices())
+
+    try:
+        args = (parser.parse_args(cl_args))
+        LOGGER.setLevel(args.log_level)
+        logging.basicConfig(format=LOG_FORMAT)
+        if args.config:
+            configure_encoders(toml.load(args.config).get('encoders', {}))
+        with tempfile.TemporaryDirectory() as tmp:
+            if args.file_glob:
+                filenames = sorted(f for fg in args.file_glob for f in glob.glob(fg))
+            else:
+                from tmv.images import generate_cal_cross_images  # pylint: disable=import-outside-toplevel
+                images_dir = Path(tmp) / "images"
+                images_dir.mkdir()
+                generate_cal_cross_images(images_dir, period=timedelta(hours=args.frames - 1), step=timedelta(hours=1))
+                filenames = sorted(images_dir.glob("*.jpg"))
+            dest = Path(args.dest or tmp)
+            dest.mkdir(parents=True, exist_ok=True)
+            results = encoder_benchmark(filenames, dest, args.encoders, args.fps)
+        print(f"{'encoder':<12} {'codec':<12} {'preset':<10} {'crf':>4} {'fps':>8} {'MB':>8}")
+        for r in results:
+            print(f"{r['encoder']:<12} {r['codec']:<12} {str(r['preset']):<10} {r['crf'] if r['crf'] is not None else '-':>4} {r['fps']:>8.1f} {r['bytes'] / 1e6:>8.2f}")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1)
+
+    except CalledProcessError as exc:
+        print(cpe2str(exc), file=sys.stderr)
+        LOGGER.debug(cpe2str(exc), exc_info=exc)
+        sys.exit(2)
+    except SignalException as exc:
+        LOGGER.debug("Caught a signal, exiting")
+        print("Exiting gracefully.")
+    except Exception as exc:
+        print(f"Exception: {exc}", file=sys.stderr)
+        LOGGER.debug(f"Exception: {exc}", exc_info=exc)
+        sys.exit(1)
+
+    sys.exit(0)
@@ -5,20 +5,55 @@ import sys
 from pathlib import Path
 import shutil
 import os
-
+import fcntl
+import socket
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from fnmatch import fnmatch
+from functools import partial
+from time import monotonic, sleep, time
+
+import numpy as np
 import toml
+from watchdog.observers import Observer
 from pkg_resources import resource_filename
 from _signal import signal, SIGINT, SIGTERM
-from _datetime import datetime as dt, timedelta
+from _datetime import date, datetime as dt, timedelta
 
 from tmv.exceptions import ConfigError, SignalException
 from tmv.util import LOG_FORMAT_DETAILED, LOG_LEVEL_STRINGS, Tomlable, dt2str, log_level_string_to_int, next_mark, sleep_until, slugify, str2dt
-from tmv.video import VideoMakerDiagonal, VideoMaker, VideoMakerDay, ffmpeg_run, video_join, strptimedelta
+from tmv.video import DEFAULT_BLUR_FRAMES, OUTPUT_FORMATS, Rendition, Video, VideoMakerConcat, VideoMakerDiagonal, VideoMaker, VideoMakerDay, encode_job, ffmpeg_run, output_path, video_join, strptimedelta
+from tmv.framefeed import DEFAULT_READ_AHEAD_MB
+from tmv.catalog import IMAGE_SUFFIXES, Catalog
+from tmv.dirindex import DirIndex
+from tmv.encoders import DEFAULT_ENCODER, configure_encoders, encoder_profile
+import tmv.ffrunner
+import tmv.retention
+from tmv.ffrunner import RUNNER
+from tmv.segments import remove_segments, segments_dir, write_video_incremental
+from tmv.scheduler import CpuBudget, Node, affected, dependencies
+from tmv.manifest import Manifest, by_day
+from tmv.watch import DirtyDays
+from tmv.jobqueue import JobQueue, digest
+from tmv.metrics import Meter, Metrics, metering
 import tmv
 
 
 LOGGER = logging.getLogger(__name__)
 
+# daily-videos/.speeds/x3.4/YYYY-MM-DD.mp4: every 3.4th frame, for recaps to copy
+SPEEDS_DIR = ".speeds"
+
+
+def speed_path(videos_path, speed):
+    """ Where daily videos' variants at speed are kept """
+    return Path(videos_path) / SPEEDS_DIR / f"x{speed:g}"
+
+
+def preview_manifest(video, preview, filters, stat=None) -> Manifest:
+    return Manifest(preview, [video], {'filters': filters}, stat)
+
 
 class Task(Tomlable):
     """
@@ -29,6 +64,10 @@ class Task(Tomlable):
         self.src_path = Path(src_path)
         self.dest_path = Path(dest_path)
         self.priority = 100  # 1-100 or so, smallest first
+        self.cpus = 1  # of the TaskRunner's cpu budget each of its nodes holds while running
+        self.catalog = None  # if set by the TaskRunner, use instead of globbing
+        self.index = DirIndex()  # the TaskRunner's, shared by its tasks
+        self.location = "."
 
     def __str__(self):
         return f"{__name__}:: src: {self.src_path} dest: {self.dest_path}"
@@ -39,11 +78,43 @@ class Task(Tomlable):
     def run(self):
         raise NotImplementedError
 
+    def estimate(self):
+        """ Predicted seconds for run() to encode what's required, or None if unknown """
+        return None
+
+    def inputs(self):
+        """ Paths run() reads. Default: unknown, so it always runs """
+        return []
+
+    def outputs(self):
+        """ Paths run() writes """
+        return [self.dest_path]
+
+    def nodes(self, name):
+        """ The work to do, for the TaskRunner to schedule (see tmv.scheduler). Default: a node to run() """
+        return [Node(name, self, self.run, self.inputs(), self.outputs())]
+
+    def rebase(self, path):
+        """ Make relative paths relative to path (the location's directory), instead of the cwd """
+        self.src_path = Path(path) / self.src_path
+        self.dest_path = Path(path) / self.dest_path
+
+    def make_renditions(self):
+        """ Renditions to make as videos are encoded, from self.renditions """
+        return [Rendition(kind, dest_dir=self.preview_dest, filters=self.preview_filters) for kind in self.renditions]
+
+    def write_rendition_manifests(self, video_filename):
+        """ Record the previews made as video_filename was encoded, so the PreviewVideosTask doesn't remake them """
+        for r in self.make_renditions():
+            if r.kind == "preview" and r.path(video_filename).is_file():
+                preview_manifest(video_filename, r.path(video_filename), r.filters).write()
+
     def configd(self, config_dict):
         """ Parse common Task config items """
         # overwrite default specified in constructor
         self.src_path = Path(config_dict.get("src_path", self.src_path))
         self.dest_path = Path(config_dict.get("dest_path", self.dest_path))
+        self.setattr_from_dict("cpus", config_dict)
         # to consider: try to avoid as the "run()" method would sometimes not run
         # probably need a "ready()" method in this class
         # self.interval = config_dict.get("interval",self.dest_path)
@@ -63,50 +134,190 @@ class DailyVideosTask(Task):
         self.minterpolate = False
         self.fps = 25
         self.speedup = None
+        self.engine = "concat"
+        self.deflicker = "ffmpeg"
+        self.deflicker_window = None
+        self.motion_blur = "none"
+        self.blur_frames = DEFAULT_BLUR_FRAMES
+        self.read_ahead_mb = DEFAULT_READ_AHEAD_MB  # of frames decoded ahead of each encode, with engine "pipe"
+        self.renditions = []  # e.g. ["preview", "poster", "sprite"]: made as each video is encoded
+        self.preview_filters = None  # default: Rendition.DEFAULT_PREVIEW_FILTERS, or as per the PreviewVideosTask
+        self.preview_dest = "previews"
+        self.output_format = "mp4"  # or "fmp4". Not "hls": daily-videos are recapped and previewed as .mp4s
+        self.encoder = DEFAULT_ENCODER  # name of an encoder profile: see tmv.encoders
+        # encode only new frames into segments (in dest_path/.segments), and copy them into the day's video
+        self.incremental = False
+        # also make variants with every speed'th frame (in dest_path/.speeds), e.g. for recaps with method "copy"
+        self.speeds = []
         self.priority = 10
 
     def run(self):
         self.dest_path.mkdir(parents=True, exist_ok=True)
         if not os.path.isdir(self.src_path):
-            LOGGER.warning(f"Ignoring directory {os.getcwd()}: no daily-photos dir")
+            LOGGER.warning(f"Ignoring directory {self.src_path.absolute()}: no daily-photos dir")
             return
 
-        for day_dir in sorted([x for x in self.src_path.iterdir() if x.is_dir()]):
-            try:
-                day = str2dt(str(day_dir.name)).date()
-                mtime_images_dir = dt.fromtimestamp(day_dir.stat().st_mtime)
-                day_video_filename = dt2str(day) + VideoMaker.VIDEO_SUFFIX
-                day_video_path = self.dest_path / day_video_filename
-                if day_video_path.is_file() and dt.fromtimestamp(day_video_path.stat().st_mtime) >= mtime_images_dir:
-                    # video file is newer than images : no update
-                    pass
+        day_dirs = self.index.dirs(self.src_path)
+        for day_dir in day_dirs:
+            self.run_day(day_dir, day_dir == day_dirs[-1])
+
+    def nodes(self, name):
+        """ A node for each day """
+        if not os.path.isdir(self.src_path):
+            return super().nodes(name)
+        day_dirs = self.index.dirs(self.src_path)
+        return [Node(f"{name} {day_dir.name}", self, partial(self.run_day, day_dir, day_dir == day_dirs[-1]), [day_dir], self.day_outputs(day_dir))
+                for day_dir in day_dirs]
+
+    def day_outputs(self, day_dir):
+        """ The day's video and its variants (empty if day_dir isn't a day) """
+        day = str2dt(str(day_dir.name), throw=False)
+        if day is None:
+            return []
+        day_video_filename = dt2str(day.date()) + VideoMaker.VIDEO_SUFFIX
+        return [self.dest_path / day_video_filename] + [speed_path(self.dest_path, s) / day_video_filename for s in self.speeds]
+
+    def run_day(self, day_dir, last):
+        """ Make the day's video (and variants) if its images or settings have changed (see stale). last: it's the latest day """
+        self.dest_path.mkdir(parents=True, exist_ok=True)
+        try:
+            day_video_filename, images, stale = self.stale(day_dir)
+            if stale:
+                # make a video
+                vm = VideoMakerDay()
+                # configure with toml
+                if self.catalog:
+                    vm.files_from_catalog(self.catalog, self.location, subdir=day_dir)
                 else:
-                    # make a video
-                    vm = VideoMakerDay()
-                    # configure with toml
-                    vm.file_list = list(day_dir.glob("*.jpg")) + list(day_dir.glob("*.JPG")) + list(day_dir.glob("*.jpeg")) + list(day_dir.glob("*.JPEG"))
-                    if len(vm.file_list) > 1:
-                        vm.load_videos()
-                        filename = self.dest_path / day_video_filename
+                    vm.file_list = images
+                if len(vm.file_list) > 1:
+                    vm.load_videos()
+                    vm.deflicker_window = self.deflicker_window or vm.deflicker_window
+                    vm.blur_frames = self.blur_frames
+                    vm.read_ahead_mb = self.read_ahead_mb
+                    filename = self.dest_path / day_video_filename
+                    if filename in stale:
                         LOGGER.info("Creating daily-video: {}".format(filename.absolute()))
-                        # ?? touch the preview file so that if we fail, we don't keep trying later runs?
-                        filename.touch()
-                        vm.write_videos(str(filename), fps=self.fps, force=True, speedup=self.speedup)
+                        if self.incremental and (last or segments_dir(filename).is_dir()):
+                            # the day's still being added to
+                            write_video_incremental(vm.videos[0], str(filename), fps=self.fps, speedup=self.speedup, engine=self.engine,
+                                                    deflicker=self.deflicker, motion_blur=self.motion_blur, output_format=self.output_format,
+                                                    encoder=self.encoder)
+                            if not last:
+                                # complete: a later day has started
+                                remove_segments(filename)
+                        else:
+                            vm.write_videos(str(filename), fps=self.fps, force=True, speedup=self.speedup, engine=self.engine,
+                                            deflicker=self.deflicker, motion_blur=self.motion_blur, renditions=self.make_renditions(),
+                                            output_format=self.output_format, encoder=self.encoder)
+                            self.write_rendition_manifests(filename)
+                        stale[filename].write()
+                    for speed in self.speeds:
+                        path = speed_path(self.dest_path, speed) / day_video_filename
+                        if path in stale and self.write_speed(vm.videos[0], speed, day_video_filename):
+                            stale[path].write()
+
+        except ValueError as exc:
+            LOGGER.warning(f"Ignoring directory {os.path.abspath(day_dir)}: not a date format: {exc}")
+
+    def stale(self, day_dir):
+        """
+        Return the day's video filename, its images, and {video: Manifest} of its videos (incl. speeds) that weren't made
+        from these images with these settings. Raise ValueError if not a day.
+        """
+        day = str2dt(str(day_dir.name)).date()
+        day_video_filename = dt2str(day) + VideoMaker.VIDEO_SUFFIX
+        images = self.day_images(day_dir)
+        manifests = {self.dest_path / day_video_filename: Manifest(self.dest_path / day_video_filename, images, self.video_params(), self.index.stat)}
+        for s in self.speeds:
+            path = speed_path(self.dest_path, s) / day_video_filename
+            manifests[path] = Manifest(path, images, self.video_params(s), self.index.stat)
+        return day_video_filename, images, {p: m for p, m in manifests.items() if not m.fresh()}
+
+    def day_images(self, day_dir):
+        if self.catalog:
+            paths, _ = self.catalog.paths(self.location, subdir=day_dir)
+            return [Path(p) for p in paths]
+        return self.index.files(day_dir, IMAGE_SUFFIXES)
+
+    def video_params(self, speed=1):
+        """ Settings that change the videos, for their manifests """
+        return {'speed': speed, 'fps': self.fps, 'speedup': self.speedup, 'engine': self.engine, 'deflicker': self.deflicker,
+                'deflicker_window': self.deflicker_window, 'motion_blur': self.motion_blur, 'blur_frames': self.blur_frames,
+                'output_format': self.output_format, 'encoder': encoder_profile(self.encoder).as_dict()}
+
+    def estimate(self):
+        if not self.src_path.is_dir():
+            return 0
+        seconds = 0
+        for day_dir in self.index.dirs(self.src_path):
+            try:
+                day_video_filename, images, stale = self.stale(day_dir)
+            except ValueError:
+                continue
+            if stale:
+                speeds = {self.dest_path / day_video_filename: 1}
+                speeds.update({speed_path(self.dest_path, s) / day_video_filename: s for s in self.speeds})
+                n_frames = sum(len(images) / speeds[p] for p in stale)
+                if images:
+                    seconds += RUNNER.predict(encode_job(n_frames, image=images[0], encoder=self.encoder)).seconds
+        return seconds
+
+    def write_speed(self, video, speed, filename):
+        """ Write a variant of video with every speed'th frame, with the same encoder settings so recaps can copy it. Return True if written """
+        path = speed_path(self.dest_path, speed) / filename
+        sampled = Video(video.images.sample(round(len(video.images) / speed)))
+        sampled.deflicker_window = video.deflicker_window
+        sampled.blur_frames = video.blur_frames
+        sampled.read_ahead_mb = video.read_ahead_mb
+        sampled.catalog = video.catalog
+        if len(sampled.images) < 2:
+            LOGGER.debug(f"Not enough images for {path}")
+            return False
+        LOGGER.info(f"Creating daily-video at x{speed:g}: {path.absolute()}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        sampled.write_video(str(path), force=True, fps=self.fps, speedup=self.speedup * speed if self.speedup else None, engine=self.engine,
+                            deflicker=self.deflicker, motion_blur=self.motion_blur, output_format=self.output_format, encoder=self.encoder)
+        return True
 
-            except ValueError as exc:
-                LOGGER.warning(f"Ignoring directory {os.path.abspath(day_dir)}: not a date format: {exc}")
-        
     def configd(self, config_dict):
         super().configd(config_dict)
         self.setattr_from_dict("minterpolate", config_dict)
         self.setattr_from_dict("speedup", config_dict)
         self.setattr_from_dict("fps", config_dict)
+        self.setattr_from_dict("engine", config_dict)
+        self.setattr_from_dict("deflicker", config_dict)
+        if 'deflicker_window' in config_dict:
+            self.deflicker_window = strptimedelta(config_dict['deflicker_window'])
+        self.setattr_from_dict("motion_blur", config_dict)
+        self.setattr_from_dict("blur_frames", config_dict)
+        self.setattr_from_dict("read_ahead_mb", config_dict)
+        self.setattr_from_dict("renditions", config_dict)
+        self.setattr_from_dict("output_format", config_dict)
+        self.setattr_from_dict("incremental", config_dict)
+        self.setattr_from_dict("speeds", config_dict)
+        self.setattr_from_dict("encoder", config_dict)
+        encoder_profile(self.encoder)  # raise if unknown
+        if self.output_format not in ("mp4", "fmp4"):
+            raise ConfigError(f"daily-videos output_format must be mp4 or fmp4, not {self.output_format}")
+        if self.incremental and self.deflicker == "ffmpeg":
+            # the filter would restart at each segment
+            if 'deflicker' in config_dict:
+                raise ConfigError('daily-videos with incremental = true need deflicker "numpy" or "none", not "ffmpeg"')
+            self.deflicker = "numpy"
+        if self.minterpolate and 'motion_blur' not in config_dict:
+            self.motion_blur = "minterpolate"
+        if self.incremental and self.motion_blur not in (None, False, "none"):
+            raise ConfigError(f'daily-videos with incremental = true can\'t use motion_blur "{self.motion_blur}", which would restart at each segment')
 
 
 class RecapVideosTask(Task):
     """
-    Concat videos together to recap from past to now.
+    Recap from past to now, by concat'ing daily videos together (method "join"), by
+    sampling frames from the images in photos_path (method "sample"), or by copying
+    the daily videos' variants at the recap's speed (method "copy": see DailyVideosTask.speeds).
     """
+    METHODS = ("join", "sample", "copy")
 
     def __init__(self, src_path, dest_path):
         super().__init__(src_path, dest_path)
@@ -124,51 +335,166 @@ class RecapVideosTask(Task):
             {'label': "Last 30 days", 'days': 30, 'speed': 7.2, 'fps': 25},
             {'label': "Complete", 'days': 0, 'speed': 35.0, 'fps': 25}
         ]
+        self.output_format = "mp4"  # default for each recap, which can set its own 'output_format'
+        self.encoder = DEFAULT_ENCODER  # default for each recap, which can set its own 'encoder'. Not used by "copy"
+        # "join": re-time the daily-videos (all their frames are decoded). "sample": encode only the
+        # images nearest to each output frame's time. "copy": copy (no encoding) the daily-videos
+        # pre-encoded at the recap's speed. Each recap can set its own 'method'
+        self.method = "join"
+        self.photos_path = Path("daily-photos")
+        # for "sample": gaps between images greater than this (e.g. nights) take no time
+        self.disjoint_threshold = timedelta(hours=1)
 
     def configd(self, config_dict):
         """
         Override default with config_dict['create'] settings.
         """
         super().configd(config_dict)
+        self.setattr_from_dict("output_format", config_dict)
+        self.setattr_from_dict("method", config_dict)
+        self.setattr_from_dict("encoder", config_dict)
+        self.photos_path = Path(config_dict.get("photos_path", self.photos_path))
+        if 'disjoint_threshold' in config_dict:
+            self.disjoint_threshold = strptimedelta(config_dict['disjoint_threshold'])
         if 'create' in config_dict:
             for label_days_pair in config_dict['create']:
                 if not all(k in label_days_pair for k in ('label', 'days')):
                     raise ConfigError(f"Need 'label' and 'days' for each item in {config_dict['create']}")
             self.recaps = config_dict['create']
+        for recap in self.recaps:
+            if recap.get('output_format', self.output_format) not in OUTPUT_FORMATS:
+                raise ConfigError(f"output_format must be one of {OUTPUT_FORMATS} in {recap}")
+            if recap.get('method', self.method) not in self.METHODS:
+                raise ConfigError(f"method must be one of {self.METHODS} in {recap}")
+            encoder_profile(recap.get('encoder', self.encoder))  # raise if unknown
 
     def run(self):
-        # Check if our recap video already exists and is equal/newer than the daily-videos *dir*.
-        # Recall that the *dir* mtime is only changes when entries (i.e. new daily video) is added.
-        # So we only re-create videos the following day - when a new daily video is added.
-        # The end date is taken as the last video's time (e.g 2020-01-01.mp4). We don't
+        # Remake a recap when the daily-videos it's made of change (see manifest()). The latest day's video
+        # is still being added to: only its date counts, so recaps are remade the following day, when a new
+        # daily video is added. The end date is taken as the last video's time (e.g 2020-01-01.mp4). We don't
         # use now() as "the last week" really means "the last week of the videos" and would be
         # blank a week after no new images are added.
+        # For method "sample", the same applies to the images in daily-photos' day dirs, and for "copy",
+        # the daily-videos at the recap's speed.
         self.dest_path.mkdir(parents=True, exist_ok=True)
-        daily_videos = [str(p) for p in self.src_path.glob("*") if str2dt(Path(p).stem, throw=False) is not None]
-        if not daily_videos:
-            return
-
-        last_video = max(daily_videos, key=lambda x: str2dt(Path(x).stem, throw=False))
-        end = str2dt(Path(last_video).stem)
-        # daily_video_dates
+        images = None  # loaded if required
         for recap in self.recaps:
             speed = recap.get('speed', 1)
             fps = recap.get('fps', 25)
+            output_format = recap.get('output_format', self.output_format)
+            method = recap.get('method', self.method)
+            encoder = recap.get('encoder', self.encoder)
+            if method == "sample":
+                trigger_path = self.photos_path
+            elif method == "copy" and speed != 1:
+                trigger_path = speed_path(self.src_path, speed)
+            else:
+                trigger_path = self.src_path
+            video_path = Path(output_path(self.dest_path / (slugify(recap['label']) + VideoMaker.VIDEO_SUFFIX), output_format))
+            if not trigger_path.is_dir():
+                continue
+            manifest = self.manifest(recap, video_path, trigger_path)
+            if manifest is None or manifest.fresh():
+                # nothing to recap, or made from the same videos: no update
+                continue
+            if method == "sample":
+                if images is None:
+                    images = self.load_images()
+                if len(images) < 2:
+                    continue
+                end = images.taken[-1].item()
+            else:
+                daily_video_datetimes = {}
+                for p in self.index.files(trigger_path, (VideoMaker.VIDEO_SUFFIX,)):
+                    p_datetime = str2dt(p.stem, throw=False)
+                    if p_datetime is not None:
+                        daily_video_datetimes[str(p)] = p_datetime
+                if not daily_video_datetimes:
+                    continue
+                daily_videos = list(daily_video_datetimes)
+                end = max(daily_video_datetimes.values())
             if recap['days'] > 0:
                 start = end - timedelta(days=recap['days'])
             else:
                 start = dt.min
 
-            video_path = self.dest_path / (slugify(recap['label']) + VideoMaker.VIDEO_SUFFIX)
-            if video_path.is_file() and dt.fromtimestamp(video_path.stat().st_mtime) >= dt.fromtimestamp(self.src_path.stat().st_mtime):
-                # exists, newer: no update
-                pass
+            LOGGER.info("Creating recap-video: {}".format(video_path.absolute()))
+            if method == "sample":
+                if not self.write_sampled(images, video_path, start, speed, fps, output_format, recap.get('seconds'), encoder):
+                    continue
+            elif method == "copy":
+                # already at speed
+                video_join(src_videos=daily_videos, dest_video=str(video_path),
+                           start_datetime=start, end_datetime=end, speed_rel=1, fps=fps, output_format=output_format)
             else:
-                LOGGER.info("Creating recap-video: {}".format(video_path.absolute()))
-                # ?? touch the preview file so that if we fail, we don't keep trying later runs?
-                video_path.touch()
                 video_join(src_videos=daily_videos, dest_video=str(video_path),
-                           start_datetime=start, end_datetime=end, speed_rel=speed, fps=fps)
+                           start_datetime=start, end_datetime=end, speed_rel=speed, fps=fps, output_format=output_format, encoder=encoder)
+            manifest.write()
+
+    def manifest(self, recap, video_path, trigger_path):
+        """
+        Manifest of the recap: of the daily-videos (or for "sample", images) in trigger_path in its range of days,
+        except the latest day's, which is still being added to. None if there are no days to recap.
+        """
+        method = recap.get('method', self.method)
+        if method == "sample":
+            if self.catalog:
+                paths, _ = self.catalog.paths(self.location, subdir=trigger_path)
+                paths = [Path(p) for p in paths]
+            else:
+                paths = self.index.walk_files(trigger_path, IMAGE_SUFFIXES)
+            days = by_day(paths, lambda p: p.parent.name)
+        else:
+            days = by_day(self.index.files(trigger_path, (VideoMaker.VIDEO_SUFFIX,)), lambda p: p.stem)
+            days.pop(None, None)  # not daily-videos
+        latest = max((d for d in days if d is not None), default=None)
+        if latest is None:
+            return None
+        first = latest - timedelta(days=recap['days']) if recap['days'] > 0 else date.min
+        inputs = [p for d, ps in days.items() if d is None or first <= d < latest for p in ps]
+        params = dict(recap, method=method, output_format=recap.get('output_format', self.output_format), latest=latest)
+        if method != "copy":
+            params['encoder'] = encoder_profile(recap.get('encoder', self.encoder)).as_dict()
+        if method == "sample":
+            params['disjoint_threshold'] = self.disjoint_threshold
+        return Manifest(video_path, inputs, params, self.index.stat)
+
+    def rebase(self, path):
+        super().rebase(path)
+        self.photos_path = Path(path) / self.photos_path
+
+    def inputs(self):
+        inputs = [self.src_path]
+        if any(recap.get('method', self.method) == "sample" for recap in self.recaps):
+            inputs.append(self.photos_path)
+        return inputs
+
+    def load_images(self):
+        """ FrameSet of the valid images in photos_path, sorted by time """
+        vm = VideoMakerConcat()
+        if self.catalog:
+            vm.files_from_catalog(self.catalog, self.location, subdir=self.photos_path)
+        else:
+            vm.file_list = self.index.walk_files(self.photos_path, IMAGE_SUFFIXES)
+        vm.read_image_times()
+        return vm.images
+
+    def write_sampled(self, images, video_path, start, speed, fps, output_format, seconds=None, encoder=None):
+        """
+        Encode the images nearest to each output frame's time. The number of output frames is
+        seconds * fps if given, else the number of images (i.e. frames in the daily videos) / speed. Return True if written.
+        """
+        # whole days, as per video_join
+        in_range = images[images.taken >= np.datetime64(start.date(), "us")] if start > dt.min else images
+        n = round(seconds * fps) if seconds else round(len(in_range) / speed)
+        video = Video(in_range.sample(n, self.disjoint_threshold))
+        video.catalog = self.catalog
+        LOGGER.debug(f"Sampled {len(video.images)} of {len(in_range)} images for {video_path}")
+        if len(video.images) < 2:
+            LOGGER.warning(f"Not enough images to sample for {video_path}")
+            return False
+        video.write_video(str(video_path.with_suffix(VideoMaker.VIDEO_SUFFIX)), force=True, fps=fps, output_format=output_format, encoder=encoder)
+        return True
 
 
 class DiagonalVideosTask(Task):
@@ -186,9 +512,34 @@ class DiagonalVideosTask(Task):
         self.speedup = None
         self.priority = 50
         self.sliceage = None
+        self.engine = "concat"
+        self.deflicker = "ffmpeg"
+        self.deflicker_window = None
+        self.motion_blur = "none"
+        self.blur_frames = DEFAULT_BLUR_FRAMES
+        self.read_ahead_mb = DEFAULT_READ_AHEAD_MB
+        self.renditions = []
+        self.preview_filters = None
+        self.preview_dest = "previews"
+        self.output_format = "mp4"
+        self.encoder = DEFAULT_ENCODER
+        self._planned = None  # VideoMakerDiagonal from estimate(), for run()
 
     def configd(self, config_dict):
         super().configd(config_dict)
+        self.setattr_from_dict("engine", config_dict)
+        self.setattr_from_dict("deflicker", config_dict)
+        if 'deflicker_window' in config_dict:
+            self.deflicker_window = strptimedelta(config_dict['deflicker_window'])
+        self.setattr_from_dict("motion_blur", config_dict)
+        self.setattr_from_dict("blur_frames", config_dict)
+        self.setattr_from_dict("read_ahead_mb", config_dict)
+        self.setattr_from_dict("renditions", config_dict)
+        self.setattr_from_dict("output_format", config_dict)
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ConfigError(f"output_format must be one of {OUTPUT_FORMATS}, not {self.output_format}")
+        self.setattr_from_dict("encoder", config_dict)
+        encoder_profile(self.encoder)  # raise if unknown
         if 'sliceage' in config_dict:
             self.sliceage = strptimedelta(config_dict['sliceage'])
 
@@ -198,22 +549,69 @@ class DiagonalVideosTask(Task):
         Hence check daily-photos (src_path) and add a day 
         """
         self.dest_path.mkdir(parents=True, exist_ok=True)
-        vm = VideoMakerDiagonal()
         video_filename = "diagonal-all" + VideoMaker.VIDEO_SUFFIX
-        video_path = self.dest_path / video_filename
-        if video_path.is_file() and \
-                dt.fromtimestamp(video_path.stat().st_mtime) + timedelta(hours=24) >= dt.fromtimestamp(self.src_path.stat().st_mtime):
-            # exists, newer: no update
+        video_path = Path(output_path(self.dest_path / video_filename, self.output_format))
+        vm, self._planned = self._planned, None
+        manifest = self.manifest(video_path)
+        if manifest.fresh():
+            # made from the same days' images: no update
             pass
         else:
-            vm.sliceage = self.sliceage
-            vm.file_list = list(self.src_path.glob("**/*.jpg"))
+            vm = vm or self.video_maker()
             if len(vm.file_list) > 1:
-                vm.load_videos()
                 LOGGER.debug("Creating diagonal-video: {}".format(video_path.absolute()))
-                # ?? touch the preview file so that if we fail, we don't keep trying later runs?
-                video_path.touch()
-                vm.write_videos(str(video_path), fps=self.fps, force=True, speedup=self.speedup)
+                vm.write_videos(str(self.dest_path / video_filename), fps=self.fps, force=True, speedup=self.speedup, engine=self.engine,
+                                deflicker=self.deflicker, motion_blur=self.motion_blur, renditions=self.make_renditions(),
+                                output_format=self.output_format, encoder=self.encoder)
+                self.write_rendition_manifests(self.dest_path / video_filename)
+                manifest.write()
+
+    def inputs(self):
+        return [self.src_path]
+
+    def manifest(self, video_path):
+        """ Manifest of the video: of the images in src_path, except the latest day's, so it's remade at most daily """
+        days = by_day(self.images(), lambda p: p.parent.name)
+        latest = max((d for d in days if d is not None), default=None)
+        inputs = [p for d, ps in days.items() if d != latest for p in ps]
+        params = {'latest': latest, 'fps': self.fps, 'speedup': self.speedup, 'sliceage': self.sliceage,
+                  'engine': self.engine, 'deflicker': self.deflicker, 'deflicker_window': self.deflicker_window,
+                  'motion_blur': self.motion_blur, 'blur_frames': self.blur_frames,
+                  'output_format': self.output_format, 'encoder': encoder_profile(self.encoder).as_dict()}
+        return Manifest(video_path, inputs, params, self.index.stat)
+
+    def images(self):
+        if self.catalog:
+            paths, _ = self.catalog.paths(self.location, subdir=self.src_path)
+            return [Path(p) for p in paths]
+        return self.index.walk_files(self.src_path, IMAGE_SUFFIXES)
+
+    def video_maker(self):
+        """ A VideoMakerDiagonal of src_path, with its videos loaded """
+        vm = VideoMakerDiagonal()
+        vm.sliceage = self.sliceage
+        if self.catalog:
+            vm.files_from_catalog(self.catalog, self.location, subdir=self.src_path)
+        else:
+            vm.file_list = self.images()
+        if len(vm.file_list) > 1:
+            vm.load_videos()
+            vm.deflicker_window = self.deflicker_window or vm.deflicker_window
+            vm.blur_frames = self.blur_frames
+            vm.read_ahead_mb = self.read_ahead_mb
+        return vm
+
+    def estimate(self):
+        video_path = Path(output_path(self.dest_path / ("diagonal-all" + VideoMaker.VIDEO_SUFFIX), self.output_format))
+        if not self.src_path.is_dir() or self.manifest(video_path).fresh():
+            return 0
+        # plan (select the images) now, and keep the plan for run()
+        self._planned = self.video_maker()
+        if len(self._planned.file_list) <= 1:
+            return 0
+        self._planned.write_videos(str(video_path), fps=self.fps, speedup=self.speedup, engine=self.engine, deflicker=self.deflicker,
+                                   motion_blur=self.motion_blur, force=True, dry_run=True, encoder=self.encoder)
+        return sum(v.estimate.seconds for v in self._planned.videos if v.estimate)
 
 
 class PreviewVideosTask(Task):
@@ -250,20 +648,48 @@ class PreviewVideosTask(Task):
             for k, v in config_dict['filters'].items():
                 self.filters[k] = v
 
+    def rebase(self, path):
+        # dest_path is the name of a subdir of each video's dir
+        self.src_path = Path(path) / self.src_path
+
     def run(self):
         # Check (recursive) all videos to see if our thumbnail is out of date and replace it
-        # Careful not to preview the previews (remove via if ...)
-        videos = [p for p in self.src_path.glob("**/*.mp4") if p.parent.name != self.dest_path.name]
+        self.preview(self.videos(self.src_path, recursive=True))
+
+    def nodes(self, name):
+        """
+        A node for each subdir of src_path (e.g. daily-videos), and one for the rest: src_path's own videos
+        and those in subdirs made by other tasks' nodes in this run
+        """
+        subdirs = [d for d in self.index.dirs(self.src_path) if d.name != self.dest_path.name]
+        nodes = [Node(f"{name} {d.name}", self, partial(self.run_dir, d), [d], [d / self.dest_path]) for d in subdirs]
+        nodes.append(Node(name, self, partial(self.run_rest, subdirs), [self.src_path], [self.src_path / self.dest_path]))
+        return nodes
+
+    def run_dir(self, directory):
+        self.preview(self.videos(directory, recursive=True))
+
+    def run_rest(self, subdirs):
+        self.preview([v for v in self.videos(self.src_path, recursive=True) if not any(d in v.parents for d in subdirs)])
+
+    def videos(self, directory, recursive):
+        """ Videos in directory to preview. Careful not to preview the previews, or hidden dirs (segments, speeds) """
+        found = self.index.walk_files(directory, (".mp4",)) if recursive else self.index.files(directory, (".mp4",))
+        return [p for p in found
+                if p.parent.name != self.dest_path.name and not any(part.startswith(".") for part in p.relative_to(self.src_path).parts)]
+
+    def preview(self, videos):
         for v in videos:
             preview_filename = v.parent / self.dest_path / v.name
             preview_filename.parent.mkdir(exist_ok=True, parents=True)
-            if preview_filename.is_file() and preview_filename.stat().st_mtime >= v.stat().st_mtime:
+            manifest = preview_manifest(v, preview_filename, self.filters, self.index.stat)
+            if manifest.fresh():
+                # made from this video, e.g. as a rendition when the video was written
                 pass
             else:
                 LOGGER.info(f"Creating preview at {Path(preview_filename).absolute()} with vf={self.filters}")
-                # touch the preview file so that if we fail, we don't keep trying later runs
-                preview_filename.touch()
                 ffmpeg_run(str(v), str(preview_filename), vf=self.filters)
+                manifest.write()
 
 
 class MostRecent(Tomlable):
@@ -275,6 +701,9 @@ class MostRecent(Tomlable):
         self.src_path = Path(src_path)
         self.dest_path = Path(dest_path)
         self.priority = 80  # 1-100 or so, smallest first
+        self.catalog = None
+        self.index = DirIndex()
+        self.location = "."
 
     def __str__(self):
         return f"MostRecent:: src: {self.src_path} dest: {self.dest_path}"
@@ -284,24 +713,35 @@ class MostRecent(Tomlable):
 
     def run(self):
         # find latest photo in 'daily-images'
-        dated_dirs = sorted((Path(d) for d in Path('daily-photos').glob("????-??-??") if d.is_dir()), reverse=True)
-        last_dir = next(iter(dated_dirs), None)
-        if last_dir:
-            dated_images = sorted((Path(f) for f in last_dir.glob("*.jpg") if f.is_file()), reverse=True)
-            last_image = next(iter(dated_images))
-            if last_image:
-                link_name = f"most-recent-{last_image.name}"
-                for link in Path(".").glob("most-recent-*.jpg"):
-                    link.unlink()
-                os.symlink(str(last_image), link_name)
+        photos_path = self.src_path / "daily-photos"
+        last_image = None
+        if self.catalog:
+            last_image = self.catalog.latest(self.location, subdir=photos_path)
+        else:
+            dated_dirs = [d for d in self.index.dirs(photos_path) if fnmatch(d.name, "????-??-??")]
+            last_dir = next(reversed(dated_dirs), None)
+            if last_dir:
+                last_image = next(reversed(self.index.files(last_dir, IMAGE_SUFFIXES)), None)
+        if last_image:
+            self.link(last_image, "jpg")
     # find latest video  in 'daily-videos'
-        dated_videos = sorted((Path(v) for v in Path('daily-videos').glob("*.mp4") if v.is_file()), reverse=True)
-        last_video = next(iter(dated_videos), None)
+        last_video = next(reversed(self.index.files(self.src_path / "daily-videos", (".mp4",))), None)
         if last_video:
-            link_name = f"most-recent-{last_video.name}"
-            for link in Path(".").glob("most-recent-*.mp4"):
-                link.unlink()
-            os.symlink(str(last_video), link_name)
+            self.link(last_video, "mp4")
+
+    def nodes(self, name):
+        # links, in dest_path, aren't outputs that other tasks read
+        return [Node(name, self, self.run, [self.src_path / "daily-photos", self.src_path / "daily-videos"])]
+
+    def link(self, target, suffix):
+        """ Replace the most-recent-*.suffix link in dest_path with one to target (relative, so the location can move) """
+        for link in self.dest_path.glob(f"most-recent-*.{suffix}"):
+            link.unlink()
+        os.symlink(os.path.relpath(target, self.dest_path), self.dest_path / f"most-recent-{Path(target).name}")
+
+    def rebase(self, path):
+        self.src_path = Path(path) / self.src_path
+        self.dest_path = Path(path) / self.dest_path
 
     def configd(self, config_dict):
         pass
@@ -310,14 +750,165 @@ class MostRecent(Tomlable):
     #    super().configd(config_dict)
 
 
+class CleanupTask(Task):
+    """
+    Keep daily-photos from growing forever: remove empty images (failed uploads), and apply the retention
+    tiers (see tmv.retention) to days as they age. A node for each day with work due, once the tasks reading its
+    images have run. Its daily-videos are made first, and aren't remade from the reduced images after.
+    src:
+    ./daily-photos/YYYY-MM-DD/*.jpg
+    """
+
+    def __init__(self, src_path, dest_path):
+        super().__init__(src_path, dest_path)
+        self.priority = 90
+        self.tiers = []  # e.g. {'days': 30, 'action': "downscale", 'width': 1280}. Default: keep every image as is
+        self.empty_after = 3600  # seconds: remove empty images older than this. None to keep them
+        self.io_rate = None  # MB/s read and written by all the task's nodes. None for no limit
+        self.quality = 90  # of downscaled JPEGs
+        self.threads = 4  # downscaling each day's images at once (their IO is limited by io_rate)
+        self.daily = None  # the DailyVideosTask, if any: see TaskRunner.configd
+        self.readers = []  # other tasks reading the images: each day's node runs after theirs
+        self._limiter = tmv.retention.RateLimiter()
+
+    def configd(self, config_dict):
+        super().configd(config_dict)
+        self.setattr_from_dict("tiers", config_dict)
+        self.setattr_from_dict("empty_after", config_dict)
+        self.setattr_from_dict("io_rate", config_dict)
+        self.setattr_from_dict("quality", config_dict)
+        self.setattr_from_dict("threads", config_dict)
+        tmv.retention.check_tiers(self.tiers)
+        self.tiers = sorted(self.tiers, key=lambda t: t['days'])
+        self._limiter = tmv.retention.RateLimiter(self.io_rate * 2 ** 20 if self.io_rate else None)
+
+    def check(self, recap=None, diagonal=None):
+        """ Raise ConfigError if the tiers would leave too few images for recap's or diagonal's videos to be remade """
+        for tier in self.tiers:
+            if tier['action'] == "thin":
+                for r in recap.recaps if recap else []:
+                    if tier['every'] > r.get('speed', 1):
+                        raise ConfigError(f"Can't thin daily-photos to every {tier['every']}: recap '{r['label']}' needs every {r.get('speed', 1):g}")
+                if diagonal:
+                    raise ConfigError("Can't thin daily-photos: diagonal-videos uses every image in its slice of each day")
+            if tier['action'] == "archive":
+                if diagonal:
+                    raise ConfigError("Can't archive daily-photos: diagonal-videos uses every day's images")
+                for r in recap.recaps if recap else []:
+                    if r.get('method', recap.method) == "sample" and not 0 < r['days'] < tier['days']:
+                        raise ConfigError(f"Can't archive daily-photos after {tier['days']} days: recap '{r['label']}' samples them")
+
+    def nodes(self, name):
+        """ A node for each day with empty images to remove or tiers due """
+        days = [(d, str2dt(d.name, throw=False)) for d in self.index.dirs(self.src_path)]
+        days = [(d, day.date()) for d, day in days if day is not None]
+        if not days:
+            return []
+        latest = days[-1][1]
+        nodes = []
+        for day_dir, day in days:
+            tiers = tmv.retention.due(self.tiers, (latest - day).days, self.state(day_dir))
+            if tiers or self.empty(day_dir):
+                waits = [o for t in self.readers for o in t.outputs()] + (self.daily.day_outputs(day_dir) if self.daily else [])
+                # named by what's due, so it isn't skipped as unchanged since the day's last cleanup
+                nodes.append(Node(" ".join([name, day_dir.name] + [t['action'] for t in tiers]), self, partial(self.run_day, day_dir, tiers),
+                                  [day_dir] + waits, [day_dir]))
+        return nodes
+
+    def state(self, day_dir):
+        """ Tiers applied to day_dir (see tmv.retention). Not read if it has none """
+        listing = self.index.listing(day_dir)
+        if not listing or tmv.retention.STATE_FILENAME not in listing.entries:
+            return {}
+        return tmv.retention.read_state(day_dir)
+
+    def empty(self, day_dir):
+        """ Empty images in day_dir, not changed for empty_after seconds """
+        if self.empty_after is None:
+            return []
+        listing = self.index.listing(day_dir)
+        old = (time() - self.empty_after) * 1e9
+        return [listing.path / name for name, (is_dir, size, mtime_ns) in (listing.entries.items() if listing else [])
+                if not is_dir and size == 0 and mtime_ns < old and name.lower().endswith(IMAGE_SUFFIXES)]
+
+    def run_day(self, day_dir, tiers):
+        """ Remove day_dir's empty images and apply tiers, once its daily-videos are made """
+        for p in self.empty(day_dir):
+            LOGGER.info(f"Removing empty image: {p}")
+            p.unlink(missing_ok=True)
+        if not tiers:
+            return
+        images = self.day_images(day_dir)
+        if self.daily and len(images) > 1 and self.daily.stale(day_dir)[2]:
+            LOGGER.info(f"Not cleaning up {day_dir} until its daily-videos are made")
+            return
+        state = tmv.retention.read_state(day_dir)
+        done = []
+        for tier in (t for t in tiers if t['action'] == "thin"):
+            step = max(1, tier['every'] // state.get('every', 1))
+            removing = set(tmv.retention.thinned(images, step))
+            for p in removing:
+                p.unlink(missing_ok=True)
+            images = [p for p in images if p not in removing]
+            # the tier, as applied: even if an earlier tier's every (e.g. from before the config changed) isn't a factor of it
+            state['every'] = tier['every']
+            done.append(f"thinned to every {state['every']}")
+        for tier in (t for t in tiers if t['action'] == "downscale"):
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                n = sum(pool.map(partial(tmv.retention.downscale_image, width=tier['width'], quality=self.quality, limiter=self._limiter), images))
+            state['downscale'] = tier['width']
+            done.append(f"downscaled {n} to {tier['width']}px")
+        if done:
+            tmv.retention.write_state(day_dir, state)
+            self.index.invalidate(day_dir)
+            self.keep_daily_videos(day_dir)
+        archive = next((t for t in tiers if t['action'] == "archive"), None)
+        if archive:
+            bundle = tmv.retention.archive_day(day_dir, archive.get('format', "tar"), self._limiter)
+            self.index.invalidate(self.src_path)
+            if self.catalog:
+                self.catalog.refresh(self.location)
+            done.append(f"archived to {bundle.name}")
+        LOGGER.info(f"Cleaned up {day_dir}: {', '.join(done)}")
+
+    def keep_daily_videos(self, day_dir):
+        """ Record the day's daily-videos (made before: see run_day) as made from its reduced images, so they aren't remade """
+        if not self.daily:
+            return
+        if self.catalog:
+            self.catalog.refresh(self.location)
+        for manifest in self.daily.stale(day_dir)[2].values():
+            if manifest.output.exists():
+                manifest.write()
+
+    def day_images(self, day_dir):
+        if self.catalog:
+            paths, _ = self.catalog.paths(self.location, subdir=day_dir)
+            return [Path(p) for p in paths]
+        return self.index.files(day_dir, IMAGE_SUFFIXES)
+
+
 class TaskRunner(Tomlable):
     """
-    Scan directories in cwd and calls VideoMaker to create videos. Various tasks can be performed.
+    Scan directories in path (default: cwd) and calls VideoMaker to create videos. Various tasks can be performed.
     """
 
     def __init__(self):
         self.tasks = {}
         self.raise_task_exceptions = False
+        self.catalog = None  # Catalog of tmv_root: refreshed each run, for tasks to use instead of globbing
+        self.index = DirIndex()  # directory listings, shared by the tasks and kept between runs (see tmv.dirindex)
+        self.location = "."  # relative to the catalog's tmv_root
+        self.path = Path(".")  # the location's directory. See rebase()
+        self.stopping = threading.Event()  # set by stop()
+        # seconds per run_tasks(): tasks predicted to take longer than what's left are deferred to the next run
+        self.budget = None
+        # nodes run at once (see tmv.scheduler), holding their task's cpus of cpu_budget (default: cpus, or shared between locations)
+        self.cpus = 1
+        self.cpu_budget = None
+        self._signatures = {}  # node name: signature when it last succeeded
+        self.metrics = Metrics()
+        self.meters = {}  # task name: Meter of its last run
 
     def __str__(self):
         return f"TaskRunner: tasks={self.tasks}"
@@ -328,6 +919,13 @@ class TaskRunner(Tomlable):
     def configd(self, config_dict):
         if 'log_level' in config_dict:
             LOGGER.setLevel(config_dict['log_level'])
+        self.setattr_from_dict('budget', config_dict)
+        self.setattr_from_dict('cpus', config_dict)
+        if 'metrics' in config_dict:
+            self.metrics.configd(config_dict['metrics'])
+        if 'encoders' in config_dict:
+            # before the tasks, which choose from them
+            configure_encoders(config_dict['encoders'])
         if 'most-recent' in config_dict:
             self.tasks['MostRecentTask'] = MostRecent(".", ".")
             self.tasks['MostRecentTask'].configd(config_dict['most-recent'])
@@ -343,48 +941,284 @@ class TaskRunner(Tomlable):
         if 'diagonal-videos' in config_dict:
             self.tasks['DiagonalVideosTask'] = DiagonalVideosTask("daily-photos", "diagonal-videos")
             self.tasks['DiagonalVideosTask'].configd(config_dict['diagonal-videos'])
+        if 'cleanup' in config_dict:
+            self.tasks['CleanupTask'] = CleanupTask("daily-photos", "daily-photos")
+            self.tasks['CleanupTask'].configd(config_dict['cleanup'])
         if 'on-demand-videos' in config_dict:
             raise NotImplementedError
-
-    def run_tasks(self):  # , runs = sys.maxsize):
-
+        if 'DailyVideosTask' in self.tasks and 'RecapVideosTask' in self.tasks:
+            # pre-encode daily videos at the speeds of recaps that copy them
+            recap_task = self.tasks['RecapVideosTask']
+            speeds = {r.get('speed', 1) for r in recap_task.recaps if r.get('method', recap_task.method) == "copy"}
+            self.tasks['DailyVideosTask'].speeds = sorted(set(self.tasks['DailyVideosTask'].speeds) | speeds - {1})
+        if 'CleanupTask' in self.tasks:
+            # reduce only images the other tasks have read, and can read again
+            cleanup = self.tasks['CleanupTask']
+            cleanup.daily = self.tasks.get('DailyVideosTask')
+            cleanup.readers = [self.tasks[t] for t in ('RecapVideosTask', 'DiagonalVideosTask') if t in self.tasks]
+            cleanup.check(self.tasks.get('RecapVideosTask'), self.tasks.get('DiagonalVideosTask'))
+        if 'PreviewVideosTask' in self.tasks:
+            # renditions made during encoding match those the PreviewVideosTask would make, so it skips them
+            for task in self.tasks.values():
+                if getattr(task, "renditions", None):
+                    task.preview_filters = self.tasks['PreviewVideosTask'].filters
+                    task.preview_dest = self.tasks['PreviewVideosTask'].dest_path
+
+    def rebase(self, path):
+        """ Run the tasks in path (absolute), instead of the cwd. Call after configd. """
+        self.path = Path(path)
+        for task in self.tasks.values():
+            task.rebase(self.path)
+
+    def stop(self):
+        """ Don't start any more tasks. The running task (if any) continues """
+        self.stopping.set()
+
+    def run_tasks(self, changed=None):  # , runs = sys.maxsize):
+        """
+        Run the tasks' nodes, each once those it depends on have succeeded, up to cpus at once. Return (succeeded, failed) tasks.
+        Tasks that are deferred (see budget), stopped or skipped as their inputs failed are neither.
+        changed: paths (e.g. day dirs) known to have changed: run only the nodes affected by them. Default: all.
+        """
+        self.prepare(changed)
+        estimates = {}
+        if self.budget:
+            for taskname, task in self.tasks.items():
+                try:
+                    estimates[taskname] = task.estimate()
+                except Exception as exc:  # pylint: disable=broad-except
+                    # run it anyway: it'll fail properly
+                    LOGGER.debug(f"No estimate for {taskname}: {exc}", exc_info=exc)
+                    estimates[taskname] = None
+                if estimates[taskname]:
+                    LOGGER.debug(f"{taskname} estimated to take {timedelta(seconds=round(estimates[taskname]))}")
+
+        meters = {taskname: Meter() for taskname in self.tasks}
+        nodes, names, failed = self.graph(meters)
+        not_run = set()  # tasks deferred, stopped, skipped or not affected by changed
+        depends = dependencies(nodes)
+        if changed is not None:
+            wanted = affected(depends, changed)
+            not_run.update(names[n.task] for n in nodes if n not in wanted)
+            not_run.difference_update(names[n.task] for n in wanted)
+            nodes = [n for n in nodes if n in wanted]
+            depends = {n: depends[n] & wanted for n in nodes}
+        # by priority, then quickest first
+        pending = sorted(nodes, key=lambda n: (n.priority, estimates.get(names[n.task]) or 0, n.name))
+        finished = set()  # nodes succeeded, or not needed
+        failed_nodes = set()  # nodes failed, or skipped as their inputs failed
+        running = {}
+        deferred = set()  # tasks
+        cpu_budget = self.cpu_budget or CpuBudget(self.cpus)
+        start = monotonic()
+        ran = 0
+        with ThreadPoolExecutor(max_workers=self.cpus, thread_name_prefix="node") as pool:
+            try:
+                while pending or running:
+                    for n in [n for n in pending if depends[n] & failed_nodes]:
+                        LOGGER.info(f"Skipping {n.name}: {', '.join(sorted(d.name for d in depends[n] & failed_nodes))} failed")
+                        pending.remove(n)
+                        failed_nodes.add(n)
+                        not_run.add(names[n.task])
+                    if self.stopping.is_set():
+                        not_run.update(names[n.task] for n in pending)
+                        pending.clear()
+                    progressed = False
+                    held = None  # limits the host exceeds (see tmv.admission): checked once a loop, if required
+                    for n in [n for n in pending if depends[n] <= finished]:
+                        if len(running) >= self.cpus:
+                            break
+                        if running:
+                            held = tmv.ffrunner.RUNNER.admission.exceeded(self.path) if held is None else held
+                            if held:
+                                LOGGER.info(f"Holding {n.name} until running nodes finish: {', '.join(held)}")
+                                break
+                        pending.remove(n)
+                        progressed = True
+                        taskname = names[n.task]
+                        elapsed = monotonic() - start
+                        # always run at least one task, so an over-budget task doesn't wait forever
+                        if taskname not in deferred and ran and estimates.get(taskname) and elapsed + estimates[taskname] > self.budget and not any(names[r.task] == taskname for r in running.values()):
+                            LOGGER.info(f"Deferring {taskname}: estimated {timedelta(seconds=round(estimates[taskname]))}, "
+                                        f"{timedelta(seconds=round(self.budget - elapsed))} left of the budget")
+                            deferred.add(taskname)
+                        if taskname in deferred:
+                            not_run.add(taskname)
+                            finished.add(n)  # dependants use what's there
+                            continue
+                        with metering(meters[taskname]):
+                            signature = n.signature(self.index)
+                        if signature is not None and self._signatures.get(n.name) == signature:
+                            LOGGER.debug(f"Skipping {n.name}: unchanged")
+                            finished.add(n)
+                            continue
+                        running[pool.submit(self.run_node, n, cpu_budget, meters[taskname])] = n
+                        ran += 1
+                    if not running:
+                        if progressed:
+                            continue  # skipped nodes may have readied others
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        n = running.pop(future)
+                        exc = future.exception()
+                        if exc is None:
+                            finished.add(n)
+                            with metering(meters[names[n.task]]):
+                                self._signatures[n.name] = n.signature(self.index)
+                            continue
+                        # one failed task shouldn't stop others - handle locally
+                        if self.raise_task_exceptions:
+                            raise exc
+                        LOGGER.debug(f"Continuing other tasks after exception in task: {n.name}, in {self.path.absolute()}: {exc}", exc_info=exc)
+                        failed_nodes.add(n)
+                        failed.add(names[n.task])
+                        meters[names[n.task]].add(failed=1)
+                        self._signatures.pop(n.name, None)
+            except BaseException:
+                # e.g. a signal: don't wait for the running nodes' ffmpeg jobs
+                for future in running:
+                    future.cancel()
+                tmv.ffrunner.RUNNER.cancel_all()
+                raise
+
+        self.write_metrics(meters)
+        succeded = len(self.tasks) - len(failed) - len(not_run - failed)
+        return succeded, len(failed)
+
+    def run_node(self, node, cpu_budget, meter=None):
+        """ Run node holding its cpus, recording its wall time (and what it records: see tmv.metrics) in meter """
+        meter = meter or Meter()
+        with cpu_budget.hold(node.cpus):
+            LOGGER.debug(f"Running {node.name} in {self.path.absolute()}")
+            start = monotonic()
+            try:
+                with metering(meter):
+                    node.run()
+            finally:
+                meter.add(nodes=1, wall_seconds=monotonic() - start)
+
+    def write_metrics(self, meters):
+        """ Log and write (see tmv.metrics) {task name: Meter} of a run """
+        self.meters = meters
+        for taskname, meter in meters.items():
+            if meter.counts['nodes']:
+                LOGGER.info(f"{taskname} in {self.path}: {meter}")
+        self.metrics.write(self.location, self.path, meters)
+
+    def prepare(self, changed=None):
+        """ Share the catalog (refreshed) and index with the tasks, before getting their nodes. changed: as per run_tasks """
         if not self.tasks:
             raise ConfigError("No tasks configured")
-
-        ordered_tasks = {k: v for k, v in sorted(self.tasks.items(), key=lambda t: t[1].priority)}
-        failed = 0
-
-        for (taskname, task) in ordered_tasks.items():
+        if self.catalog:
+            self.catalog.refresh(self.location)
+        for task in self.tasks.values():
+            task.catalog = self.catalog
+            task.index = self.index
+            task.location = self.location
+        for path in changed or []:
+            # e.g. images replaced in place, which doesn't change the dir's mtime
+            self.index.invalidate(path)
+
+    def graph(self, meters=None):
+        """
+        Return the tasks' nodes, {task: name}, and the set of names of tasks whose nodes couldn't be made.
+        meters: {task name: Meter} to record the files scanned to make them
+        """
+        nodes = []
+        names = {}
+        failed = set()
+        for taskname, task in self.tasks.items():
+            names[task] = taskname
             try:
-                LOGGER.debug(f"Running {taskname} in cwd {os.getcwd()}")
-                task.run()
-            except BaseException as exc:
-                # one failed task shouldn't stop others - handle locally
+                with metering((meters or {}).get(taskname)):
+                    nodes.extend(task.nodes(taskname))
+            except Exception as exc:  # pylint: disable=broad-except
                 if self.raise_task_exceptions:
                     raise
-                else:
-                    LOGGER.debug(f"Continuing other tasks after exception in task: {taskname}, cwd: {os.getcwd()}: {exc}", exc_info=exc)
-                    failed += 1
+                LOGGER.debug(f"Continuing other tasks after exception in task: {taskname}, in {self.path.absolute()}: {exc}", exc_info=exc)
+                failed.add(taskname)
+        return nodes, names, failed
 
-        succeded = len(ordered_tasks) - failed
-        return succeded, failed
+    def plan_tasks(self, queue, changed=None):
+        """
+        Enqueue a job (see tmv.jobqueue) for each node whose inputs or outputs have changed since its last job was done,
+        and for the nodes depending on them, after their dependencies' jobs. Return (jobs enqueued, tasks failed).
+        changed: as per run_tasks
+        """
+        self.prepare(changed)
+        nodes, _, failed = self.graph()
+        depends = dependencies(nodes)
+        latest = queue.latest(self.location)
+        candidates = affected(depends, changed) if changed is not None else set(nodes)
+        stale = set()
+        for n in candidates:
+            signature = n.signature(self.index)
+            job = latest.get(n.name)
+            if signature is not None and job and job.state == "done" and job.signature == digest(signature, self.path):
+                continue
+            if job and job.state in ("pending", "running"):
+                continue  # it'll see the changes, or be re-planned once it's done
+            stale.add(n)
+        wanted = stale | affected(depends, [o for n in stale for o in n.outputs])
+        jobs = {}  # node: id
+        for n in sorted(wanted, key=lambda n: (n.priority, n.name)):
+            after = [jobs[d] for d in depends[n] if d in jobs] + \
+                    [latest[d.name].id for d in depends[n] if d not in jobs and d.name in latest and latest[d.name].state in ("pending", "running")]
+            jobs[n] = queue.enqueue(self.location, n.name, n.priority, after)
+        if jobs:
+            LOGGER.debug(f"Enqueued {len(jobs)} jobs in {self.path}: {', '.join(sorted(n.name for n in jobs))}")
+        return len(jobs), len(failed)
+
+    def run_job(self, name):
+        """ Run the node called name (e.g. a job's: see plan_tasks). Return its signature after, or None if there's no such node """
+        self.prepare()
+        nodes, names, _ = self.graph()
+        node = next((n for n in nodes if n.name == name), None)
+        if node is None:
+            LOGGER.info(f"Skipping {name} in {self.path}: no longer required")
+            return None
+        meter = Meter()
+        try:
+            self.run_node(node, self.cpu_budget or CpuBudget(self.cpus), meter)
+        except Exception:
+            meter.add(failed=1)
+            raise
+        finally:
+            self.write_metrics({names[node.task]: meter})
+        return node.signature(self.index)
 
 
 class TaskRunnerManager(Tomlable):
     """
-    In a single directory run a list of tasks to make videos, etc.
+    Run a TaskRunner in each location under tmv_root, up to 'concurrency' locations at once.
+    A lock file in each location stops two videods working on it at once.
+    To share the work between processes (e.g. on several hosts), run one with role "planner" and others with role "worker".
     """
 
     DEFAULT_INTERVAL = timedelta(seconds=60)
+    LOCK_FILENAME = ".videod.lock"
+    # "all": run the tasks. "planner": enqueue their nodes as jobs, for "worker"s to run (see tmv.jobqueue)
+    ROLES = ("all", "planner", "worker")
 
     def __init__(self):
         self.locations = ["."]
         self.tmv_root = "."
         self.vds = {}
         self.interval = self.DEFAULT_INTERVAL
+        self.catalog = False  # use an image catalog in tmv_root instead of globbing
+        self.concurrency = 1  # locations run at once
+        # watch for new images (see tmv.watch) instead of running every interval
+        self.watch = False
+        self.debounce = 10  # seconds
+        self.debounce_max = 120  # seconds
+        self.full_scan = 3600  # seconds between re-listing every dir (and in watch mode, running every location)
+        self.role = "all"
+        self.queue = None  # JobQueue in tmv_root: see open_queue()
+        self._queue_config = {}
 
     def __str__(self):
-        return f"TaskRunnerManager: locations={self.vds} tmv_root={self.tmv_root} interval:{self.interval}"
+        return f"TaskRunnerManager: locations={self.vds} tmv_root={self.tmv_root} interval:{self.interval} concurrency:{self.concurrency} watch:{self.watch}"
 
     def __repr__(self):
         return f"TaskRunnerManager: locations={self.locations} tmv_root={self.tmv_root}"
@@ -397,43 +1231,230 @@ class TaskRunnerManager(Tomlable):
             self.interval = timedelta(seconds=config_dict['interval'])
 
         self.setattr_from_dict('locations', config_dict)
+        self.setattr_from_dict('catalog', config_dict)
+        self.setattr_from_dict('concurrency', config_dict)
+        self.setattr_from_dict('watch', config_dict)
+        self.setattr_from_dict('debounce', config_dict)
+        self.setattr_from_dict('debounce_max', config_dict)
+        self.setattr_from_dict('full_scan', config_dict)
+        self.setattr_from_dict('role', config_dict)
+        self._queue_config = config_dict.get('queue', {})
+        if self.concurrency < 1:
+            raise ConfigError(f"concurrency must be at least 1, not {self.concurrency}")
+        if self.role not in self.ROLES:
+            raise ConfigError(f"role must be one of {self.ROLES}, not {self.role}")
+        if 'ffmpeg' in config_dict:
+            # limits, priority and timeout of all ffmpeg jobs
+            tmv.ffrunner.RUNNER.configd(config_dict['ffmpeg'])
+        catalog = Catalog(self.tmv_root) if self.catalog else None
+        # if set, cpus are shared by all locations' nodes. Else each location has its own
+        cpu_budget = CpuBudget(config_dict['cpus']) if 'cpus' in config_dict else None
+        tmv_root_path = Path(os.path.abspath(self.tmv_root))
         # Make instances for each location
         # Pass the same config to each daemon (they will ignore our  keys)
         # They can override if they want
         for l in self.locations:
             self.vds[l] = TaskRunner()
             self.vds[l].configd(config_dict)
+            self.vds[l].catalog = catalog
+            self.vds[l].location = l
+            self.vds[l].cpu_budget = cpu_budget
+            self.vds[l].rebase(tmv_root_path / l)
 
     def run(self, runs):
-        # start in the specified directory and run forever
+        # run forever, in the specified directory
         if not Path(self.tmv_root).is_dir():
             LOGGER.error(f"No such dir to start in: {Path(self.tmv_root).absolute()}")
 
-        original_cwd = os.getcwd()
-        tmv_root_path = Path(self.tmv_root).absolute()
         LOGGER.debug(f"Starting TaskRunner: {str(self)}")
-
+        if self.role != "all" and self.queue is None:
+            self.open_queue()
+        if self.role == "worker":
+            return self.work(runs)
+        if self.watch:
+            return self.watch_locations(runs)
+        results = {}
+        last_scan = monotonic()
         for run in range(0, runs):
-            s_total = 0
             # run immediately, then sleep between runs
             if run > 0:
                 sleep_until(next_mark(self.interval, dt.now()), dt.now())
-            # run each TaskRunner in sequence 
-            for l, vd in self.vds.items():
-                try:
-                    if (tmv_root_path / l).is_dir():
-                        os.chdir(tmv_root_path / l)
-                        LOGGER.debug(f"running tasks in cwd:{os.getcwd()}")
-                        s, f = vd.run_tasks()
-                        s_total += s
-                        if s_total == 0 or f > 0:
-                            LOGGER.warning(f"TaskRunner at {Path(l).absolute()} failed {f} tasks and succeeded in {s} tasks")
-                except BaseException as exc:
-                    LOGGER.warning(exc)
-                    LOGGER.debug(exc, exc_info=exc)
-
-            LOGGER.debug(f"Finished all tasks under {tmv_root_path}")
-            os.chdir(original_cwd)
+            if monotonic() - last_scan >= self.full_scan:
+                # see files changed in place
+                self.clear_indexes()
+                last_scan = monotonic()
+            results = self.run_locations()
+            self.log_run(run, results)
+        return results
+
+    def watch_locations(self, runs, dirty=None):
+        """
+        Run all locations, then run those with new images once they've settled, and all again every full_scan seconds
+        dirty: a DirtyDays to use. Default: one watching tmv_root
+        """
+        observer = None
+        if dirty is None:
+            dirty = DirtyDays({l: vd.path for l, vd in self.vds.items()}, self.debounce, self.debounce_max)
+            observer = Observer()
+            observer.schedule(dirty, os.path.abspath(self.tmv_root), recursive=True)
+            observer.start()
+            LOGGER.info(f"Watching {os.path.abspath(self.tmv_root)} for new images")
+        results = {}
+        last_scan = None
+        try:
+            run = 0
+            while run < runs:
+                if last_scan is None or monotonic() - last_scan >= self.full_scan:
+                    # catch anything events missed
+                    dirty.clear()
+                    self.clear_indexes()
+                    last_scan = monotonic()
+                    results = self.run_locations()
+                else:
+                    changes = dirty.wait(self.full_scan - (monotonic() - last_scan))
+                    if not changes:
+                        continue
+                    LOGGER.debug(f"Changed: {({l: sorted(str(d) for d in days) for l, days in changes.items()})}")
+                    results = self.run_locations(changes)
+                    # try again later
+                    dirty.requeue({l: changes[l] for l, r in results.items() if r is None})
+                self.log_run(run, results)
+                run += 1
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
+        return results
+
+    def open_queue(self):
+        """ Open (creating if required) the queue of jobs in tmv_root """
+        self.queue = JobQueue(self.tmv_root)
+        self.queue.configd(self._queue_config)
+        return self.queue
+
+    def work(self, jobs=sys.maxsize, idle=None):
+        """
+        Run jobs from the queue, one at a time, until jobs have been run. Return the number run.
+        idle: also stop after this many seconds without a job to run
+        """
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        LOGGER.info(f"Worker {worker} running jobs from {self.queue.path}")
+        ran = 0
+        idle_since = monotonic()
+        while ran < jobs:
+            job = self.queue.claim(worker)
+            if job is None:
+                if idle is not None and monotonic() - idle_since >= idle:
+                    break
+                sleep(self.queue.poll)
+                continue
+            self.run_job(job, worker)
+            ran += 1
+            idle_since = monotonic()
+        return ran
+
+    def run_job(self, job, worker):
+        """ Run job's node, renewing the lease until it's finished, and record the outcome in the queue """
+        vd = self.vds.get(job.location)
+        if vd is None:
+            self.queue.fail(job, worker, f"Unknown location: {job.location}")
+            return
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.queue.lease / 3):
+                if not self.queue.heartbeat(job, worker):
+                    LOGGER.warning(f"Lost the lease of {job.node} in {vd.path}: another worker may be running it")
+                    return
+
+        beating = threading.Thread(target=heartbeat, name="heartbeat", daemon=True)
+        beating.start()
+        try:
+            LOGGER.info(f"Running {job.node} in {vd.path} (job {job.id}, attempt {job.attempts})")
+            signature = vd.run_job(job.node)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.warning(f"{job.node} in {vd.path} failed (attempt {job.attempts} of {self.queue.max_attempts}): {exc}")
+            LOGGER.debug(exc, exc_info=exc)
+            self.queue.fail(job, worker, exc)
+        except BaseException:
+            # e.g. a signal: kill its ffmpeg jobs, and leave it for another worker
+            tmv.ffrunner.RUNNER.cancel_all()
+            self.queue.release(job, worker)
+            raise
+        else:
+            self.queue.done(job, worker, digest(signature, vd.path) if signature is not None else None)
+        finally:
+            stop.set()
+            beating.join()
+
+    def clear_indexes(self):
+        """ Forget the locations' directory listings, so they're all listed again """
+        for vd in self.vds.values():
+            vd.index.clear()
+
+    def log_run(self, run, results):
+        counts = sum((vd.index.take_counts() for vd in self.vds.values()), Counter())
+        succeeded = sum(r[0] for r in results.values() if isinstance(r, tuple))
+        failed = sum(r[1] for r in results.values() if isinstance(r, tuple))
+        errors = [l for l, r in results.items() if isinstance(r, BaseException)]
+        skipped = [l for l, r in results.items() if r is None]
+        done = f"{succeeded} jobs enqueued ({self.queue.counts()})" if self.role == "planner" else f"{succeeded} tasks succeeded"
+        LOGGER.info(f"Finished run {run} of {len(results)} locations under {Path(self.tmv_root).absolute()}: {done}, {failed} failed" +
+                    (f", locations failed: {errors}" if errors else "") + (f", locations busy: {skipped}" if skipped else "") +
+                    f". Listed {counts['scandir']} dirs ({counts['cached']} cached), {counts['stat']} stats")
+
+    def run_locations(self, changes=None):
+        """
+        Run each location's tasks, up to concurrency at once.
+        changes: {location: changed paths} to run only those locations, and only their tasks' nodes affected by the changes
+        Return {location: (succeeded, failed) tasks, None if it was busy, or the exception it raised}
+        """
+        results = {}
+        for vd in self.vds.values():
+            vd.stopping.clear()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="location") as pool:
+            futures = {pool.submit(self.run_location, vd, changes[l] if changes is not None else None): l
+                       for l, vd in self.vds.items() if vd.path.is_dir() and (changes is None or l in changes)}
+            try:
+                for future in as_completed(futures):
+                    l = futures[future]
+                    try:
+                        results[l] = future.result()
+                    except Exception as exc:  # pylint: disable=broad-except
+                        LOGGER.warning(f"TaskRunner at {self.vds[l].path} failed: {exc}")
+                        LOGGER.debug(exc, exc_info=exc)
+                        results[l] = exc
+                        continue
+                    if results[l] and results[l][1] > 0:
+                        LOGGER.warning(f"TaskRunner at {self.vds[l].path} failed {results[l][1]} tasks and succeeded in {results[l][0]} tasks")
+            except BaseException:
+                # e.g. a signal: start nothing else, and kill the running ffmpeg jobs
+                for future in futures:
+                    future.cancel()
+                for vd in self.vds.values():
+                    vd.stop()
+                tmv.ffrunner.RUNNER.cancel_all()
+                raise
+        if self.role == "planner":
+            self.queue.purge(time() - self.queue.keep)
+        return results
+
+    def run_location(self, vd, changed=None):
+        """
+        Run vd's tasks (see TaskRunner.run_tasks) and return (succeeded, failed), or None if another videod is running them.
+        For a planner, enqueue them instead (see TaskRunner.plan_tasks) and return (enqueued, failed)
+        """
+        # not "w", which would change the location dir's signature (see tmv.scheduler) each run
+        with open(vd.path / self.LOCK_FILENAME, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                LOGGER.info(f"Skipping {vd.path}: its tasks are already running")
+                return None
+            LOGGER.debug(f"Running tasks in {vd.path}")
+            if self.role == "planner":
+                return vd.plan_tasks(self.queue, changed)
+            return vd.run_tasks(changed)
 
 
 def sig_handler(signal_received, frame):
@@ -455,7 +1476,8 @@ def videod_console(cl_args=sys.argv[1:]):
                         type=log_level_string_to_int, nargs='?',
                         help='level: {0}'.format(LOG_LEVEL_STRINGS))
     parser.add_argument('--config-file', default="./videod.toml")
-    parser.add_argument('--runs', nargs="?", type=int, default=sys.maxsize)
+    parser.add_argument('--runs', nargs="?", type=int, default=sys.maxsize, help="runs, or for a worker, jobs to run before exiting")
+    parser.add_argument('--role', choices=TaskRunnerManager.ROLES, help="override the config's role (default: all)")
 
     args = (parser.parse_args(cl_args))
 
@@ -474,6 +1496,8 @@ def videod_console(cl_args=sys.argv[1:]):
         print(LOGGER.getEffectiveLevel())
         manager = TaskRunnerManager()
         manager.config(args.config_file)
+        if args.role:
+            manager.role = args.role
         LOGGER.setLevel(args.log_level) # args override
         #tmv.video.LOGGER.setLevel(LOGGER.getEffectiveLevel() + 10)  # less logging for video when running as daemon
         manager.run(args.runs)
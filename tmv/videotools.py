@@ -19,7 +19,8 @@ import re
 from PIL import Image, ImageOps
 from nptime import nptime
 from _datetime import timedelta, datetime as dt
-from tmv.util import cpe2str, LOG_FORMAT, LOG_LEVELS, dt2str, run_and_capture, str2dt
+from tmv.ffrunner import run_ffmpeg
+from tmv.util import cpe2str, LOG_FORMAT, LOG_LEVELS, dt2str, str2dt
 from tmv.config import HH_MM
 
 LOGGER = logging.getLogger(__name__)
@@ -60,6 +61,21 @@ def real_start(filename):
     return i.real_start
 
 
+def jerkiness(filename, size=(160, 90)):
+    """
+    Mean absolute change in frame-to-frame motion (2nd temporal difference) of the luma, 0-1.
+    Lower is smoother. Measured on frames decoded at a small size.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    cl = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", str(filename),
+          "-vf", f"scale={size[0]}:{size[1]},format=gray", "-f", "rawvideo", "-"]
+    out, _ = run_ffmpeg(cl, text=False)
+    frames = np.frombuffer(out, dtype="uint8").reshape(-1, size[1], size[0]).astype("float32")
+    if len(frames) < 3:
+        return 0.0
+    return float(np.abs(frames[2:] - 2 * frames[1:-1] + frames[:-2]).mean()) / 255
+
+
 class VideoInfo():
     """ Use ffprobe to return info about videos """
 
@@ -78,7 +94,7 @@ class VideoInfo():
             try:
                 cl = "ffprobe -hide_banner -v error -show_format -show_streams -print_format json".split()
                 cl.append(self.filename)
-                out, _ = run_and_capture(cl)
+                out, _ = run_ffmpeg(cl)
                 self._info_dict = loads(out)  # json -> dict
             except:
                 LOGGER.debug(f"ffprobe failed (bubbled up) in cwd: {getcwd()}")
@@ -126,7 +142,7 @@ class VideoInfo():
             cl = ["ffprobe", "-i", self.filename]
             cl = cl + "-show_frames -show_entries frame=pkt_pts_time -of json".split()
 
-            out, _ = run_and_capture(cl)
+            out, _ = run_ffmpeg(cl)
             json = loads(out)
             video_frames = [float(f['pkt_pts_time']) for f in json['frames']]  # list of frame timestamps as seconds
             LOGGER.debug(f"frames:{len(video_frames)} real_start={self.real_start} real_duration={str(self.real_duration)}")
@@ -182,7 +198,7 @@ def extract_dated_images(filename, output, start_time=None, end_time=None, inter
     # the_call.extend(['-frame_pts', 'true'])
     the_call.extend(['-qscale:v', '2'])  # jpeg quality: 2-5 is good : https://stackoverflow.com/questions/10225403/how-can-i-extract-a-good-quality-jpeg-image-from-an-h264-video-file-with-ffmpeg
     the_call.extend(['%06d.jpg'])
-    run_and_capture(the_call)  # throw on fail
+    run_ffmpeg(the_call)  # throw on fail
     rx = re.compile(r'\d\d\d\d\d\d\.jpg')  # glob can't match this properly
     image_filenames = [f for f in Path(".").glob("*.jpg") if rx.match(str(f)) is not None]
     last_ts = vi.real_start
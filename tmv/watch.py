@@ -0,0 +1,105 @@
+"""
+Watch tmv_root for new images, instead of rescanning every location each interval.
+
+Images added to, changed in or removed from a day dir (e.g. cam1/daily-photos/2000-01-01/) mark that day dirty in its
+location. Once a location's uploads have settled (no events for 'debounce' seconds, or 'debounce_max' seconds since
+the first), its TaskRunner runs only the nodes affected by its dirty days (see TaskRunner.run_tasks).
+Events aren't guaranteed (e.g. those while videod isn't running, or on network filesystems), so a full scan still
+runs every 'full_scan' seconds.
+"""
+# pylint: disable=line-too-long, logging-fstring-interpolation
+
+import logging
+import threading
+from pathlib import Path
+from time import monotonic
+
+from watchdog.events import FileSystemEventHandler
+
+from tmv.catalog import is_image_name
+from tmv.util import str2dt
+
+LOGGER = logging.getLogger(__name__)
+
+# opened and closed-without-writing events don't change anything
+EVENT_TYPES = ("created", "modified", "moved", "deleted", "closed")
+
+
+class DirtyDays(FileSystemEventHandler):
+    """
+    Collect the day dirs changed in each location from watchdog's events, and release them once they've settled.
+    locations: {location: Path}, absolute
+    """
+
+    def __init__(self, locations, debounce=10, debounce_max=120):
+        super().__init__()
+        self.locations = {l: Path(p) for l, p in locations.items()}
+        self.debounce = debounce  # seconds
+        self.debounce_max = debounce_max  # seconds
+        self._dirty = {}  # location: set of day dirs
+        self._first = {}  # location: monotonic() of its first event
+        self._last = {}  # location: monotonic() of its last event
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        return f"DirtyDays: {({l: len(d) for l, d in self._dirty.items()})} debounce:{self.debounce} debounce_max:{self.debounce_max}"
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in EVENT_TYPES:
+            return
+        for path in (event.src_path, getattr(event, "dest_path", None)):
+            if path:
+                self.add(Path(path))
+
+    def add(self, path, now=None):
+        """ Mark path's day dir dirty, if it's an image in a day dir of a location """
+        if not is_image_name(path.name) or str2dt(path.parent.name, throw=False) is None:
+            return
+        now = monotonic() if now is None else now
+        for l, root in self.locations.items():
+            if root in path.parents:
+                with self._cond:
+                    self._dirty.setdefault(l, set()).add(path.parent)
+                    self._first.setdefault(l, now)
+                    self._last[l] = now
+                    self._cond.notify_all()
+                return
+
+    def requeue(self, changes, now=None):
+        """ Mark {location: day dirs} (e.g. from ready(), of busy locations) dirty again """
+        now = monotonic() if now is None else now
+        with self._cond:
+            for l, days in changes.items():
+                self._dirty.setdefault(l, set()).update(days)
+                self._first.setdefault(l, now)
+                self._last[l] = now
+            self._cond.notify_all()
+
+    def clear(self):
+        """ Forget all changes, e.g. before a full scan """
+        with self._cond:
+            self._dirty.clear()
+            self._first.clear()
+            self._last.clear()
+
+    def ready(self, now=None):
+        """ Remove and return {location: day dirs} of the locations whose changes have settled """
+        now = monotonic() if now is None else now
+        with self._cond:
+            settled = [l for l in self._dirty if now - self._last[l] >= self.debounce or now - self._first[l] >= self.debounce_max]
+            for l in settled:
+                del self._first[l], self._last[l]
+            return {l: self._dirty.pop(l) for l in settled}
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for some locations' changes to settle, and return them as ready() (maybe {}) """
+        until = monotonic() + timeout
+        with self._cond:
+            while True:
+                now = monotonic()
+                changes = self.ready(now)
+                if changes or now >= until:
+                    return changes
+                # until the soonest location could settle, or a new event
+                due = [min(self._last[l] + self.debounce, self._first[l] + self.debounce_max) for l in self._dirty]
+                self._cond.wait(max(0, min(due + [until]) - now))